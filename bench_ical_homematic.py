@@ -0,0 +1,410 @@
+#!/usr/local/share/mypy/bin/python3
+# Copyright (C) 2024 Christian Ospelkaus
+# This file is part of ical_homematic <https://github.com/cospelka/ical_homematic>.
+#
+# ical_homematic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ical_homematic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ical_homematic.  If not, see <http://www.gnu.org/licenses/>.
+
+# Offline simulator and benchmark for ical_homematic. Runs main_loop against a fake
+# AsyncHome with simulated rooms, and against synthetic calendars served from a local
+# HTTP server. Usage:
+#
+#   bench_ical_homematic.py [--rooms 10 100 1000] [--cycles 20]
+#   bench_ical_homematic.py --kernel 10 500 10000
+#
+# Every setup runs in its own process, so that peak memory is measured per setup.
+# --kernel runs the microbenchmarks of the control kernel instead: one batched call, and a
+# simulated week in one-minute steps.
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import tempfile
+import resource
+import threading
+import subprocess
+import multiprocessing
+import http.server
+import functools
+import timeit
+import numpy
+import homematicip.device
+import homematicip.group
+import homematicip.base.enums
+import homematicip.base.functionalChannels
+from homematicip.EventHook import EventHook
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+import ical_homematic
+
+api_calls=dict()
+
+def count_call(name):
+    api_calls[name]=api_calls.get(name,0)+1
+
+def echo(obj):
+    # The cloud confirms every change with a websocket event, which arrives after the call has returned
+    if fake_home is not None and fake_home.loop is not None:
+        event_type=homematicip.base.enums.EventType.GROUP_CHANGED if isinstance(obj,homematicip.group.Group) else homematicip.base.enums.EventType.DEVICE_CHANGED
+        fake_home.loop.call_soon_threadsafe(fake_home.fire,event_type,obj)
+
+fake_home=None
+
+class FakeHeatingGroup(homematicip.group.HeatingGroup):
+    def __init__(self,id,label):
+        self.id=id
+        self.label=label
+        self.groupType="HEATING"
+        self.boostDuration=15
+        self.boostMode=False
+        self.setPointTemperature=18.0
+        self.actualTemperature=round(random.uniform(15.,20.),1)
+        self.controlMode="AUTOMATIC"
+        self.devices=[]
+
+    async def set_point_temperature_async(self,temperature):
+        count_call("set_point_temperature")
+        self.setPointTemperature=temperature
+        echo(self)
+
+    async def set_boost_async(self,enable=True):
+        count_call("set_boost")
+        self.boostMode=enable
+        echo(self)
+
+    async def set_control_mode_async(self,mode):
+        count_call("set_control_mode")
+        self.controlMode=mode
+        echo(self)
+
+class FakeMetaGroup(homematicip.group.MetaGroup):
+    def __init__(self,id,label,devices):
+        self.id=id
+        self.label=label
+        self.groupType="META"
+        self.devices=devices
+
+def init_device(d,id,label):
+    d.id=id
+    d.label=label
+    d.lowBat=False
+    d.unreach=False
+
+class FakeHeatingThermostat(homematicip.device.HeatingThermostat):
+    def __init__(self,id,label):
+        init_device(self,id,label)
+        self.valvePosition=0.0
+        self.valveState="ADAPTION_DONE"
+        self.valveActualTemperature=None
+        self.automaticValveAdaptionNeeded=False
+
+class FakeWallMountedThermostatPro(homematicip.device.WallMountedThermostatPro):
+    def __init__(self,id,label):
+        init_device(self,id,label)
+        self.actualTemperature=None
+        self.setPointTemperature=None
+        self.humidity=45
+        self.vaporAmount=7.5
+
+class FakeSwitchMeasuring(homematicip.device.SwitchMeasuring):
+    def __init__(self,id,label):
+        init_device(self,id,label)
+        self.on=False
+        self.energyCounter=0.0
+
+    async def set_switch_state_async(self,on=True):
+        count_call("set_switch_state")
+        self.on=on
+        echo(self)
+
+class FakeEnergySensorChannel(homematicip.base.functionalChannels.EnergySensorInterfaceChannel):
+    def __init__(self,sensor_type):
+        self.connectedEnergySensorType=sensor_type
+        self.gasVolume=1000.0
+        self.energyCounterOne=5000.0
+        self.energyCounterTwo=None
+        self.energyCounterThree=None
+
+class FakeEnergySensorsInterface(homematicip.device.EnergySensorsInterface):
+    def __init__(self,id,label,sensor_type):
+        init_device(self,id,label)
+        self.functionalChannels=[FakeEnergySensorChannel(sensor_type)]
+
+class FakeAsyncHome:
+    # Stand-in for homematicip.async_home.AsyncHome with simulated rooms. Temperatures drift towards
+    # the set point and every change is reported through onEvent like the websocket does.
+    def __init__(self,num_rooms,switch_rooms=0.1,energy_sensors=2):
+        self.onEvent=EventHook()
+        self.groups=[]
+        self.devices=[]
+        for i in range(num_rooms):
+            label=f'Room {i}'
+            hg=FakeHeatingGroup(f'hg{i}',label)
+            devices=[FakeHeatingThermostat(f'ht{i}a',f'{label} HT a'),FakeHeatingThermostat(f'ht{i}b',f'{label} HT b'),FakeWallMountedThermostatPro(f'wth{i}',f'{label} WTH')]
+            if i < num_rooms*switch_rooms:
+                devices.append(FakeSwitchMeasuring(f'sw{i}',f'{label} Heater'))
+            self.groups.append(hg)
+            self.groups.append(FakeMetaGroup(f'meta{i}',label,devices))
+            self.devices.extend(devices)
+        for i in range(energy_sensors):
+            self.devices.append(FakeEnergySensorsInterface(f'es{i}',f'Meter {i}',"ES_GAS" if i%2==0 else "ES_IEC"))
+        self.event_task=None
+        self.loop=None
+
+    async def enable_events(self):
+        global fake_home
+        count_call("enable_events")
+        fake_home=self
+        self.loop=asyncio.get_running_loop()
+        self.event_task=asyncio.create_task(self.simulate())
+
+    def fire(self,event_type,data):
+        self.onEvent.fire([{"eventType": event_type, "data": data}])
+
+    async def simulate(self,interval=0.05,events_per_tick=5):
+        # Inject websocket events: temperature drift of a few random rooms per tick
+        heating=[g for g in self.groups if g.groupType=="HEATING"]
+        while True:
+            await asyncio.sleep(interval)
+            for g in random.sample(heating,min(events_per_tick,len(heating))):
+                g.actualTemperature=round(g.actualTemperature+0.1*(1 if g.setPointTemperature > g.actualTemperature else -1),1)
+                self.fire(homematicip.base.enums.EventType.GROUP_CHANGED,g)
+            for d in random.sample(self.devices,min(events_per_tick,len(self.devices))):
+                if isinstance(d,homematicip.device.HeatingThermostat):
+                    d.valvePosition=random.random()
+                    self.fire(homematicip.base.enums.EventType.DEVICE_CHANGED,d)
+
+class FakeInfluxDBClient:
+    def __init__(self):
+        self.points=0
+
+    def write_points(self,points):
+        count_call("influx_write_points")
+        self.points+=len(points)
+
+def ics_time(t):
+    return t.strftime("%Y%m%dT%H%M%SZ")
+
+def generate_ics(num_rooms,series_per_room=3,singles_per_room=20,history_days=365):
+    # Synthetic calendar: dense recurring series with EXDATEs and resources, plus a year of past single events
+    now=datetime.datetime.now(datetime.timezone.utc).replace(minute=0,second=0,microsecond=0)
+    lines=["BEGIN:VCALENDAR","VERSION:2.0","PRODID:-//ical_homematic//bench//EN"]
+    uid=0
+    for i in range(num_rooms):
+        for j in range(series_per_room):
+            uid+=1
+            start=now-datetime.timedelta(days=history_days)+datetime.timedelta(hours=random.randint(0,23))
+            lines+=["BEGIN:VEVENT",f'UID:series-{uid}',f'DTSTAMP:{ics_time(now)}',f'DTSTART:{ics_time(start)}',
+                    f'DTEND:{ics_time(start+datetime.timedelta(minutes=random.choice([30,60,90,120])))}',
+                    f'SUMMARY:Series {uid} (HEIZ)',f'RESOURCES:Room {i}',"RRULE:FREQ=DAILY",
+                    f'EXDATE:{ics_time(start+datetime.timedelta(days=history_days+1))}',"END:VEVENT"]
+        for j in range(singles_per_room):
+            uid+=1
+            start=now+datetime.timedelta(hours=random.randint(-24*history_days,24*7))
+            resources=f'Room {i}' if j%5 else f'Room {i},Closed'
+            lines+=["BEGIN:VEVENT",f'UID:single-{uid}',f'DTSTAMP:{ics_time(now)}',f'DTSTART:{ics_time(start)}',
+                    f'DTEND:{ics_time(start+datetime.timedelta(hours=1))}',f'SUMMARY:Event {uid}',f'RESOURCES:{resources}',"END:VEVENT"]
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(lines)+"\r\n").encode()
+
+def serve_directory(directory):
+    # Local HTTP server for the synthetic calendars; SimpleHTTPRequestHandler answers If-Modified-Since with 304
+    handler=functools.partial(QuietHandler,directory=directory)
+    server=http.server.ThreadingHTTPServer(("127.0.0.1",0),handler)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version="HTTP/1.1"
+
+    def log_message(self,*args):
+        pass
+
+def setup(num_rooms,workdir):
+    # Configure the ical_homematic module globals the same way its __main__ block does
+    base_url=serve_directory(workdir)
+    with open(os.path.join(workdir,"global.ics"),"wb") as f:
+        f.write(generate_ics(num_rooms))
+    num_room_calendars=max(1,num_rooms//10)
+    for k in range(num_room_calendars):
+        with open(os.path.join(workdir,f'room{k}.ics'),"wb") as f:
+            f.write(generate_ics(10,series_per_room=1,singles_per_room=5))
+
+    m=ical_homematic
+    m.site.error_msg_filename=os.path.join(workdir,"ical_homematic.msg")
+    m.cycle_time=0.
+    m.lookahead=4
+    m.cache_dir=os.path.join(workdir,"cache")
+    # The fake cloud has no rate limit; measure our own overhead instead of the token bucket
+    m.site.global_config={"url": f'{base_url}/global.ics', "high": 21.0, "low": 18.0, "lown": 16.0, "ramp": 1.0, "veto_resource": "Closed",
+                     "hmip_rate": 1e6, "hmip_burst": 1e6, "hmip_max_concurrency": 64}
+    m.site.home=FakeAsyncHome(num_rooms)
+    m.influx=FakeInfluxDBClient()
+    m.site.rooms=dict()
+    m.get_rooms()
+    m.build_hmip_index()
+    inisections=dict()
+    for i,room in enumerate(m.site.rooms):
+        config={"ical_resource": room}
+        if i%4==1:
+            config={"url": f'{base_url}/room{i%num_room_calendars}.ics', "summary_keyword": "(HEIZ)"}
+        if i%3==0:
+            config["night_start"]=23
+            config["night_end"]=7
+        if i%5==0:
+            config["boost_threshold"]=0.5
+        if (room,f'{room} Heater') in m.site.hmip_index["switches"]:
+            config["heating_switches"]=[f'{room} Heater']
+        inisections[room]=config
+    m.apply_config(inisections)
+
+def percentile(values,p):
+    values=sorted(values)
+    if not values:
+        return 0.
+    return values[min(len(values)-1,int(round(p/100.*(len(values)-1))))]
+
+def run_single(num_rooms,cycles):
+    workdir=tempfile.mkdtemp(prefix="ical_homematic_bench_")
+    os.chdir(workdir)
+    random.seed(num_rooms)
+    setup(num_rooms,workdir)
+    m=ical_homematic
+
+    durations=[]
+    phases=dict()
+    sweep=m.sweep
+    async def timed_sweep():
+        t0=time.perf_counter()
+        retval=await sweep()
+        durations.append(time.perf_counter()-t0)
+        for name,t in m.site.cycle_perf.items():
+            phases.setdefault(name,[]).append(t)
+        return retval
+    m.sweep=timed_sweep
+
+    cpu0=time.process_time()
+    children0=resource.getrusage(resource.RUSAGE_CHILDREN)
+    wall0=time.perf_counter()
+    asyncio.run(m.main_loop(cycles=cycles))
+    wall=time.perf_counter()-wall0
+    cpu=time.process_time()-cpu0
+    # The calendar workers only count in RUSAGE_CHILDREN once they have exited and been waited for
+    if m.calendar_pool is not None:
+        m.calendar_pool.shutdown(wait=True)
+        m.calendar_pool=None
+    for child in multiprocessing.active_children():
+        child.join(5.)
+    children=resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_children=children.ru_utime+children.ru_stime-children0.ru_utime-children0.ru_stime
+    m.stop_logging()
+    return {
+        "rooms": num_rooms,
+        "cycles": len(durations),
+        "first_cycle_ms": durations[0]*1000. if durations else 0.,
+        "p50_ms": percentile(durations[1:],50)*1000.,
+        "p90_ms": percentile(durations[1:],90)*1000.,
+        "p99_ms": percentile(durations[1:],99)*1000.,
+        "wall_s": wall,
+        # Including the calendar workers; their peak RSS is that of the largest one, added to ours
+        "cpu_s": cpu+cpu_children,
+        "cpu_children_s": cpu_children,
+        "peak_rss_mb": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss+children.ru_maxrss)/1024.,
+        "children_rss_mb": children.ru_maxrss/1024.,
+        "api_calls": api_calls,
+        "phases_p50_ms": {name: percentile(t[1:],50)*1000. for name,t in phases.items()},
+    }
+
+def kernel_inputs(num_rooms,now,rng):
+    # Random parameters and state for num_rooms rooms, with events around now
+    params={"high": rng.choice([20.,21.,22.],num_rooms), "low": numpy.full(num_rooms,18.), "lown": numpy.full(num_rooms,16.),
+            "ramp": rng.choice([0.5,1.,2.],num_rooms),
+            "boost_threshold": numpy.where(rng.random(num_rooms) < 0.3,0.5,numpy.nan),
+            "night_start": numpy.where(rng.random(num_rooms) < 0.5,23.,numpy.nan), "night_end": numpy.full(num_rooms,6.),
+            "switches": rng.random(num_rooms) < 0.1, "profile": numpy.zeros(num_rooms,dtype=bool)}
+    first_start=now+rng.uniform(-3600.,4*3600.,num_rooms)
+    state={"setpoint": rng.choice([16.,18.,21.],num_rooms), "actual": rng.uniform(15.,22.,num_rooms),
+           "boost_duration": numpy.full(num_rooms,15.), "boost_last_set": numpy.full(num_rooms,now-3600.),
+           "in_event": rng.random(num_rooms) < 0.2, "night_mode": rng.random(num_rooms) < 0.3,
+           "first_start": numpy.where(rng.random(num_rooms) < 0.7,first_start,numpy.nan),
+           "second_start": numpy.where(rng.random(num_rooms) < 0.3,first_start+3*3600.,numpy.nan)}
+    return params,state
+
+def simulate_week(params,state,now,rng):
+    # One week in one-minute steps: every room has a one hour event each day at a random time, the room
+    # temperature follows the set point with the ramp rate, and the kernel's flags and set points are fed back.
+    state=dict(state)
+    num_rooms=len(state["setpoint"])
+    daily=rng.uniform(0.,86400.,num_rooms)
+    actions=0
+    for minute in range(7*24*60):
+        t=now+60.*minute
+        day_start=t-(t-daily)%86400.
+        state["first_start"]=numpy.where(t-day_start < 3600.,day_start,day_start+86400.)
+        state["first_start"]=numpy.where(state["first_start"]-t < 4*3600.,state["first_start"],numpy.nan)
+        state["second_start"]=numpy.full(num_rooms,numpy.nan)
+        decisions=ical_homematic.control_kernel(params,state,t,int((t//3600)%24))
+        state["in_event"]=decisions["in_event"]
+        state["night_mode"]=decisions["night_mode"]
+        state["setpoint"]=numpy.where(numpy.isnan(decisions["setpoint"]),state["setpoint"],decisions["setpoint"])
+        state["actual"]=state["actual"]+numpy.clip(state["setpoint"]-state["actual"],-params["ramp"]/60.,params["ramp"]/60.)
+        actions+=int(numpy.count_nonzero(~numpy.isnan(decisions["setpoint"])))
+    return actions
+
+def run_kernel(sizes):
+    rng=numpy.random.default_rng(0)
+    now=time.time()
+    print(f'{"rooms":>6} {"call us":>9} {"ns/room":>8} {"week s":>7} {"set points":>10}')
+    for num_rooms in sizes:
+        params,state=kernel_inputs(num_rooms,now,rng)
+        number,_=timeit.Timer(lambda: ical_homematic.control_kernel(params,state,now,12)).autorange()
+        best=min(timeit.repeat(lambda: ical_homematic.control_kernel(params,state,now,12),number=number,repeat=5))/number
+        t0=time.perf_counter()
+        actions=simulate_week(params,state,now,rng)
+        week=time.perf_counter()-t0
+        print(f'{num_rooms:>6} {best*1e6:>9.1f} {best*1e9/num_rooms:>8.1f} {week:>7.2f} {actions:>10}')
+
+def main():
+    parser=argparse.ArgumentParser(description="Offline benchmark of the ical_homematic main loop.")
+    parser.add_argument("--rooms",type=int,nargs="+",default=[10,100,1000],help="number of simulated rooms per setup")
+    parser.add_argument("--cycles",type=int,default=20,help="number of periodic sweeps per setup")
+    parser.add_argument("--kernel",type=int,nargs="+",help="only run the control kernel microbenchmarks for these numbers of rooms")
+    parser.add_argument("--single",type=int,help=argparse.SUPPRESS)
+    args=parser.parse_args()
+
+    if args.kernel:
+        run_kernel(args.kernel)
+        return
+
+    if args.single is not None:
+        print(json.dumps(run_single(args.single,args.cycles)))
+        return
+
+    print(f'{"rooms":>6} {"cycles":>6} {"first ms":>9} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"cpu s":>7} {"rss MB":>7}  api calls')
+    for num_rooms in args.rooms:
+        out=subprocess.run([sys.executable,os.path.abspath(__file__),"--single",str(num_rooms),"--cycles",str(args.cycles)],capture_output=True,text=True)
+        if out.returncode != 0:
+            print(f'{num_rooms:>6} failed:\n{out.stderr}')
+            continue
+        r=json.loads(out.stdout.strip().splitlines()[-1])
+        calls=", ".join(f'{k}={v}' for k,v in sorted(r["api_calls"].items()))
+        print(f'{r["rooms"]:>6} {r["cycles"]:>6} {r["first_cycle_ms"]:>9.1f} {r["p50_ms"]:>8.1f} {r["p90_ms"]:>8.1f} {r["p99_ms"]:>8.1f} {r["cpu_s"]:>7.2f} {r["peak_rss_mb"]:>7.1f}  {calls}')
+        print(f'{"":>6} p50 per phase: '+", ".join(f'{name} {t:.1f} ms' for name,t in r["phases_p50_ms"].items()))
+
+if __name__ == "__main__":
+    main()
@@ -18,9 +18,9 @@
 # nagios/icinga plugin to check that ical_homematic is running and does 
 # not produce any errors.
 
-import os
-import time
 import sys
+import socket
+import json
 
 if len(sys.argv) >=2 :
   suffix = "_" + sys.argv[1]
@@ -32,28 +32,47 @@ def bye(status,statusstr):
   print(f'{exstring[status]} {statusstr}')
   sys.exit(status)
 
+sockname=f'/var/local/ical_homematic{suffix}/ical_homematic.sock'
 statfilename=f'/var/local/ical_homematic{suffix}/ical_homematic.msg'
 
-try:
-  statfiletime=os.path.getmtime(statfilename)
-except:
-  bye(3,f' Unable to determine modification time of status file {statfilename}.')
-
-if time.time()-statfiletime > 120:
-  bye(3,f' Last modification time of status file {statfilename} is more than 120 seconds ago.')
+def query(path):
+  # One HTTP/1.0 request to the status endpoint of the daemon
+  with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as s:
+    s.settimeout(10)
+    s.connect(sockname)
+    s.sendall(f'GET {path} HTTP/1.0\r\nHost: localhost\r\n\r\n'.encode())
+    response=b''
+    while True:
+      data=s.recv(65536)
+      if not data:
+        break
+      response+=data
+  head,_,body=response.partition(b'\r\n\r\n')
+  if not head.split(b' ')[1:2] == [b'200']:
+    raise Exception(head.split(b'\r\n')[0].decode())
+  return json.loads(body)
 
-status=3
-statusstr=f'Could not read from {statfilename}'
-with open(statfilename) as f:
+def last_status_from_file():
+  # Written by the daemon whenever its status changes; it does not tell whether the daemon is still running
   try:
-    statusarr=f.readlines()
+    with open(statfilename) as f:
+      statusarr=f.readlines()
     if statusarr:
-        status=int(statusarr[0])
-        statusarr.pop(0)
-        statusstr=' '.join(statusarr)
-    else:
-        statusstr=f'Status file {statfilename} is empty.'
+      return int(statusarr[0]),' '.join(statusarr[1:])
+    return 3,f'Status file {statfilename} is empty.'
   except:
-    pass
+    return 3,f'Could not read from {statfilename}'
+
+try:
+  health=query('/health')
+except Exception as e:
+  status,statusstr=last_status_from_file()
+  bye(3,f' Status endpoint {sockname} not reachable ({e}). Last status {status}: {statusstr}')
+
+if health["age"] is None:
+  bye(3,f' No cycle completed yet, up for {health["uptime"]:.0f} seconds.')
+
+if health["age"] > 120:
+  bye(3,f' Last cycle completed more than 120 seconds ago ({health["age"]:.0f} seconds).')
 
-bye(status,statusstr)
+bye(health["status"],' '.join(health["messages"]+[health["perf"]]))
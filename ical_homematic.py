@@ -17,60 +17,453 @@
 
 import os
 import sys
-import icalendar
-import recurring_ical_events
+import base64
 import urllib.request
+import urllib.parse
+import http.client
+import threading
+import socket
+import argparse
+import queue
+import atexit
+import contextlib
+import contextvars
+import functools
+import cProfile
 import datetime
 import json
+import hashlib
 import time
+import random
 import configparser
 import numbers
+import bisect
+import collections
+import math
+import heapq
 import asyncio
+import concurrent.futures
+import multiprocessing
 import homematicip
 import homematicip.home
 import homematicip.device
 import homematicip.group
 import homematicip.base.enums
 from systemd.daemon import notify
-from influxdb import InfluxDBClient
-from pprint import pprint
+
+class Site:
+    # The state of one installation: its HmIP home and websocket, rooms, desired-state ledger, scheduler and status.
+    # A single-site daemon has only main_site. The multi-site supervisor runs one Site per site directory, each in
+    # its own asyncio task with current_site set to it. The calendar cache and workers, the influxdb writer and the
+    # log writer are shared by all sites.
+
+    def __init__(self,name=None,directory=""):
+        # Name and working directory of the site when run by the supervisor, else None and ""
+        self.name=name
+        self.directory=directory
+        self.error_msg_filename=os.path.join(directory,"ical_homematic.msg")
+        self.state_filename=os.path.join(directory,"ical_homematic_state.json")
+        self.ramp_filename=os.path.join(directory,"ical_homematic_ramp.json")
+        self.home_snapshot_filename=os.path.join(directory,"home_snapshot.json")
+        # Config files and their modification times when they were last read; None disables the reload
+        self.config_files=[ os.path.join(directory,"ical_homematic.ini") ]
+        self.config_mtimes=None
+        self.inisections=dict()
+        self.global_config=dict()
+        self.log_level=0
+        # HmIP config, HmIP home (set by main()) and the tasks which run next to the sweeps
+        self.config=None
+        self.home=None
+        self.background_tasks=[]
+        self.hmip_semaphore=None
+        self.hmip_bucket=None
+        self.rooms=dict()
+        self.room_configs=dict()
+        # Index of the HmIP home by room label, kept current from the websocket events
+        self.hmip_index={"heating": {}, "meta": {}, "devices": {}, "switches": {}, "groups": {}, "device_labels": {}, "device_rooms": {}, "energy": {}}
+        # Room states by room label. An entry is dropped when an event touches the room and rebuilt on the next read.
+        self.room_state_cache=dict()
+        # Last emitted reading per (counter, counter type): value, time and consumption rate since the reading before
+        self.energy_readings=dict()
+        # HmIP cloud calls by method name, including retries
+        self.api_calls=dict()
+        # Websocket events waiting for event_processor(), coalesced per device
+        self.pending_events=dict()
+        self.events_overflow=False
+        self.events_pending=None
+        self.room_wakeup=None
+        # Desired-state ledger, and when each desired entry was last set, so that a restart can drop the ones from an
+        # earlier decision window
+        self.desired_state=dict()
+        self.desired_times=dict()
+        self.issued_state=dict()
+        # On-device heating profiles by room as uploaded (hash of the plan), so that a profile is only uploaded when
+        # its plan changed
+        self.profile_plans=dict()
+        self.last_saved_state=None
+        # Learned ramp rates
+        self.ramp_samples=dict()
+        self.ramp_intervals=dict()
+        self.ramp_models=dict()
+        self.ramp_fitted=None
+        # Scheduler: heap of (deadline, room) at which a room needs to be re-evaluated, and rooms flagged by websocket events
+        self.room_deadlines=[]
+        self.room_next_deadline=dict()
+        self.dirty_rooms=set()
+        # Plans by room, computed for a range around now and sliced for every query while the timeline (and its
+        # version), the room settings and the ramp lead times are unchanged
+        self.schedule_cache=dict()
+        # Per-phase timing of the current sweep, and evaluation time per room: its share of the control kernel batch
+        # and applying its decision
+        self.cycle_perf=dict()
+        self.room_perf=dict()
+        self.slowest_cycle=0.
+        self.error_log=[]
+        self.icinga_status=0
+        # Error messages by status, counted once per cycle like the status file reports them
+        self.error_counts={0: 0, 1: 0, 2: 0, 3: 0}
+        self.cycle_error_counts=dict()
+        # Outcome of the last completed cycle, served by the status endpoint
+        self.last_status=None
+        self.last_status_file=None
+        self.last_room_states=dict()
+        self.status_servers=[]
+        self.start_time=time.time()
+
+    def load_config(self):
+        # Configure a supervised site from the config files in its directory, like the __main__ block configures a
+        # single site
+        self.config_mtimes=get_config_mtimes(self.config_files)
+        self.inisections=read_config(self.config_files)
+        self.global_config=self.inisections.pop("global")
+        self.log_level=self.global_config.get("log_level",main_site.log_level)
+        self.config=homematicip.load_config_file(self.global_config.get("hmip_config",os.path.join(self.directory,".homematicip-rest-api","config.ini")))
+
+class CurrentSite:
+    # Module functions find the state of the site they run for here: the Site in current_site, which asyncio tasks and
+    # asyncio.to_thread() inherit from the code which started them. Other threads see main_site.
+    __slots__=()
+
+    def __getattr__(self,name):
+        return getattr(current_site.get(),name)
+
+    def __setattr__(self,name,value):
+        setattr(current_site.get(),name,value)
+
+main_site=Site()
+current_site=contextvars.ContextVar("current_site",default=main_site)
+site=CurrentSite()
 
 def start_error_log():
-    global error_log
-    global icinga_status
-    error_log=[]
-    icinga_status=0
+    site.error_log=[]
+    site.icinga_status=0
+    site.cycle_error_counts.clear()
 
 def stop_error_log():
-    global error_msg_filename
-    global error_log
-    global icinga_status
-    with open(error_msg_filename,"w") as f:
-        f.write(str(icinga_status))
-        f.write('\n')
-        f.write('\n'.join(error_log))
+    # The status file is only a fallback for the status endpoint. It is written atomically, and only if it changed.
+    site.last_status={"status": site.icinga_status, "messages": list(site.error_log), "perf": perf_summary() if site.cycle_perf else "", "time": time.time()}
+    for status,count in site.cycle_error_counts.items():
+        site.error_counts[status]=site.error_counts.get(status,0)+count
+    content=(str(site.icinga_status)+'\n'+'\n'.join(site.error_log)).encode()
+    if content != site.last_status_file:
+        try:
+            write_file_atomic(site.error_msg_filename,content)
+            site.last_status_file=content
+        except OSError as e:
+            log(f'ERROR: Could not write {site.error_msg_filename}: {e}')
 
 def error_msg(msg,status=0):
-    global error_log
-    global icinga_status
-    icinga_status=max(icinga_status,status)
-    error_log.append(msg)
+    site.icinga_status=max(site.icinga_status,status)
+    site.cycle_error_counts[status]=site.cycle_error_counts.get(status,0)+1
+    site.error_log.append(msg)
+
+def logtime(t=None):
+    return datetime.datetime.fromtimestamp(t if t is not None else time.time()).strftime("%Y-%m-%d %H:%M:%S")
+
+# Log records are put on this queue by log() and formatted and written by the LogWriter thread,
+# so that the event loop never waits for the disk. If the writer falls behind by log_queue_max records,
+# further records are dropped and counted instead of piling up in memory.
+log_queue_max=10000
+log_queue=queue.Queue(maxsize=log_queue_max)
+log_writer=None
+# Dropped log records, and how many of them the LogWriter has reported in the log
+log_stats={"dropped": 0, "reported": 0}
+
+class LogWriter(threading.Thread):
+    # Buffered appends to the log file with size or daily rotation, optionally as JSON lines
+
+    def __init__(self,filename,max_bytes=10*1024*1024,backup_count=5,rotate_when="size",json_lines=False):
+        super().__init__(name="LogWriter",daemon=True)
+        self.filename=filename
+        self.max_bytes=max_bytes
+        self.backup_count=backup_count
+        self.rotate_when=rotate_when
+        self.json_lines=json_lines
+        self.f=None
+        self.day=None
+
+    def format(self,record):
+        t,level,msg,site=record
+        if self.json_lines:
+            retval={"time": datetime.datetime.fromtimestamp(t).isoformat(timespec="milliseconds"), "level": level, "msg": str(msg)}
+            if site is not None:
+                retval["site"]=site
+            return json.dumps(retval)+"\n"
+        if site is not None:
+            return f'{logtime(t)} [{site}] {msg}\n'
+        return f'{logtime(t)} {msg}\n'
+
+    def open(self):
+        self.f=open(self.filename,"a",buffering=65536)
+        self.day=datetime.date.fromtimestamp(os.path.getmtime(self.filename)) if self.f.tell() else datetime.date.today()
+
+    def rotate(self):
+        self.f.close()
+        if self.rotate_when=="daily":
+            os.replace(self.filename,f'{self.filename}.{self.day.isoformat()}')
+            old=sorted(name for name in os.listdir(os.path.dirname(os.path.abspath(self.filename))) if name.startswith(os.path.basename(self.filename)+"."))
+            for name in old[:-self.backup_count] if self.backup_count > 0 else old:
+                os.remove(os.path.join(os.path.dirname(os.path.abspath(self.filename)),name))
+        else:
+            for i in range(self.backup_count-1,0,-1):
+                if os.path.exists(f'{self.filename}.{i}'):
+                    os.replace(f'{self.filename}.{i}',f'{self.filename}.{i+1}')
+            if self.backup_count > 0:
+                os.replace(self.filename,f'{self.filename}.1')
+            else:
+                os.remove(self.filename)
+        self.open()
+
+    def write(self,record):
+        if self.f is None:
+            self.open()
+        if self.rotate_when=="daily":
+            if datetime.date.fromtimestamp(record[0]) != self.day:
+                self.rotate()
+                self.day=datetime.date.fromtimestamp(record[0])
+        elif self.max_bytes and self.f.tell() >= self.max_bytes:
+            self.rotate()
+        self.f.write(self.format(record))
+
+    def failed(self,e,records):
+        # The log file cannot be written (disk full, permissions, directory gone): the records go to stderr, which
+        # ends up in the journal, and the file is opened again for the next records
+        if not self.failing:
+            sys.stderr.write(f'{logtime()} ERROR: Could not write {self.filename}: {e}\n')
+        self.failing=True
+        for record in records:
+            sys.stderr.write(self.format(record))
+        sys.stderr.flush()
+        try:
+            if self.f is not None:
+                self.f.close()
+        except Exception:
+            pass
+        self.f=None
+
+    def run(self):
+        self.failing=False
+        while True:
+            record=log_queue.get()
+            records=[record]
+            # Write everything which is queued in one go and flush once
+            while True:
+                try:
+                    records.append(log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop=None in records
+            records=[record for record in records if record is not None]
+            dropped=log_stats["dropped"]-log_stats["reported"]
+            if dropped:
+                log_stats["reported"]+=dropped
+                records.append((time.time(),0,f'WARNING: {dropped} log messages were dropped because the log queue was full.',site.name))
+            try:
+                for record in records:
+                    self.write(record)
+                if self.f is not None:
+                    self.f.flush()
+                self.failing=False
+            except Exception as e:
+                # What was written before the error may still be in the buffer, so everything goes to stderr
+                self.failed(e,records)
+            if stop:
+                if self.f is not None:
+                    try:
+                        self.f.close()
+                    except Exception:
+                        pass
+                return
 
-def logtime():
-    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def start_logging(filename="ical_homematic.log",**kwargs):
+    global log_writer
+    stop_logging()
+    log_writer=LogWriter(filename,**kwargs)
+    log_writer.start()
+
+def stop_logging():
+    # Write out everything which is still queued
+    global log_writer
+    if log_writer and log_writer.is_alive():
+        log_queue.put(None)
+        log_writer.join()
+    log_writer=None
 
 def log(msg,log_level_par=0):
-    if log_level_par <= log_level:
-        with open("ical_homematic.log","a") as f:
-            f.write(f'{logtime()} {msg}\n')
+    if log_level_par <= site.log_level:
+        if log_writer is None:
+            start_logging()
+        try:
+            log_queue.put_nowait((time.time(),log_level_par,msg,site.name))
+        except queue.Full:
+            log_stats["dropped"]+=1
+
+def device_kind(d):
+    if isinstance(d,homematicip.device.SwitchMeasuring):
+        return "switches"
+    elif isinstance(d,homematicip.device.WallMountedThermostatPro) or isinstance(d,homematicip.device.TemperatureHumiditySensorWithoutDisplay):
+        return "climate"
+    elif isinstance(d,homematicip.device.HeatingThermostat) or isinstance(d,homematicip.device.HeatingThermostatCompact) or isinstance(d,homematicip.device.HeatingThermostatEvo):
+        return "thermostats"
+    return "other"
+
+def unindex_group(group_id):
+    if not group_id in site.hmip_index["groups"]:
+        return
+    group_type,label=site.hmip_index["groups"].pop(group_id)
+    if group_type=="HEATING":
+        site.hmip_index["heating"].pop(label,None)
+    elif group_type=="META":
+        site.hmip_index["meta"].pop(label,None)
+        for kind,devices in site.hmip_index["devices"].pop(label,{}).items():
+            for d in devices:
+                # Unless the device has been indexed for another room since
+                if site.hmip_index["device_rooms"].get(d.id)==label:
+                    site.hmip_index["device_rooms"].pop(d.id)
+                    site.hmip_index["device_labels"].pop(d.id,None)
+                if kind=="switches":
+                    site.hmip_index["switches"].pop((label,d.label),None)
+
+def unindex_device(device_id):
+    # Remove a device from the index of its room, e.g. after it was removed while its META group still lists it
+    site.hmip_index["device_labels"].pop(device_id,None)
+    label=site.hmip_index["device_rooms"].pop(device_id,None)
+    for kind,devices in site.hmip_index["devices"].get(label,{}).items():
+        for d in [d for d in devices if d.id == device_id]:
+            devices.remove(d)
+            if kind=="switches":
+                site.hmip_index["switches"].pop((label,d.label),None)
+    site.room_state_cache.pop(label,None)
+
+def index_group(g):
+    unindex_group(g.id)
+    if g.groupType=="HEATING":
+        site.hmip_index["heating"][g.label]=g
+    elif g.groupType=="META":
+        site.hmip_index["meta"][g.label]=g
+        devices={"switches": [], "climate": [], "thermostats": [], "other": []}
+        for d in g.devices:
+            kind=device_kind(d)
+            devices[kind].append(d)
+            site.hmip_index["device_labels"][d.id]=d.label
+            site.hmip_index["device_rooms"][d.id]=g.label
+            if kind=="switches":
+                site.hmip_index["switches"][(g.label,d.label)]=d
+        site.hmip_index["devices"][g.label]=devices
+    else:
+        return
+    site.hmip_index["groups"][g.id]=(g.groupType,g.label)
+
+def index_energy_device(d):
+    site.hmip_index["energy"].pop(d.id,None)
+    if isinstance(d,homematicip.device.EnergySensorsInterface):
+        channels=[c for c in d.functionalChannels if isinstance(c,homematicip.base.functionalChannels.EnergySensorInterfaceChannel)]
+        if channels:
+            site.hmip_index["energy"][d.id]=(d,channels)
+
+def build_hmip_index():
+    for key in site.hmip_index:
+        site.hmip_index[key].clear()
+    for g in site.home.groups:
+        index_group(g)
+    for d in site.home.devices:
+        index_energy_device(d)
+    site.room_state_cache.clear()
+
+def reindex_device(d):
+    # Re-index the META groups containing this device, e.g. after it was renamed or removed
+    for g in list(site.hmip_index["meta"].values()):
+        if any(gd.id == d.id for gd in g.devices):
+            index_group(g)
+            site.room_state_cache.pop(g.label,None)
+
+# Websocket events are coalesced per device here and processed in batches by event_processor(), so that
+# event storms (many valves reporting at once, a reconnect flood) cost one update per device and room.
+
+def handle_events(context,event_list):
+    # homematicip callback: only hand the events over to the event loop, in the context (and so to the Site) of the
+    # main() which registered it
+    event_loop.call_soon_threadsafe(queue_events,event_list,context=context)
 
-def handle_events(event_list):
+def queue_events(event_list):
     for event in event_list:
+        site.pending_events[(event["eventType"],getattr(event["data"],"id",None))]=event
+    if len(site.pending_events) > site.global_config.get("event_queue_max",1000):
+        # Too much to process one by one: rebuild the index and the room states instead
+        site.pending_events.clear()
+        site.events_overflow=True
+    site.events_pending.set()
+
+async def event_processor():
+    while True:
+        await site.events_pending.wait()
+        await asyncio.sleep(site.global_config.get("event_coalesce",0.2))
+        site.events_pending.clear()
         notify("WATCHDOG=1")
+        if site.events_overflow:
+            site.events_overflow=False
+            log(f'WARNING: More than {site.global_config.get("event_queue_max",1000)} HmIP events queued, resynchronising all rooms.')
+            build_hmip_index()
+            for room in site.rooms:
+                wake_room(room)
+            continue
+        batch=list(site.pending_events.values())
+        site.pending_events.clear()
+        try:
+            process_events(batch)
+        except Exception as e:
+            log(f'ERROR: Processing HmIP events failed: {e}')
+            build_hmip_index()
+
+def process_events(event_list):
+    for event in event_list:
+        if event["eventType"]==homematicip.base.enums.EventType.GROUP_REMOVED:
+            site.room_state_cache.pop(site.hmip_index["groups"].get(event["data"].id,(None,None))[1],None)
+            unindex_group(event["data"].id)
+        elif event["eventType"]==homematicip.base.enums.EventType.GROUP_ADDED:
+            index_group(event["data"])
+            site.room_state_cache.pop(event["data"].label,None)
+        elif event["eventType"]==homematicip.base.enums.EventType.DEVICE_ADDED:
+            reindex_device(event["data"])
+            index_energy_device(event["data"])
+        elif event["eventType"]==homematicip.base.enums.EventType.DEVICE_REMOVED:
+            reindex_device(event["data"])
+            unindex_device(event["data"].id)
+            site.hmip_index["energy"].pop(event["data"].id,None)
         if event["eventType"]==homematicip.base.enums.EventType.GROUP_CHANGED:
+            index_group(event["data"])
+            site.room_state_cache.pop(event["data"].label,None)
             if isinstance(event["data"],homematicip.group.HeatingGroup):
+                wake_room(event["data"].label)
                 log(f'EVENT {event["data"].label} boost={event["data"].boostMode}')
         elif event["eventType"]==homematicip.base.enums.EventType.DEVICE_CHANGED:
+            if site.hmip_index["device_labels"].get(event["data"].id,event["data"].label) != event["data"].label:
+                reindex_device(event["data"])
+            site.room_state_cache.pop(site.hmip_index["device_rooms"].get(event["data"].id),None)
+            if device_kind(event["data"]) in ("climate","thermostats"):
+                wake_room(site.hmip_index["device_rooms"].get(event["data"].id))
+            elif isinstance(event["data"],homematicip.device.EnergySensorsInterface):
+                index_energy_device(event["data"])
             if isinstance(event["data"],homematicip.device.HeatingThermostat) or isinstance(event["data"],homematicip.device.HeatingThermostatCompact):
                 vp=event["data"].valvePosition
                 if type(vp) == int or type(vp) == float:
@@ -85,215 +478,2079 @@ def handle_events(event_list):
                 log(f'EVENT {event["data"].label} state={event["data"].on}')
 
 def get_energy_counters():
-    global home
+    # Current readings of the energy sensor channels in the index
     counters=dict()
-    for d in home.devices:
-        if isinstance(d,homematicip.device.EnergySensorsInterface):
-            label=d.label
-            counters[label]=dict()
-            for subd in d.functionalChannels:
-                if isinstance(subd,homematicip.base.functionalChannels.EnergySensorInterfaceChannel):
-                    if subd.connectedEnergySensorType == 'ES_GAS':
-                        log(f'INFO: {label} gas volume {subd.gasVolume}',0)
-                        counters[label]["gas"]=subd.gasVolume
-                    elif subd.connectedEnergySensorType == 'ES_IEC':
-                        if subd.energyCounterOne:
-                            log(f'INFO: {label} energy counter 1 {subd.energyCounterOne}',0)
-                            counters[label]["elec1"]=subd.energyCounterOne
-                        if subd.energyCounterTwo:
-                            log(f'INFO: {label} energy counter 2 {subd.energyCounterTwo}',0)
-                            counters[label]["elec2"]=subd.energyCounterTwo
-                        if subd.energyCounterThree:
-                            log(f'INFO: {label} energy counter 3 {subd.energyCounterThree}',0)
-                            counters[label]["elec3"]=subd.energyCounterThree
+    for d,channels in site.hmip_index["energy"].values():
+        label=d.label
+        counters[label]=dict()
+        for subd in channels:
+            if subd.connectedEnergySensorType == 'ES_GAS':
+                counters[label]["gas"]=subd.gasVolume
+            elif subd.connectedEnergySensorType == 'ES_IEC':
+                if subd.energyCounterOne:
+                    counters[label]["elec1"]=subd.energyCounterOne
+                if subd.energyCounterTwo:
+                    counters[label]["elec2"]=subd.energyCounterTwo
+                if subd.energyCounterThree:
+                    counters[label]["elec3"]=subd.energyCounterThree
     return counters
 
+def energy_series(counters,start_date):
+    # Influx points for the readings which moved by more than energy_deadband, or which were last emitted
+    # more than energy_heartbeat seconds ago. Rates are per hour: m³/h for gas, kW for electricity.
+    deadband=site.global_config.get("energy_deadband",0.)
+    heartbeat=site.global_config.get("energy_heartbeat",900.)
+    now=start_date.timestamp()
+    series=[]
+    for counter in counters:
+        for counter_type,value in counters[counter].items():
+            if not isinstance(value,numbers.Number):
+                continue
+            last=site.energy_readings.get((counter,counter_type))
+            rate=None
+            if last is not None:
+                if abs(value-last["value"]) <= deadband and now-last["time"] < heartbeat:
+                    continue
+                if now > last["time"] and value >= last["value"]:
+                    rate=(value-last["value"])/(now-last["time"])*3600.
+            site.energy_readings[(counter,counter_type)]={"value": value, "time": now, "rate": rate}
+            if counter_type == "gas":
+                log(f'INFO: {counter} gas volume {value}'+(f' ({rate:.3f} m³/h)' if rate is not None else ''),0)
+                fields={ "gas": value }
+                if rate is not None:
+                    fields["gas_rate"]=rate
+                series.append({
+                                "measurement": "energy",
+                                "tags":        { "type": "gas", "name": counter },
+                                "time":        start_date,
+                                "fields":      fields
+                              })
+            elif counter_type.startswith("elec"):
+                log(f'INFO: {counter} energy counter {counter_type.removeprefix("elec")} {value}'+(f' ({rate:.3f} kW)' if rate is not None else ''),0)
+                fields={ "electricity": value }
+                if rate is not None:
+                    fields["power"]=rate
+                series.append({
+                                "measurement": "energy",
+                                "tags":        { "type": "electrical", "name": counter, "number": counter_type.removeprefix("elec") },
+                                "time":        start_date,
+                                "fields":      fields
+                              })
+    return series
+
 def get_rooms():
-    global home
-    global rooms
-    for g in home.groups:
+    for g in site.home.groups:
         if g.groupType=="HEATING":
-            if not g.label in rooms:
-                rooms[g.label]={}
+            if not g.label in site.rooms:
+                site.rooms[g.label]={}
 
-def get_room_data(roomname):
-    global home
-    global rooms
+def scan_room_state(roomname):
+    # State of a room from its devices in the index, and the problems found with them
     retval=dict()
+    errors=[]
     retval["thermostats"]=dict()
     retval["switches"]=dict()
     actt=0.0
     num_ht=0
-    for g in home.groups:
-        if g.groupType=="META" and g.label==roomname:
-            for d in g.devices:
-                label=d.label
-                if d.lowBat:
-                    error_msg(f'Device {label} in room {roomname} has low battery.',1)
-                if d.unreach:
-                    error_msg(f'Device {label} in room {roomname} is not reachable.',2)
-                if isinstance(d,homematicip.device.SwitchMeasuring):
-                    retval["switches"][label]={"state": d.on, "energy": d.energyCounter}
-                elif isinstance(d,homematicip.device.WallMountedThermostatPro) or isinstance(d,homematicip.device.TemperatureHumiditySensorWithoutDisplay):
-                    retval["humidity"]=d.humidity
-                    retval["vaporAmount"]=d.vaporAmount
-                elif isinstance(d,homematicip.device.HeatingThermostat) or isinstance(d,homematicip.device.HeatingThermostatCompact) or isinstance(d,homematicip.device.HeatingThermostatEvo):
-                    vp=d.valvePosition
-                    vs=d.valveState
-                    if isinstance(d.valveActualTemperature,numbers.Number): 
-                        actt+=d.valveActualTemperature
-                        num_ht+=1
-                    if not isinstance (vp,float):
-                        error_msg(f'HeatingThermostat {label} in room {roomname} has valvePosition {vp}.',1)
-                    if d.automaticValveAdaptionNeeded:
-                        error_msg(f'HeatingThermostat {label} in room {roomname} requires automatic valve adaption.',2)
-                    if vs != "ADAPTION_DONE":
-                        error_msg(f'HeatingThermostat {label} in room {roomname} has valveState {vs}',1)
-                    retval["thermostats"][label]=vp
-                else:
-                    log(f'DEBUG {roomname}: Unknown device type {type(d).__name__}',1)
-        if g.groupType=="HEATING":
-            # log(f'DEBUG {g.label}: has control mode {g.controlMode}',1)
-            if g.label==roomname:
-                log(f'DEBUG {roomname}: This is a HEATING group',1)
-                retval["boostDuration"]=g.boostDuration
-                retval["setPointTemperature"]=g.setPointTemperature
-                retval["actualTemperature"]=g.actualTemperature
-                retval["controlMode"]=g.controlMode
-                if "url" in rooms[g.label] or "ical_resource" in rooms[g.label]:
-                    if not g.controlMode == 'MANUAL' and not g.controlMode == 'ECO':
-                        log(f'DEBUG {g.label}: Setting controlMode to MANUAL',1)
-                        try:
-                            g.set_control_mode('MANUAL')
-                        except:
-                            log(f'ERROR {g.label}: Setting controlMode to MANUAL failed.',1)
-
-            if ( not g.label in rooms ) or ( g.label in rooms and ( not ("url" in rooms[g.label] or "ical_resource" in rooms[g.label] ))):
-                if not g.controlMode == 'AUTOMATIC' and not g.controlMode == 'ECO':
-                    log(f'DEBUG {g.label}: Setting controlMode to AUTOMATIC',1)
-                    try:
-                        g.set_control_mode('AUTOMATIC')
-                    except:
-                        log(f'ERROR {g.label}: Setting controlMode to AUTOMATIC failed.',1)
+    if roomname in site.hmip_index["meta"]:
+        devices=site.hmip_index["devices"][roomname]
+        for d in site.hmip_index["meta"][roomname].devices:
+            if d.lowBat:
+                errors.append((f'Device {d.label} in room {roomname} has low battery.',1))
+            if d.unreach:
+                errors.append((f'Device {d.label} in room {roomname} is not reachable.',2))
+        for d in devices["switches"]:
+            retval["switches"][d.label]={"state": d.on, "energy": d.energyCounter}
+        for d in devices["climate"]:
+            retval["humidity"]=d.humidity
+            retval["vaporAmount"]=d.vaporAmount
+        for d in devices["thermostats"]:
+            label=d.label
+            vp=d.valvePosition
+            vs=d.valveState
+            if isinstance(d.valveActualTemperature,numbers.Number): 
+                actt+=d.valveActualTemperature
+                num_ht+=1
+            if not isinstance (vp,float):
+                errors.append((f'HeatingThermostat {label} in room {roomname} has valvePosition {vp}.',1))
+            if d.automaticValveAdaptionNeeded:
+                errors.append((f'HeatingThermostat {label} in room {roomname} requires automatic valve adaption.',2))
+            if vs != "ADAPTION_DONE":
+                errors.append((f'HeatingThermostat {label} in room {roomname} has valveState {vs}',1))
+            retval["thermostats"][label]=vp
+        if site.log_level >= 1:
+            for d in devices["other"]:
+                log(f'DEBUG {roomname}: Unknown device type {type(d).__name__}',1)
+    g=site.hmip_index["heating"].get(roomname)
+    if g is not None:
+        if site.log_level >= 1:
+            log(f'DEBUG {roomname}: This is a HEATING group',1)
+        retval["boostDuration"]=g.boostDuration
+        retval["setPointTemperature"]=g.setPointTemperature
+        retval["actualTemperature"]=g.actualTemperature
+        retval["controlMode"]=g.controlMode
     if num_ht >= 1 and not retval["actualTemperature"]:
-        log(f'DEBUG {roomname}: has {num_ht} heating thermostats, but likely no wall-mounted thermostat. We will get the temperature from the average.',1)
+        if site.log_level >= 1:
+            log(f'DEBUG {roomname}: has {num_ht} heating thermostats, but likely no wall-mounted thermostat. We will get the temperature from the average.',1)
         retval["actualTemperature"]=actt/num_ht
-    log(f'DEBUG {roomname}: actualTemperature: {retval["actualTemperature"]}',1)
-    return retval
+    if site.log_level >= 1:
+        log(f'DEBUG {roomname}: actualTemperature: {retval["actualTemperature"]}',1)
+    return retval,errors
 
-async def set_room_temperature(roomname,temperature):
-    global home
-    for g in home.groups:
-        if g.groupType=="HEATING" and g.label==roomname:
-            if not g.controlMode == 'ECO':
-                await g.set_point_temperature_async(temperature)
+def get_room_data(roomname):
+    if not roomname in site.room_state_cache:
+        site.room_state_cache[roomname]=scan_room_state(roomname)
+    state,errors=site.room_state_cache[roomname]
+    for msg,status in errors:
+        error_msg(msg,status)
+    return state
+
+class TokenBucket:
+    # Allows rate calls per second on average with bursts of up to burst calls
+    __slots__ = ("rate", "burst", "tokens", "last")
+
+    def __init__(self,rate,burst):
+        self.rate=rate
+        self.burst=burst
+        self.tokens=burst
+        self.last=time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now=time.monotonic()
+            self.tokens=min(self.burst,self.tokens+(now-self.last)*self.rate)
+            self.last=now
+            if self.tokens >= 1.:
+                self.tokens-=1.
+                return
+            await asyncio.sleep((1.-self.tokens)/self.rate)
+
+async def actuate(description,fn,*args,**kwargs):
+    # Run one HmIP call with bounded concurrency and rate, retrying transient failures with jittered backoff.
+    # Synchronous calls are run in a worker thread.
+    retries=site.global_config.get("hmip_retries",3)
+    call=getattr(fn,"__name__","call").removesuffix("_async")
+    for attempt in range(retries+1):
+        await site.hmip_bucket.acquire()
+        site.api_calls[call]=site.api_calls.get(call,0)+1
+        try:
+            async with site.hmip_semaphore:
+                if asyncio.iscoroutinefunction(fn):
+                    await fn(*args,**kwargs)
+                else:
+                    await asyncio.to_thread(fn,*args,**kwargs)
             return True
+        except Exception as e:
+            if attempt == retries:
+                log(f'ERROR {description} failed after {retries+1} attempts: {e}')
+                error_msg(f'{description} failed.',1)
+                return False
+            delay=min(2.**attempt,60.)*random.uniform(0.5,1.5)
+            log(f'WARNING {description} failed ({e}), retrying in {delay:.1f} s.')
+            await asyncio.sleep(delay)
+
+async def set_room_control_mode(roomname):
+    # Rooms controlled by a calendar need MANUAL mode, all others AUTOMATIC. ECO is left alone.
+    g=site.hmip_index["heating"].get(roomname)
+    if g is None:
+        return
+    if site.room_configs[roomname].heating_profile is not None:
+        # The heating profile only runs in AUTOMATIC mode
+        mode='AUTOMATIC'
+    elif site.room_configs[roomname].calendar_url is not None:
+        mode='MANUAL'
+    else:
+        mode='AUTOMATIC'
+    if not g.controlMode == mode and not g.controlMode == 'ECO':
+        if site.log_level >= 1:
+            log(f'DEBUG {roomname}: Setting controlMode to {mode}',1)
+        await actuate(f'{roomname}: Setting controlMode to {mode}',hmip_method(g,"set_control_mode"),mode)
+
+async def set_room_temperature(roomname,temperature):
+    g=site.hmip_index["heating"].get(roomname)
+    if g is not None:
+        if not g.controlMode == 'ECO':
+            return await actuate(f'{roomname}: Setting temperature to {temperature}°C',g.set_point_temperature_async,temperature)
+        return True
     error_msg(f'Set point temperature could not be set to {temperature} for room {roomname} because we did not find the proper heating group.',2)
     return False
 
 async def set_room_boost(roomname,status):
-    global home
-    for g in home.groups:
-        if g.groupType=="HEATING" and g.label==roomname:
-            await g.set_boost_async(enable=status)
-            return True
+    g=site.hmip_index["heating"].get(roomname)
+    if g is not None:
+        return await actuate(f'{roomname}: Setting boost to {status}',g.set_boost_async,enable=status)
     error_msg(f'Boost mode could not be set to {status} for room {roomname} because we did not find the proper heating group.',2)
     return False
 
 async def set_room_switch(roomname,switch,status):
-    global home
-    for g in home.groups:
-        if g.groupType=="META" and g.label==roomname:
-            for d in g.devices:
-                label=d.label
-                if isinstance(d,homematicip.device.SwitchMeasuring) and label==switch:
-                    await d.set_switch_state_async(status)
-                    return True
+    d=site.hmip_index["switches"].get((roomname,switch))
+    if d is not None:
+        return await actuate(f'{roomname}: Setting switch {switch} to {status}',d.set_switch_state_async,status)
     error_msg(f'Switch state for switch {switch} in room {roomname} could not be set to {status} bcuause we did not find the proper device.',2)
     return False
 
-def refresh_calendar(room,label):
+# Pool of idle keep-alive connections per (scheme,host,port,proxy) with the time they became idle, shared by the download threads
+http_pool=dict()
+http_semaphore=None
+http_pool_lock=threading.Lock()
+
+def http_proxy(u):
+    # The proxy from http_proxy/https_proxy for a split URL, unless no_proxy exempts its host, like urlopen() does
+    proxy=urllib.request.getproxies().get(u.scheme)
+    if proxy is None or urllib.request.proxy_bypass(u.hostname):
+        return None
+    return proxy if "://" in proxy else f'http://{proxy}'
+
+def proxy_auth(proxy):
+    # Proxy-Authorization header for credentials in the proxy URL
+    p=urllib.parse.urlsplit(proxy)
+    if p.username is None:
+        return {}
+    credentials=f'{urllib.parse.unquote(p.username)}:{urllib.parse.unquote(p.password or "")}'
+    return {"Proxy-Authorization": "Basic "+base64.b64encode(credentials.encode()).decode()}
+
+def http_connection(u,proxy,timeout):
+    # New connection to the host of a split URL, or to the proxy. https goes through a CONNECT tunnel.
+    if proxy is None:
+        if u.scheme=="https":
+            return http.client.HTTPSConnection(u.hostname,u.port,timeout=timeout)
+        return http.client.HTTPConnection(u.hostname,u.port,timeout=timeout)
+    p=urllib.parse.urlsplit(proxy)
+    if u.scheme=="https":
+        conn=http.client.HTTPSConnection(p.hostname,p.port or 8080,timeout=timeout)
+        conn.set_tunnel(u.hostname,u.port,headers=proxy_auth(proxy))
+        return conn
+    return http.client.HTTPConnection(p.hostname,p.port or 8080,timeout=timeout)
+
+def idle_connection(key):
+    # The most recently used idle connection to key, or None. Servers close keep-alive connections after a few
+    # seconds, so connections idle for longer than http_idle_timeout seconds are closed instead of reused.
+    now=time.monotonic()
+    idle_timeout=main_site.global_config.get("http_idle_timeout",4.)
+    with http_pool_lock:
+        idle=http_pool.setdefault(key,[])
+        stale=[conn for conn,since in idle if now-since > idle_timeout]
+        idle[:]=[(conn,since) for conn,since in idle if now-since <= idle_timeout]
+        conn=idle.pop()[0] if idle else None
+    for old in stale:
+        old.close()
+    return conn
+
+def http_request(conn,path,headers):
+    # One GET on conn, which is closed if it fails. Returns (response,body).
     try:
-        ical_string = urllib.request.urlopen(room["url"]).read()
+        conn.request("GET",path,headers={"Accept-Encoding": "identity", **headers})
+        resp=conn.getresponse()
+        return resp,resp.read()
     except:
+        conn.close()
+        raise
+
+def http_get(url,headers={},timeout=30.,max_redirects=5):
+    # Blocking GET which reuses keep-alive connections to the same host. Returns (status,headers,body).
+    for i in range(max_redirects+1):
+        u=urllib.parse.urlsplit(url)
+        if not u.scheme in ("http","https"):
+            # file:// and friends
+            return 200,{},urllib.request.urlopen(url,timeout=timeout).read()
+        proxy=http_proxy(u)
+        key=(u.scheme,u.hostname,u.port,proxy)
+        request_headers=headers
+        if proxy is not None and u.scheme=="http":
+            # A plain HTTP proxy takes the absolute URL
+            path=urllib.parse.urlunsplit(u._replace(fragment=""))
+            request_headers={**proxy_auth(proxy), **headers}
+        else:
+            path=u.path or "/"
+            if u.query:
+                path+="?"+u.query
+        conn=idle_connection(key)
+        reused=conn is not None
+        if not reused:
+            conn=http_connection(u,proxy,timeout)
+        try:
+            resp,body=http_request(conn,path,request_headers)
+        except (http.client.RemoteDisconnected,BrokenPipeError,ConnectionResetError):
+            if not reused:
+                raise
+            # The server closed the idle connection before it saw our request: once more on a fresh one
+            conn=http_connection(u,proxy,timeout)
+            resp,body=http_request(conn,path,request_headers)
+        if resp.will_close:
+            conn.close()
+        else:
+            with http_pool_lock:
+                http_pool[key].append((conn,time.monotonic()))
+        if resp.status in (301,302,303,307,308) and resp.getheader("Location"):
+            url=urllib.parse.urljoin(url,resp.getheader("Location"))
+            continue
+        if resp.status >= 400:
+            raise http.client.HTTPException(f'HTTP status {resp.status} for {url}')
+        return resp.status,dict(resp.getheaders()),body
+    raise http.client.HTTPException(f'Too many redirects for {url}')
+
+# Calendar cache keyed by URL. Rooms and global_config sharing a URL share one set of event records and occurrences.
+calendars=dict()
+
+def calendar_cache_file(url,ext):
+    return os.path.join(cache_dir,hashlib.sha256(url.encode()).hexdigest()+ext)
+
+def write_file_atomic(filename,data):
+    # The temporary name is per process, as site worker processes share the calendar cache
+    tmpname=f'{filename}.{os.getpid()}.tmp'
+    with open(tmpname,"wb") as f:
+        f.write(data)
+    os.replace(tmpname,filename)
+
+def load_cached_calendar(url):
+    # Last good calendar body on disk, so that a restart or an outage of the calendar host does not leave rooms without a calendar
+    entry={"url": url}
+    try:
+        with open(calendar_cache_file(url,".json")) as f:
+            meta=json.load(f)
+    except FileNotFoundError:
+        return entry
+    except Exception as e:
+        log(f'ERROR: Could not load cached calendar for {url}: {e}')
+        return entry
+    if not os.path.exists(calendar_cache_file(url,".ics")):
+        return entry
+    entry["etag"]=meta.get("etag")
+    entry["last_modified"]=meta.get("last_modified")
+    entry["cal_last_update"]=datetime.datetime.fromtimestamp(meta.get("fetched",0))
+    if site.log_level >= 1:
+        log(f'ICAL: Using cached calendar for {url} from {entry["cal_last_update"]}.',1)
+    return entry
+
+def store_cached_calendar_meta(entry):
+    meta={"url": entry["url"], "etag": entry.get("etag"), "last_modified": entry.get("last_modified"), "fetched": time.time()}
+    write_file_atomic(calendar_cache_file(entry["url"],".json"),json.dumps(meta).encode())
+
+async def refresh_calendar(url,label):
+    # The download runs in a worker thread, so a slow calendar host does not stall the event loop
+    entry=calendars[url]
+    headers={}
+    if entry.get("etag"):
+        headers["If-None-Match"]=entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"]=entry["last_modified"]
+    try:
+        async with http_semaphore:
+            status,resp_headers,ical_string = await asyncio.to_thread(http_get,url,headers,timeout=site.global_config.get("http_timeout",30.))
+    except Exception as e:
+        log(f'ERROR {label}: Downloading calendar failed: {e}')
         error_msg(f'Could not download calendar file for {label}',2)
+        return
+    entry["cal_last_update"] = datetime.datetime.now()
+    if status == 304 and os.path.exists(calendar_cache_file(url,".ics")):
+        if site.log_level >= 1:
+            log(f'ICAL {label}: Calendar not modified.',1)
+        try:
+            await asyncio.to_thread(os.utime,calendar_cache_file(url,".json"))
+        except OSError:
+            pass
+        return
+    # The new body only replaces the cached one if it can be ingested
+    newfile=calendar_cache_file(url,f'.ics.{os.getpid()}.new')
+    try:
+        os.makedirs(cache_dir,exist_ok=True)
+        await asyncio.to_thread(write_file_atomic,newfile,ical_string)
+    except Exception as e:
+        log(f'ERROR {label}: Could not write calendar cache: {e}')
+        return
+    del ical_string
+    try:
+        await ingest_calendar_file(url,entry,newfile)
+    except Exception as e:
+        log(f'ERROR {label}: Could not parse calendar: {e}')
+        error_msg(f'Could not convert calendar file to icalendar for {label}',2)
+        os.remove(newfile)
+        return
+    os.replace(newfile,calendar_cache_file(url,".ics"))
+    entry["etag"] = resp_headers.get("ETag")
+    entry["last_modified"] = resp_headers.get("Last-Modified")
+    try:
+        await asyncio.to_thread(store_cached_calendar_meta,entry)
+    except Exception as e:
+        log(f'ERROR {label}: Could not write calendar cache: {e}')
+
+def calendar_job(entry,job):
+    # At most one download or expansion of a calendar runs at a time, also when several sites share it. job() is only
+    # called if none is running; the running one is returned otherwise. Shielded, so that a site which is stopped
+    # does not cancel the job for the others.
+    if not "job" in entry:
+        task=asyncio.ensure_future(job())
+        entry["job"]=task
+        task.add_done_callback(lambda task: entry.pop("job",None))
+    return asyncio.shield(entry["job"])
+
+async def refresh_calendars():
+    # Refresh all calendars which are due concurrently; a refresh takes about as long as the slowest calendar.
+    users=dict()
+    if "url" in site.global_config:
+        users.setdefault(site.global_config["url"],[]).append(("global calendar",site.global_config))
+    for room in site.rooms:
+        if site.room_configs[room].url is not None:
+            users.setdefault(site.room_configs[room].url,[]).append((room,site.rooms[room]))
+
+    now=datetime.datetime.now()
+    jobs=[]
+    for url in users:
+        if not url in calendars:
+            calendars[url]=load_cached_calendar(url)
+        calendars[url].setdefault("sites",set()).add(site.name)
+        lu=calendars[url].get("cal_last_update",datetime.datetime(1970,1,1))
+        if (now-lu).total_seconds() > 300.:
+            label=", ".join(user[0] for user in users[url])
+            if not "job" in calendars[url]:
+                log(f'ICAL {label}: Refreshing ical.')
+            jobs.append(calendar_job(calendars[url],lambda url=url,label=label: refresh_calendar(url,label)))
+    if jobs:
+        await asyncio.gather(*jobs)
+    # Calendars which are no longer configured, here or at any other site
+    for url in list(calendars):
+        if not url in users:
+            calendars[url].get("sites",set()).discard(site.name)
+            calendars[url].get("selectors",{}).pop(site.name,None)
+            if not calendars[url].get("sites"):
+                del calendars[url]
+
+    for url in users:
+        for label,user in users[url]:
+            if "cal_last_update" in calendars[url]:
+                user["cal_last_update"] = calendars[url]["cal_last_update"]
+
+class Timeline:
+    # Sorted, compact list of the heat events of a room: parallel lists of start/end (unix time) and title
+    __slots__ = ("starts", "ends", "titles", "max_duration", "version")
+
+    def __init__(self, intervals):
+        intervals=sorted(intervals)
+        # Counts the changes, for the schedule preview cache
+        self.version=0
+        self.starts=[i[0] for i in intervals]
+        self.ends=[i[1] for i in intervals]
+        self.titles=[i[2] for i in intervals]
+        self.max_duration=max((i[1]-i[0] for i in intervals),default=0.)
+
+    def add(self, intervals):
+        self.version+=1
+        for o_start,o_end,title in intervals:
+            i=bisect.bisect_right(self.starts,o_start)
+            self.starts.insert(i,o_start)
+            self.ends.insert(i,o_end)
+            self.titles.insert(i,title)
+            self.max_duration=max(self.max_duration,o_end-o_start)
+
+    def remove(self, intervals):
+        self.version+=1
+        for o_start,o_end,title in intervals:
+            i=bisect.bisect_left(self.starts,o_start)
+            while i < len(self.starts) and self.starts[i]==o_start:
+                if self.ends[i]==o_end and self.titles[i]==title:
+                    del self.starts[i], self.ends[i], self.titles[i]
+                    break
+                i+=1
+
+    def between(self, start, end):
+        # All (start,end,title) overlapping [start,end), sorted by start. Two bisects, no calendar access.
+        lo=bisect.bisect_left(self.starts,start-self.max_duration)
+        hi=bisect.bisect_left(self.starts,end)
+        return [(self.starts[i],self.ends[i],self.titles[i]) for i in range(lo,hi) if self.ends[i] > start]
+
+    def first_after(self, start):
+        # The first (start,end,title) which has not ended at start, or None
+        for i in range(bisect.bisect_left(self.starts,start-self.max_duration),len(self.starts)):
+            if self.ends[i] > start:
+                return (self.starts[i],self.ends[i],self.titles[i])
+        return None
+
+def ical_timestamp(value):
+    # Naive datetimes are floating time and interpreted as local time, like everywhere else in this script
+    return value.timestamp()
+
+def expand_calendar(calendar,start,end):
+    # Expand all recurrences once and reduce each occurrence to (start, end, summary, resources), grouped by UID
+    import recurring_ical_events
+    occurrences=dict()
+    for event in recurring_ical_events.of(calendar, skip_bad_series=True).between(start, end):
+        dtstart=event["DTSTART"].dt
+        if not isinstance(dtstart,datetime.datetime):
+            continue
+        if "DTEND" in event:
+            dtend=event["DTEND"].dt
+        elif "DURATION" in event:
+            dtend=dtstart+event["DURATION"].dt
+        else:
+            dtend=dtstart
+        if "RESOURCES" in event:
+            resources=tuple(element.strip() for element in str(event["RESOURCES"]).split(','))
+        else:
+            resources=None
+        occurrences.setdefault(str(event.get("UID","")),[]).append((ical_timestamp(dtstart),ical_timestamp(dtend),str(event.get("SUMMARY","")),resources))
+    return occurrences
+
+class EventRecord:
+    # What we keep of a VEVENT between refreshes. The raw text is only kept until the event has been expanded.
+    __slots__ = ("uid", "recurrence_id", "sequence", "last_modified", "start", "end", "summary", "resources", "rrule", "raw")
+
+    def __init__(self):
+        self.uid=""
+        self.recurrence_id=""
+        self.sequence=0
+        self.last_modified=None
+        self.start=None
+        self.end=None
+        self.summary=""
+        self.resources=None
+        self.rrule=None
+        self.raw=None
+
+    def fingerprint(self):
+        # Identifies a version of a VEVENT: RECURRENCE-ID, SEQUENCE and LAST-MODIFIED, or its content if it has neither
+        if self.last_modified is not None or self.sequence:
+            return (self.recurrence_id,self.sequence,self.last_modified or "")
+        return (self.recurrence_id,0,hashlib.sha1("".join(line for line in self.raw if not line.startswith("DTSTAMP")).encode()).hexdigest())
+
+def ical_lines(f):
+    # Unfolded content lines of an ics file, read line by line
+    previous=None
+    for line in f:
+        line=line.rstrip("\r\n")
+        if line[:1] in (" ","\t"):
+            if previous is not None:
+                previous+=line[1:]
+            continue
+        if previous is not None:
+            yield previous
+        previous=line
+    if previous is not None:
+        yield previous
+
+def split_property(line):
+    # NAME;PARAMS:VALUE -> (NAME, PARAMS, VALUE); colons inside quoted parameter values are skipped
+    quoted=False
+    for i,c in enumerate(line):
+        if c=='"':
+            quoted=not quoted
+        elif c==':' and not quoted:
+            head,value=line[:i],line[i+1:]
+            name,_,params=head.partition(";")
+            return name.upper(),params,value
+    return line.upper(),"",""
+
+def ical_rough_time(value):
+    # Unix time of an ics DATE or DATE-TIME value, ignoring its time zone (callers allow for a margin of a day).
+    # Returns None for DATE values and anything we cannot read.
+    if len(value) < 15 or value[8] != "T":
+        return None
+    try:
+        return datetime.datetime.strptime(value[:15],"%Y%m%dT%H%M%S").replace(tzinfo=datetime.timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+def scan_calendar_file(filename,window_start,window_end):
+    # Stream through an ics file without building a component tree. Returns the VCALENDAR property lines (such as
+    # X-WR-TIMEZONE, which the expansion uses for floating and UTC times), the VTIMEZONE blocks and the records of
+    # all VEVENTs which can matter between window_start and window_end (unix time): single events which ended
+    # before or start after the window, all-day events and series which ended before it are dropped right away.
+    # Raises ValueError if the file is not a complete VCALENDAR, e.g. an error page served with status 200.
+    margin=86400.
+    properties=[]
+    timezones=[]
+    records=dict()
+    block=None
+    depth=0
+    # Nesting depth of the other components (VTODO, VJOURNAL, ...) outside the blocks we keep
+    other=0
+    calendar_begun=False
+    calendar_ended=False
+    with open(filename,encoding="utf-8",errors="replace",newline="") as f:
+        for line in ical_lines(f):
+            if block is None:
+                if other == 0 and (line=="BEGIN:VEVENT" or line=="BEGIN:VTIMEZONE"):
+                    block=[line]
+                    depth=1
+                    record=EventRecord() if line=="BEGIN:VEVENT" else None
+                    dates={}
+                    continue
+                name=split_property(line)[0]
+                if name=="BEGIN":
+                    if line.upper() == "BEGIN:VCALENDAR":
+                        calendar_begun=True
+                    else:
+                        other+=1
+                elif name=="END":
+                    if other > 0:
+                        other-=1
+                    elif line.upper() == "END:VCALENDAR" and calendar_begun:
+                        calendar_ended=True
+                elif other == 0:
+                    properties.append(line)
+                continue
+            block.append(line)
+            name,params,value=split_property(line)
+            if name=="BEGIN":
+                depth+=1
+                continue
+            if name=="END":
+                depth-=1
+                if depth > 0:
+                    continue
+                if record is None:
+                    timezones.append(block)
+                elif keep_record(record,dates,window_start,window_end,margin):
+                    record.raw=block
+                    records.setdefault(record.uid,[]).append(record)
+                block=None
+                continue
+            if record is None or depth > 1:
+                # Properties of VTIMEZONE and of nested components such as VALARM
+                continue
+            if name=="UID":
+                record.uid=value
+            elif name=="RECURRENCE-ID":
+                record.recurrence_id=value
+                dates["recurrence_id"]=ical_rough_time(value)
+            elif name=="SEQUENCE":
+                try:
+                    record.sequence=int(value)
+                except ValueError:
+                    pass
+            elif name=="LAST-MODIFIED":
+                record.last_modified=value
+            elif name=="DTSTART":
+                dates["start"]=ical_rough_time(value)
+                dates["start_is_date"]="VALUE=DATE" in params.upper() and not "VALUE=DATE-TIME" in params.upper() or len(value)==8
+            elif name=="DTEND":
+                dates["end"]=ical_rough_time(value)
+            elif name=="RRULE" or name=="RDATE":
+                record.rrule=value if name=="RRULE" else (record.rrule or f'RDATE:{value}')
+            elif name=="SUMMARY":
+                record.summary=value
+            elif name=="RESOURCES":
+                record.resources=tuple(element.strip() for element in value.split(','))
+    if not calendar_ended:
+        raise ValueError(f'{"Incomplete calendar" if calendar_begun else "Not a calendar"}: no BEGIN:VCALENDAR ... END:VCALENDAR')
+    return properties,timezones,records
+
+def keep_record(record,dates,window_start,window_end,margin):
+    if dates.get("start_is_date"):
+        # All-day events never trigger heating
+        return False
+    if not record.uid:
+        record.uid=f'nouid-{hashlib.sha1(repr(sorted(dates.items())).encode()+record.summary.encode()).hexdigest()}'
+    start=dates.get("start")
+    end=dates.get("end")
+    if record.rrule is not None:
+        if record.rrule.startswith("RDATE:"):
+            return True
+        until=[part.partition("=")[2] for part in record.rrule.split(";") if part.upper().startswith("UNTIL=")]
+        if until:
+            until=ical_rough_time(until[0]) if len(until[0]) > 8 else ical_rough_time(until[0]+"T235959")
+            if until is not None and until+margin < window_start:
+                return False
+        return start is None or start-margin < window_end
+    if start is None:
+        return True
+    if end is None:
+        end=start+margin
+    if record.recurrence_id:
+        # A moved instance is needed if either its new or its original time is in the window
+        original=dates.get("recurrence_id") or start
+        return (end+margin >= window_start and start-margin < window_end) or (original+margin >= window_start and original-margin < window_end)
+    return end+margin >= window_start and start-margin < window_end
+
+def expand_records(properties,timezones,records,uids,start,end):
+    # Expand the given series from their raw text, in a calendar which has the properties and time zones of the original one
+    import icalendar
+    lines=["BEGIN:VCALENDAR"]+properties
+    names=set(split_property(line)[0] for line in properties)
+    if not "VERSION" in names:
+        lines.append("VERSION:2.0")
+    if not "PRODID" in names:
+        lines.append("PRODID:-//ical_homematic//EN")
+    for block in timezones:
+        lines+=block
+    for uid in uids:
+        for record in records[uid]:
+            lines+=record.raw
+    lines.append("END:VCALENDAR")
+    calendar=icalendar.Calendar.from_ical("\r\n".join(lines))
+    return expand_calendar(calendar,start,end)
+
+def ingest_calendar(filename,start,end,old_fingerprints):
+    # Scan a calendar file and expand what changed since old_fingerprints (None: everything) between start and end.
+    # Returns (fingerprints, records, occurrences of the expanded series, changed uids, removed uids).
+    properties,timezones,records=scan_calendar_file(filename,start.timestamp(),end.timestamp())
+    fingerprints={uid: tuple(sorted(record.fingerprint() for record in series)) for uid,series in records.items()}
+    if old_fingerprints is None:
+        changed=set(fingerprints)
+        removed=set()
     else:
+        changed=set(uid for uid in fingerprints if old_fingerprints.get(uid) != fingerprints[uid])
+        removed=set(old_fingerprints)-set(fingerprints)
+    occurrences=expand_records(properties,timezones,records,changed,start,end) if changed else {}
+    for series in records.values():
+        for record in series:
+            record.raw=None
+    for uid,series_occurrences in occurrences.items():
+        # Single events: keep their exact time for introspection
+        if len(records.get(uid,())) == 1 and records[uid][0].rrule is None and len(series_occurrences) == 1:
+            records[uid][0].start,records[uid][0].end=series_occurrences[0][0],series_occurrences[0][1]
+    return fingerprints,records,occurrences,changed,removed
+
+def room_selector(room):
+    # Rooms with the same keyword, resource and veto resource get the same heat events
+    config=site.room_configs[room]
+    return (config.summary_keyword,config.ical_resource,config.veto_resource)
+
+def selector_index(selectors):
+    # Inverted index from keyword and resource to the selectors asking for them
+    by_keyword=dict()
+    by_resource=dict()
+    for selector in selectors:
+        keyword,resource,veto=selector
+        if keyword is not None:
+            by_keyword.setdefault(keyword,[]).append(selector)
+        if resource is not None:
+            by_resource.setdefault(resource,[]).append(selector)
+    return by_keyword,by_resource
+
+def classify_occurrences(occurrences,index):
+    # Classify occurrences in one pass into heat event intervals per selector. Instead of testing every
+    # occurrence against every room, resources and keywords of an occurrence are looked up in an inverted index.
+    by_keyword,by_resource=index
+    intervals=dict()
+    for o_start,o_end,summary,resources in occurrences:
+        matched=set()
+        for keyword in by_keyword:
+            if keyword in summary:
+                matched.update(by_keyword[keyword])
+        if resources is not None:
+            for resource in resources:
+                for selector in by_resource.get(resource,()):
+                    veto=selector[2]
+                    if veto != "" and veto in resources:
+                        if site.log_level >= 1:
+                            log(f'DEBUG {resource}: Event {summary} (from {datetime.datetime.fromtimestamp(o_start)} to {datetime.datetime.fromtimestamp(o_end)}) skipped because of veto resource {veto}',1)
+                    else:
+                        matched.add(selector)
+        for selector in matched:
+            intervals.setdefault(selector,[]).append((o_start,o_end,summary))
+    return intervals
+
+# Worker processes for calendar parsing and recurrence expansion. These are pure-Python CPU work which would
+# otherwise stall the event loop serving the HmIP websocket and the watchdog, and use only one core. Calendars rarely
+# change, so the pool is shut down when it has been idle for calendar_pool_idle seconds and started again when needed.
+calendar_pool=None
+calendar_pool_jobs=0
+calendar_pool_timer=None
+
+def get_calendar_pool():
+    # The pool for one job, which is to be handed back with release_calendar_pool(); None if jobs run in a thread
+    global calendar_pool
+    global calendar_pool_jobs
+    global calendar_pool_timer
+    # By default one worker per CPU, but never more than there are calendars to parse
+    workers=min(main_site.global_config.get("calendar_workers",os.cpu_count() or 1),max(1,len(calendars)))
+    if workers < 1:
+        return None
+    if calendar_pool_timer is not None:
+        calendar_pool_timer.cancel()
+        calendar_pool_timer=None
+    if calendar_pool is None:
+        # spawn instead of fork: we have threads (logging, HTTP) which a forked child must not inherit
+        calendar_pool=concurrent.futures.ProcessPoolExecutor(max_workers=workers,mp_context=multiprocessing.get_context("spawn"))
+    calendar_pool_jobs+=1
+    return calendar_pool
+
+def release_calendar_pool():
+    global calendar_pool_jobs
+    global calendar_pool_timer
+    calendar_pool_jobs-=1
+    if calendar_pool_jobs == 0 and calendar_pool is not None:
+        calendar_pool_timer=asyncio.get_running_loop().call_later(main_site.global_config.get("calendar_pool_idle",300),stop_calendar_pool)
+
+def stop_calendar_pool():
+    global calendar_pool
+    global calendar_pool_timer
+    if calendar_pool_timer is not None:
+        calendar_pool_timer.cancel()
+        calendar_pool_timer=None
+    if calendar_pool is not None:
+        calendar_pool.shutdown(wait=False,cancel_futures=True)
+        calendar_pool=None
+        if site.log_level >= 1:
+            log('INFO: Stopped the calendar workers.',1)
+
+atexit.register(stop_calendar_pool)
+
+async def run_in_calendar_pool(fn,*args):
+    # Run fn in a worker process; with calendar_workers: 0 or a broken pool, in a thread of this process
+    pool=get_calendar_pool()
+    if pool is not None:
         try:
-            tmpcal = icalendar.Calendar.from_ical(ical_string)
-        except:
-            error_msg(f'Could not convert calendar file to icalendar for {label}',2)
+            return await asyncio.get_running_loop().run_in_executor(pool,fn,*args)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            log(f'ERROR: Calendar worker pool broke ({e}), restarting it.')
+            stop_calendar_pool()
+        finally:
+            release_calendar_pool()
+    return await asyncio.to_thread(fn,*args)
+
+async def ingest_calendar_file(url,entry,filename,full=False):
+    # Bring the records and expanded occurrences of a calendar up to date from filename. Only series which were
+    # added, changed (by RECURRENCE-ID, SEQUENCE, LAST-MODIFIED) or removed since the last ingest are expanded,
+    # except when the expanded horizon runs out. The pending change is picked up by update_timelines().
+    now=datetime.datetime.now(datetime.timezone.utc)
+    # A week by default, as far as the schedule preview looks ahead
+    horizon=max(site.global_config.get("timeline_horizon",7*24),2*lookahead,profile_horizon())
+    if entry.get("expanded_until") is None or entry["expanded_until"] <= now+datetime.timedelta(hours=lookahead):
+        full=True
+    end=now+datetime.timedelta(hours=horizon) if full else entry["expanded_until"]
+    fingerprints,records,occurrences,changed,removed=await run_in_calendar_pool(ingest_calendar,filename,now,end,None if full else entry["fingerprints"])
+    if full:
+        removed=set(entry.get("fingerprints",{}))-set(fingerprints)
+        entry["occurrences"]=occurrences
+    else:
+        for uid in removed|changed:
+            entry["occurrences"].pop(uid,None)
+        entry["occurrences"].update(occurrences)
+    entry["expanded_until"]=end
+    entry["fingerprints"]=fingerprints
+    entry["records"]=records
+    pending=entry.get("pending")
+    if pending is None:
+        entry["pending"]=(full,changed,removed)
+    else:
+        entry["pending"]=(pending[0] or full,pending[1]|changed,pending[2]|removed)
+    if site.log_level >= 1:
+        log(f'ICAL: {"Expanded" if full else "Updated"} {url}: {len(records)} series kept, {len(changed)} expanded, {len(removed)} removed, {sum(len(o) for o in entry["occurrences"].values())} events until {end}.',1)
+
+async def expand_calendar_horizon(url,entry):
+    try:
+        await ingest_calendar_file(url,entry,calendar_cache_file(url,".ics"),full=True)
+    except Exception as e:
+        log(f'ERROR: Unable to expand calendar {url}: {e}')
+        error_msg(f'Unable to get events within the timeline horizon for calendar {url}.',1)
+
+async def update_timelines():
+    # Roll the expanded horizon forward where it runs out and update the timelines of the rooms using a changed calendar
+    now=datetime.datetime.now(datetime.timezone.utc)
+    jobs=[]
+    for url,entry in calendars.items():
+        if entry.get("expanded_until") is None or entry["expanded_until"] <= now+datetime.timedelta(hours=lookahead):
+            if os.path.exists(calendar_cache_file(url,".ics")):
+                jobs.append(calendar_job(entry,lambda url=url,entry=entry: expand_calendar_horizon(url,entry)))
+    if jobs:
+        # Separate calendars are expanded in parallel worker processes
+        await asyncio.gather(*jobs)
+    users=dict()
+    for room in site.rooms:
+        url=site.room_configs[room].calendar_url
+        if url is None:
+            continue
+        if "occurrences" in calendars.get(url,{}):
+            users.setdefault(url,[]).append(room)
+
+    # A change is left pending for a site using the calendar if this one does not
+    updates=dict()
+    for url in users:
+        if calendars[url].get("pending") is not None:
+            updates[url]=calendars[url].pop("pending")
+
+    for url in users:
+        entry=calendars[url]
+        # The timelines of a calendar are kept for the rooms of all sites using it, so that whichever site picks
+        # up a change patches them for all
+        entry.setdefault("selectors",{})[site.name]=set(room_selector(room) for room in users[url])
+        selectors=set().union(*entry["selectors"].values())
+        index=selector_index(selectors)
+        if not selectors <= entry.get("timelines",{}).keys() or (url in updates and updates[url][0]):
+            # Classify everything: new rooms or a full expansion
+            entry["classified"]={uid: classify_occurrences(occurrences,index) for uid,occurrences in entry["occurrences"].items()}
+            intervals={selector: [] for selector in selectors}
+            for classified in entry["classified"].values():
+                for selector,selector_intervals in classified.items():
+                    intervals[selector]+=selector_intervals
+            entry["timelines"]={selector: Timeline(intervals[selector]) for selector in selectors}
+        elif url in updates:
+            # Classify only what changed and patch the timelines
+            full,changed,removed=updates[url]
+            for uid in changed|removed:
+                for selector,selector_intervals in entry["classified"].pop(uid,{}).items():
+                    entry["timelines"][selector].remove(selector_intervals)
+            for uid in changed:
+                if uid in entry["occurrences"]:
+                    entry["classified"][uid]=classify_occurrences(entry["occurrences"][uid],index)
+                    for selector,selector_intervals in entry["classified"][uid].items():
+                        entry["timelines"][selector].add(selector_intervals)
+        for room in users[url]:
+            site.rooms[room]["timeline"]=entry["timelines"][room_selector(room)]
+
+# InfluxDB write pipeline: points of a cycle are collected here and written in one batch by influx_writer().
+# Points which cannot be written are spooled to disk and retried later.
+influx_queue=[]
+influx_stats={"queued": 0, "written": 0, "dropped": 0, "spooled": 0}
+influx_spool_filename="influx_spool.jsonl"
+
+def influx_write(series):
+    # Queue points for the background writer; never blocks
+    for point in series:
+        if isinstance(point.get("time"),datetime.datetime):
+            point["time"]=point["time"].isoformat()
+        influx_queue.append(point)
+    influx_stats["queued"]+=len(series)
+
+# The spool is a file of JSON lines, one failed batch per line, which is only ever appended to. influx_spool_batches
+# indexes the batches which have not been written yet as (offset, length, points), oldest first. Written and dropped
+# batches are skipped by moving the read offset, which is kept in a small file next to the spool, and the spool is
+# compacted once they make up most of it.
+influx_spool_batches=collections.deque()
+influx_spool_size=0
+influx_spool_skipped=0
+
+def influx_spool_offset_filename():
+    return f'{influx_spool_filename}.offset'
+
+def store_influx_spool_offset():
+    write_file_atomic(influx_spool_offset_filename(),str(influx_spool_batches[0][0] if influx_spool_batches else influx_spool_size).encode())
+
+def scan_influx_spool():
+    # Index the spool file once at startup, from the stored read offset on. A last line without newline is the
+    # remainder of an interrupted write.
+    global influx_spool_size
+    global influx_spool_skipped
+    influx_spool_batches.clear()
+    influx_spool_size=0
+    influx_spool_skipped=0
+    try:
+        with open(influx_spool_offset_filename()) as f:
+            start=int(f.read())
+    except (OSError,ValueError):
+        start=0
+    try:
+        with open(influx_spool_filename,"rb+") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    f.truncate(influx_spool_size)
+                    break
+                if influx_spool_size >= start:
+                    try:
+                        influx_spool_batches.append((influx_spool_size,len(line),len(json.loads(line))))
+                    except ValueError:
+                        log(f'ERROR: Skipping unreadable batch in {influx_spool_filename}.')
+                influx_spool_size+=len(line)
+    except FileNotFoundError:
+        pass
+    influx_stats["spooled"]=sum(points for offset,length,points in influx_spool_batches)
+    limit_influx_spool()
+
+def limit_influx_spool():
+    # Drop the oldest batches beyond influx_spool_max points
+    limit=main_site.global_config.get("influx_spool_max",100000)
+    if influx_stats["spooled"] <= limit:
+        return
+    while influx_stats["spooled"] > limit and influx_spool_batches:
+        influx_stats["dropped"]+=skip_influx_spool_batch()
+    store_influx_spool_offset()
+    compact_influx_spool()
+
+def spool_influx_points(points):
+    # Append a failed batch to the spool
+    global influx_spool_size
+    line=(json.dumps(points)+"\n").encode()
+    with open(influx_spool_filename,"ab") as f:
+        f.write(line)
+    influx_spool_batches.append((influx_spool_size,len(line),len(points)))
+    influx_spool_size+=len(line)
+    influx_stats["spooled"]+=len(points)
+    limit_influx_spool()
+
+def peek_influx_spool():
+    # Oldest spooled batch, or None. It stays in the spool until done_influx_spool_batch() is called.
+    while influx_spool_batches:
+        offset,length,points=influx_spool_batches[0]
+        with open(influx_spool_filename,"rb") as f:
+            f.seek(offset)
+            line=f.read(length)
+        try:
+            return json.loads(line)
+        except ValueError:
+            log(f'ERROR: Skipping unreadable batch in {influx_spool_filename}.')
+            influx_stats["dropped"]+=skip_influx_spool_batch()
+    return None
+
+def skip_influx_spool_batch():
+    # Skip the oldest batch. Returns its number of points.
+    global influx_spool_skipped
+    offset,length,points=influx_spool_batches.popleft()
+    influx_stats["spooled"]-=points
+    influx_spool_skipped+=1
+    return points
+
+def done_influx_spool_batch():
+    # The batch returned by peek_influx_spool() has been written
+    skip_influx_spool_batch()
+    store_influx_spool_offset()
+    compact_influx_spool()
+
+def compact_influx_spool():
+    # Remove the spool once it is empty. Before that, rewrite it without the skipped batches when at least
+    # influx_spool_compact batches were skipped since the last compaction and they take up more than half
+    # of the file, so that every point is copied a bounded number of times.
+    global influx_spool_size
+    global influx_spool_skipped
+    if not influx_spool_batches:
+        # The offset goes first: if we stop in between, a leftover spool is written again, but nothing is lost
+        for filename in (influx_spool_offset_filename(),influx_spool_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+        influx_spool_size=0
+        influx_spool_skipped=0
+        return
+    start=influx_spool_batches[0][0]
+    if influx_spool_skipped < main_site.global_config.get("influx_spool_compact",100) or start < influx_spool_size-start:
+        return
+    with open(influx_spool_filename,"rb") as f:
+        f.seek(start)
+        data=f.read()
+    write_file_atomic(influx_spool_offset_filename(),b"0")
+    write_file_atomic(influx_spool_filename,data)
+    for i in range(len(influx_spool_batches)):
+        offset,length,points=influx_spool_batches[i]
+        influx_spool_batches[i]=(offset-start,length,points)
+    influx_spool_size-=start
+    influx_spool_skipped=0
+
+async def influx_writer():
+    # Background task: writes the queued points (and afterwards anything spooled) with exponential backoff on errors
+    await asyncio.to_thread(scan_influx_spool)
+    backoff=1.
+    while True:
+        await influx_flush.wait()
+        influx_flush.clear()
+        while influx_queue or influx_stats["spooled"]:
+            if influx_queue:
+                batch=influx_queue[:]
+                influx_queue.clear()
+                from_spool=False
+            else:
+                batch=await asyncio.to_thread(peek_influx_spool)
+                if batch is None:
+                    break
+                from_spool=True
+            try:
+                t0=time.perf_counter()
+                await asyncio.to_thread(influx.write_points,batch)
+                influx_stats["last_write_s"]=time.perf_counter()-t0
+            except Exception as e:
+                log(f'ERROR: Writing {len(batch)} points to influxdb failed: {e}')
+                error_msg("Write to influxdb failed.",1)
+                if not from_spool:
+                    await asyncio.to_thread(spool_influx_points,batch)
+                await asyncio.sleep(backoff)
+                backoff=min(backoff*2.,site.global_config.get("influx_max_backoff",300.))
+                if not from_spool:
+                    break
+                continue
+            if from_spool:
+                await asyncio.to_thread(done_influx_spool_batch)
+            influx_stats["written"]+=len(batch)
+            backoff=1.
+            if site.log_level >= 1:
+                log(f'DEBUG: Wrote {len(batch)} points to influxdb{" from spool" if from_spool else ""}.',1)
+
+# Learned ramp rates: while a room heats up, its temperature is sampled every ramp_sample_interval seconds into a ring
+# buffer of (gap, rate) pairs, gap being the room temperature minus the outside temperature (or minus the room's low
+# temperature if the home reports no weather). rate=intercept+slope*gap is fitted for all rooms in one pass and used
+# instead of the configured ramp once a room has ramp_min_samples samples.
+
+def outside_temperature():
+    weather=getattr(site.home,"weather",None)
+    return number_or_nan(getattr(weather,"temperature",None))
+
+def ramp_reference(config,outside):
+    return config.low if math.isnan(outside) else outside
+
+def record_ramp_samples(states,now):
+    # Called by the sweep: a sample is taken when a room has been heating (set point at least 0.5 K above the room
+    # temperature, with the same set point) for ramp_sample_interval seconds since its last sample
+    interval=site.global_config.get("ramp_sample_interval",900.)
+    outside=outside_temperature()
+    for room,state in states.items():
+        config=site.room_configs[room]
+        actual=number_or_nan(state.get("actualTemperature"))
+        setpoint=number_or_nan(state.get("setPointTemperature"))
+        if not config.learn_ramp or config.heating_switches is not None or not state.get("thermostats") or not setpoint-actual >= 0.5:
+            site.ramp_intervals.pop(room,None)
+            continue
+        start=site.ramp_intervals.get(room)
+        if start is None or start[2] != setpoint or now-start[0] > 3*interval:
+            site.ramp_intervals[room]=(now,actual,setpoint)
+            continue
+        if now-start[0] < interval:
+            continue
+        if not room in site.ramp_samples:
+            site.ramp_samples[room]=collections.deque(maxlen=site.global_config.get("ramp_samples",500))
+        site.ramp_samples[room].append(((start[1]+actual)/2.-ramp_reference(config,outside),(actual-start[1])*3600./(now-start[0])))
+        site.ramp_intervals[room]=(now,actual,setpoint)
+
+def fit_ramp_models():
+    # Least-squares fit of rate=intercept+slope*gap for all rooms with enough samples at once. A room loses more
+    # heat at a larger gap, never less, so a positive slope is noise and the mean rate is used instead.
+    import numpy
+    min_samples=site.global_config.get("ramp_min_samples",20)
+    fit_rooms=[room for room,samples in site.ramp_samples.items() if len(samples) >= max(min_samples,1)]
+    site.ramp_models.clear()
+    if not fit_rooms:
+        return
+    data=numpy.full((len(fit_rooms),max(len(site.ramp_samples[room]) for room in fit_rooms),2),numpy.nan)
+    for i,room in enumerate(fit_rooms):
+        data[i,:len(site.ramp_samples[room])]=site.ramp_samples[room]
+    valid=numpy.isfinite(data).all(axis=2)
+    gap=numpy.where(valid,data[:,:,0],0.)
+    rate=numpy.where(valid,data[:,:,1],0.)
+    n=valid.sum(axis=1)
+    mean_gap=gap.sum(axis=1)/n
+    mean_rate=rate.sum(axis=1)/n
+    dgap=numpy.where(valid,gap-mean_gap[:,None],0.)
+    variance=(dgap*dgap).sum(axis=1)
+    slope=numpy.where(variance > 1e-6*n,(dgap*(rate-mean_rate[:,None])).sum(axis=1)/numpy.maximum(variance,1e-12),0.)
+    slope=numpy.minimum(slope,0.)
+    intercept=mean_rate-slope*mean_gap
+    for i,room in enumerate(fit_rooms):
+        site.ramp_models[room]=(float(intercept[i]),float(slope[i]),int(n[i]))
+        if site.log_level >= 1:
+            log(f'DEBUG {room}: Learned ramp {intercept[i]:.2f}{slope[i]:+.3f}*gap K/h from {n[i]} samples (configured: {site.room_configs[room].ramp} K/h).',1)
+
+def ramp_coefficients(room,outside):
+    # (intercept, slope, reference temperature) of the learned ramp of a room, or NaNs if it has none
+    config=site.room_configs[room]
+    model=site.ramp_models.get(room)
+    if model is None or not config.learn_ramp:
+        return (math.nan,math.nan,math.nan)
+    return (model[0],model[1],ramp_reference(config,outside))
+
+def learned_ramps(room_list,ramp,start,target):
+    # Heat-up rates in K/h of the rooms from start to target temperature (arrays by room): the learned rate at the
+    # mean gap, limited to ramp_min..ramp_max, or the configured ramp where there is no learned one
+    import numpy
+    outside=outside_temperature()
+    coefficients=numpy.array([ramp_coefficients(room,outside) for room in room_list],dtype=float).reshape(-1,3)
+    learned=coefficients[:,0]+coefficients[:,1]*((start+target)/2.-coefficients[:,2])
+    learned=numpy.clip(learned,site.global_config.get("ramp_min",0.2),site.global_config.get("ramp_max",6.))
+    return numpy.where(numpy.isfinite(learned),learned,ramp)
+
+def room_ramp(room,start,target):
+    # learned_ramps() for a single room
+    intercept,slope,reference=ramp_coefficients(room,outside_temperature())
+    if math.isnan(intercept):
+        return site.room_configs[room].ramp
+    return min(max(intercept+slope*((start+target)/2.-reference),site.global_config.get("ramp_min",0.2)),site.global_config.get("ramp_max",6.))
+
+def ramp_state():
+    return {"saved": time.time(), "rooms": {room: {"samples": [list(sample) for sample in samples], "model": site.ramp_models.get(room)} for room,samples in site.ramp_samples.items()}}
+
+async def update_ramp_models(states,now):
+    # Record this sweep's samples; refit and save the models every ramp_fit_interval seconds
+    record_ramp_samples(states,now)
+    if site.ramp_fitted is not None and now-site.ramp_fitted < site.global_config.get("ramp_fit_interval",3600.):
+        return
+    site.ramp_fitted=now
+    fit_ramp_models()
+    try:
+        await asyncio.to_thread(write_file_atomic,site.ramp_filename,json.dumps(ramp_state()).encode())
+    except Exception as e:
+        log(f'ERROR: Could not write ramp models to {site.ramp_filename}: {e}')
+
+def restore_ramp_models():
+    # The samples of the last run; the models are refitted from them on the next sweep
+    try:
+        with open(site.ramp_filename) as f:
+            state=json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        log(f'ERROR: Could not read ramp models from {site.ramp_filename}: {e}')
+        return
+    for room,saved in state.get("rooms",{}).items():
+        if room in site.rooms:
+            site.ramp_samples[room]=collections.deque((tuple(sample) for sample in saved["samples"]),maxlen=site.global_config.get("ramp_samples",500))
+    if site.log_level >= 1:
+        log(f'INFO: Restored ramp samples of {len(site.ramp_samples)} rooms from {site.ramp_filename}.',1)
+
+def control_kernel(params,state,now,hour):
+    # Control decisions for a batch of rooms in one pass, without side effects. params and state are dicts of
+    # equally long NumPy arrays, one element per room; NaN stands for "not configured" or "not known".
+    #   params: high, low, lown, ramp, boost_threshold, night_start, night_end, switches, profile (bool)
+    #   state:  setpoint, actual, boost_duration (min), boost_last_set (unix time), in_event, night_mode (bool),
+    #           first_start, second_start (unix time of the first two events within the lookahead)
+    # Returns a dict of arrays: the flanks and actions which fired, the new in_event and night_mode flags, and
+    # setpoint, the set point to desire (NaN: none; always for rooms run by a heating profile). Comparisons with
+    # NaN are false, so unknown values never act.
+    import numpy
+    high=params["high"]
+    low=params["low"]
+    setpoint=state["setpoint"]
+    actual=state["actual"]
+    in_event=state["in_event"]
+    night_mode=state["night_mode"]
+    first_start=state["first_start"]
+    has_events=numpy.isfinite(first_start)
+    started=first_start-now < 0
+    should_be_in_event=has_events & started
+    # In the event, ramp towards the next one if it is already in sight; before the event, towards this one
+    should_be_ramping=has_events & (~started | numpy.isfinite(state["second_start"]))
+    timetohot=numpy.where(started,state["second_start"],first_start)-now
+
+    numeric_setpoint=numpy.isfinite(setpoint)
+    begin=should_be_in_event & ~in_event
+    begin_set_high=begin & numeric_setpoint & (setpoint+0.1 < high)
+    end=~should_be_in_event & in_event
+    new_in_event=(in_event | (begin & numeric_setpoint)) & ~end
+
+    # Rooms with heating switches are not ramped, boosted or reduced over night
+    thermostats_only=~params["switches"]
+    ramp_high=thermostats_only & should_be_ramping & (actual < high-timetohot*params["ramp"]/3600.) & (setpoint < high)
+    boost=thermostats_only & (setpoint-actual > params["boost_threshold"]) & (now-state["boost_last_set"] > state["boost_duration"]*60.)
+
+    night_start=params["night_start"]
+    night_end=params["night_end"]
+    night_configured=thermostats_only & numpy.isfinite(night_start) & numpy.isfinite(night_end)
+    should_be_in_night_mode=night_configured & numpy.where(night_start > night_end,
+                                                           (hour >= night_start) | (hour < night_end),
+                                                           (hour >= night_start) & (hour < night_end))
+    night_on=should_be_in_night_mode & ~night_mode
+    night_off=night_configured & night_mode & ~should_be_in_night_mode
+    night_set_lown=night_on & ~(new_in_event | should_be_ramping)
+    night_set_low=night_off & (setpoint < low)
+    new_night_mode=(night_mode | night_on) & ~night_off
+
+    # Later decisions override earlier ones, in the order in which the scalar control logic issued them
+    target=numpy.full(setpoint.shape,numpy.nan)
+    target=numpy.where(begin_set_high,high,target)
+    target=numpy.where(end,low,target)
+    target=numpy.where(ramp_high,high,target)
+    target=numpy.where(night_set_lown,params["lown"],target)
+    target=numpy.where(night_set_low,low,target)
+    target=numpy.where(params["profile"],numpy.nan,target)
+    return {"begin": begin, "begin_set_high": begin_set_high, "begin_without_setpoint": begin & ~numeric_setpoint, "end": end,
+            "ramp_high": ramp_high, "timetohot": timetohot, "boost": boost, "night_on": night_on, "night_off": night_off,
+            "night_set_lown": night_set_lown, "night_set_low": night_set_low,
+            "in_event": new_in_event, "night_mode": new_night_mode, "setpoint": target}
+
+def number_or_nan(value):
+    return float(value) if isinstance(value,numbers.Number) and not isinstance(value,bool) else math.nan
+
+def evaluate_rooms(room_list,states,start_date,start_date_local):
+    # Collect parameters and state of the given rooms, run the control kernel once for all of them and return
+    # the decisions by room. Rooms without thermostats or calendar are only logged.
+    import numpy
+    t0=time.perf_counter()
+    start_ts=start_date.timestamp()
+    evaluated=[]
+    params={key: [] for key in ("high","low","lown","ramp","boost_threshold","night_start","night_end","switches","profile")}
+    state={key: [] for key in ("setpoint","actual","boost_duration","boost_last_set","in_event","night_mode","first_start","second_start")}
+    for room in room_list:
+        # Stop processing this room in case we only follow it for logging purposes
+        if not "thermostats" in states[room]:
+            if site.log_level >= 1:
+                log(f'DEBUG {room}: No thermostats available for this room, continuing with next room after logging.',1)
+            continue
+        if not "timeline" in site.rooms[room]:
+            if site.log_level >= 1:
+                log(f'DEBUG {room}: No calendar available for this room, continuing with next room.',1)
+            continue
+        heatevents=site.rooms[room]["timeline"].between(start_ts,start_ts+lookahead*3600.)
+        if site.log_level >= 1:
+            for event in heatevents:
+                log(f'DEBUG {room}: Event {event[2]} (from {datetime.datetime.fromtimestamp(event[0])} to {datetime.datetime.fromtimestamp(event[1])}) ahead!',1)
+        if heatevents:
+            site.rooms[room]["event_title"] = heatevents[0][2]
+        evaluated.append(room)
+        config=site.room_configs[room]
+        params["high"].append(config.high)
+        params["low"].append(config.low)
+        params["lown"].append(config.lown)
+        params["ramp"].append(config.ramp)
+        params["boost_threshold"].append(numpy.nan if config.boost_threshold is None else config.boost_threshold)
+        params["night_start"].append(numpy.nan if config.night_start is None else config.night_start)
+        params["night_end"].append(numpy.nan if config.night_end is None else config.night_end)
+        params["switches"].append(config.heating_switches is not None)
+        params["profile"].append(config.heating_profile is not None)
+        room_state=states[room]
+        state["setpoint"].append(number_or_nan(room_state.get("setPointTemperature")))
+        state["actual"].append(number_or_nan(room_state.get("actualTemperature")))
+        state["boost_duration"].append(number_or_nan(room_state.get("boostDuration")))
+        state["boost_last_set"].append(site.rooms[room]["boostLastSet"].timestamp())
+        state["in_event"].append(site.rooms[room]["in_event"])
+        state["night_mode"].append(site.rooms[room]["night_mode"])
+        state["first_start"].append(heatevents[0][0] if heatevents else numpy.nan)
+        state["second_start"].append(heatevents[1][0] if len(heatevents) >= 2 else numpy.nan)
+    if not evaluated:
+        return {}
+    params={key: numpy.array(value,dtype=bool if key in ("switches","profile") else float) for key,value in params.items()}
+    state={key: numpy.array(value,dtype=bool if key in ("in_event","night_mode") else float) for key,value in state.items()}
+    params["ramp"]=learned_ramps(evaluated,params["ramp"],state["actual"],params["high"])
+    decisions=control_kernel(params,state,start_ts,start_date_local.hour)
+    decisions={key: value.tolist() for key,value in decisions.items()}
+    # Every room of the batch is charged an equal share of its time; control_room() adds applying the decision
+    share=(time.perf_counter()-t0)/len(evaluated)
+    for room in evaluated:
+        site.room_perf[room]=share
+    return {room: {key: value[i] for key,value in decisions.items()} for i,room in enumerate(evaluated)}
+
+def apply_decision(room,state,decision,start_date):
+    # Log the decision of the control kernel for one room and record it in the desired-state ledger
+    title=site.rooms[room].get("event_title")
+    config=site.room_configs[room]
+    # Set points of rooms with a heating profile are run by the thermostats
+    by_profile=config.heating_profile is not None
+    if decision["begin"]:
+        log(f'BEGIN {room}: {title}')
+        if decision["begin_without_setpoint"]:
+            log(f'WARNING {room}: setPointTemperature is not numeric!')
+        elif by_profile:
+            if site.log_level >= 1:
+                log(f'DEBUG {room}: Temperature is set by heating profile {config.heating_profile} (Reason: {title}).',1)
+        elif decision["begin_set_high"]:
+            log(f'ACTION {room}: Setting temperature to {config.high}°C (Reason: {title}).')
+        else:
+            log(f'ACTION {room}: No need to set temperature to {config.high}°C; it is already at {state["setPointTemperature"]}°C (Reason: {title}).')
+        if not decision["begin_without_setpoint"] and config.heating_switches is not None:
+            for switch in config.heating_switches:
+                log(f'ACTION {room}: Setting switch {switch} to on. (Reason: {title})')
+                desire(room,("switch",switch),True)
+    if decision["end"]:
+        log(f'END {room}: {title}')
+        if not by_profile:
+            log(f'ACTION {room}: Setting temperature to {config.low}°C. (Reason: {title})')
+        if config.heating_switches is not None:
+            for switch in config.heating_switches:
+                log(f'ACTION {room}: Setting switch {switch} to off. (Reason: {title})')
+                desire(room,("switch",switch),False)
+    site.rooms[room]["in_event"]=decision["in_event"]
+    if decision["ramp_high"] and not by_profile:
+        log(f'ACTION {room}: Setting temperature to {config.high}°C at {decision["timetohot"]} seconds from next event (Reason: {title}).')
+    if decision["boost"]:
+        log(f'ACTION {room}: Setting {state["boostDuration"]} minutes boost mode because set point {state["setPointTemperature"]}°C is more than {config.boost_threshold}K above the room temperature {state["actualTemperature"]}°C.')
+        desire(room,"boost",True)
+        site.rooms[room]["boostLastSet"]=start_date
+    if decision["night_set_lown"] and not by_profile:
+        log(f'ACTION {room}: Setting to reduced base temperature of {config.lown}°C over night.')
+    elif decision["night_on"]:
+        if site.log_level >= 1:
+            log(f'DEBUG {room}: night mode begins, no reduction during an event or its ramp.',1)
+    if decision["night_set_low"] and not by_profile:
+        log(f'ACTION {room}: Setting to base temperature of {config.low}°C.')
+    elif decision["night_off"]:
+        if site.log_level >= 1:
+            log(f'DEBUG {room}: night mode ends.',1)
+    site.rooms[room]["night_mode"]=decision["night_mode"]
+    if not math.isnan(decision["setpoint"]):
+        desire(room,"setpoint",decision["setpoint"])
+
+# On-device heating profiles: rooms with heating_profile set get their upcoming heat events, ramp lead times and
+# night reduction compiled into the weekly profile of their HEATING group, which then runs on the thermostats.
+
+def profile_hhmm(minute):
+    return f'{minute//60:02d}:{minute%60:02d}'
+
+def profile_slot(t,date,resolution,ceil=False):
+    # Slot of unix time t in the profile of date. Profiles run on wall-clock time, so on the days on which daylight
+    # saving time begins or ends, slots are not a fixed number of seconds after midnight.
+    local=datetime.datetime.fromtimestamp(t)
+    minutes=(local.date()-date).days*1440+local.hour*60+local.minute+(local.second+local.microsecond/1e6)/60.
+    return int(math.ceil(minutes/resolution)) if ceil else int(math.floor(minutes/resolution))
+
+def compile_heating_profile(timeline,config,now_local,resolution=15,max_periods=6,ramp=None):
+    # Weekly profile for the seven days starting today: for every weekday (0 is Monday) the base value and the
+    # periods (start minute, end minute, value) which differ from it. Heat events start earlier by the time the
+    # room needs to heat up from the temperature before the event, at ramp(temperature before) K/h if given and
+    # else at the configured ramp rate.
+    slots_per_day=1440//resolution
+    plan=[None]*7
+    for day in range(7):
+        date=now_local.date()+datetime.timedelta(days=day)
+        day_start=datetime.datetime.combine(date,datetime.time()).timestamp()
+        slots=[config.low]*slots_per_day
+        if config.night_start is not None:
+            for i in range(slots_per_day):
+                hour=i*resolution/60.
+                if config.night_start > config.night_end:
+                    night=hour >= config.night_start or hour < config.night_end
+                else:
+                    night=hour >= config.night_start and hour < config.night_end
+                if night:
+                    slots[i]=config.lown
+        base_slots=list(slots)
+        events=timeline.between(day_start-86400.,day_start+2*86400.) if timeline is not None else []
+        for ev_start,ev_end,title in events:
+            i=profile_slot(ev_start,date,resolution)
+            before=base_slots[i] if 0 <= i < slots_per_day else config.low
+            rate=ramp(before) if ramp is not None else config.ramp
+            lead=(config.high-before)*3600./rate if rate > 0 and config.high > before else 0.
+            # The lead is rounded to whole slots, so that a lead of a few seconds does not cost a slot
+            lead=round(lead/(resolution*60.))*resolution*60.
+            first=max(0,profile_slot(ev_start-lead,date,resolution))
+            last=min(slots_per_day,profile_slot(ev_end,date,resolution,ceil=True))
+            for i in range(first,last):
+                slots[i]=max(slots[i],config.high)
+        periods=profile_periods(slots,config.low)
+        while len(periods) > max_periods:
+            # Too many switch points for the thermostat: merge the two neighbouring periods which cost the
+            # least extra heating (kelvin times slots) when raised to the higher of their values
+            merges=[]
+            for k in range(len(periods)-1):
+                value=max(periods[k][2],periods[k+1][2])
+                merges.append((sum(value-slots[i] for i in range(periods[k][0],periods[k+1][1])),k,value))
+            cost,k,value=min(merges)
+            for i in range(periods[k][0],periods[k+1][1]):
+                slots[i]=value
+            periods=profile_periods(slots,config.low)
+        plan[date.weekday()]=(config.low,tuple((start*resolution,end*resolution,value) for start,end,value in periods))
+    return tuple(plan)
+
+def profile_periods(slots,base):
+    # Runs of equal value in slots which differ from base, as (first slot, end slot, value)
+    periods=[]
+    start=0
+    for i in range(1,len(slots)+1):
+        if i == len(slots) or slots[i] != slots[start]:
+            if slots[start] != base:
+                periods.append((start,i,slots[start]))
+            start=i
+    return periods
+
+def hmip_method(obj,name):
+    # The async variant of a homematicip method where the library has one
+    return getattr(obj,f'{name}_async',None) or getattr(obj,name)
+
+def find_heating_profile(g,profile):
+    for p in g.profiles or []:
+        if p.index == profile or p.name == profile or p.index == f'PROFILE_{profile}':
+            return p
+    return None
+
+async def upload_heating_profile(room,plan):
+    # Write the plan into the room's profile and make it the active one. Returns True when done.
+    config=site.room_configs[room]
+    g=site.hmip_index["heating"].get(room)
+    if g is None:
+        return False
+    profile=find_heating_profile(g,config.heating_profile)
+    if profile is None:
+        error_msg(f'Room {room} has no heating profile {config.heating_profile}.',1)
+        return False
+    if profile.profileDays is None:
+        # homeId and type of the profile are only known after reading it
+        if not await actuate(f'{room}: Reading heating profile {profile.index}',hmip_method(profile,"get_details")):
+            return False
+    days=dict()
+    for weekday,(base,periods) in enumerate(plan):
+        day=homematicip.group.HeatingCoolingProfileDay(profile._connection)
+        day.from_json({"baseValue": base, "periods": [{"starttime": profile_hhmm(start), "endtime": profile_hhmm(end), "value": value} for start,end,value in periods]})
+        days[weekday]=day
+    profile.profileDays=days
+    log(f'ACTION {room}: Uploading heating profile {profile.index} with {sum(len(periods) for base,periods in plan)} periods.')
+    if not await actuate(f'{room}: Uploading heating profile {profile.index}',hmip_method(profile,"update_profile")):
+        return False
+    if g.activeProfile is None or g.activeProfile.index != profile.index:
+        log(f'ACTION {room}: Activating heating profile {profile.index}.')
+        if not await actuate(f'{room}: Activating heating profile {profile.index}',hmip_method(g,"set_active_profile"),profile.index):
+            return False
+    return True
+
+async def update_heating_profiles(now_local):
+    # Compile the profiles of all profile rooms and upload those whose plan changed
+    resolution=site.global_config.get("profile_resolution",15)
+    max_periods=site.global_config.get("profile_max_periods",6)
+    jobs=dict()
+    for room in site.rooms:
+        config=site.room_configs[room]
+        if config.heating_profile is None or not room in site.hmip_index["heating"]:
+            continue
+        plan=compile_heating_profile(site.rooms[room].get("timeline"),config,now_local,resolution,max_periods,
+                                     lambda before,room=room: room_ramp(room,before,site.room_configs[room].high))
+        digest=hashlib.sha1(json.dumps(plan).encode()).hexdigest()
+        if site.profile_plans.get(room) != digest:
+            jobs[room]=(digest,upload_heating_profile(room,plan))
+    if jobs:
+        results=await asyncio.gather(*(job for digest,job in jobs.values()))
+        for (room,(digest,job)),ok in zip(jobs.items(),results):
+            if ok:
+                site.profile_plans[room]=digest
+
+def profile_horizon():
+    # Profiles cover a week, so calendars need to be expanded that far if any room uses one
+    return 7*24 if any(config.heating_profile is not None for config in site.room_configs.values()) else 0
+
+# Desired-state ledger: the control logic records what each room should look like, reconcile_room() sends only
+# what differs from the observed HmIP state. Entries stay until they are delivered, so failed calls are retried.
+
+def desire(room,key,value):
+    # key is "setpoint", "boost" or ("switch",label). Later writes within a cycle replace earlier ones.
+    site.desired_state.setdefault(room,{})[key]=value
+    site.desired_times.setdefault(room,{})[key]=time.time()
+
+def observed_state(room,key):
+    # Returns (found,value) of the live HmIP state for a ledger key
+    if key=="setpoint" or key=="boost":
+        g=site.hmip_index["heating"].get(room)
+        if g is None:
+            return False,None
+        if key=="setpoint":
+            if g.controlMode == 'ECO':
+                # We never override ECO mode
+                return True,site.desired_state.get(room,{}).get(key)
+            return True,g.setPointTemperature
+        return True,g.boostMode
+    d=site.hmip_index["switches"].get((room,key[1]))
+    if d is None:
+        return False,None
+    return True,d.on
+
+def state_matches(observed,value):
+    if isinstance(observed,numbers.Number) and isinstance(value,numbers.Number) and not isinstance(value,bool):
+        return abs(observed-value) < 0.05
+    return observed == value
+
+async def send_desired(room,key,value):
+    if key=="setpoint":
+        return await set_room_temperature(room,value)
+    elif key=="boost":
+        return await set_room_boost(room,value)
+    return await set_room_switch(room,key[1],value)
+
+async def reconcile_room(room):
+    pending=site.desired_state.get(room)
+    if not pending:
+        return
+    now=time.time()
+    issued=site.issued_state.setdefault(room,{})
+    calls=[]
+    for key,value in list(pending.items()):
+        found,observed=observed_state(room,key)
+        if found and state_matches(observed,value):
+            if site.log_level >= 1:
+                log(f'DEBUG {room}: {key} is already {value}, nothing to send.',1)
+            pending.pop(key)
+        elif key in issued and issued[key][0]==value and now-issued[key][1] < site.global_config.get("hmip_confirm_timeout",cycle_time*2):
+            # Sent recently; the websocket event confirming it has not arrived yet
+            if site.log_level >= 1:
+                log(f'DEBUG {room}: {key}={value} was sent {now-issued[key][1]:.0f} s ago, not sending again.',1)
+            pending.pop(key)
+        else:
+            calls.append((key,value))
+    results=await asyncio.gather(*(send_desired(room,key,value) for key,value in calls))
+    for (key,value),success in zip(calls,results):
+        if success or not observed_state(room,key)[0]:
+            # Delivered, or the group/device does not exist and error_msg has been raised
+            issued[key]=(value,time.time())
+            if pending.get(key)==value:
+                pending.pop(key)
+
+@contextlib.contextmanager
+def perf_phase(name):
+    t0=time.perf_counter()
+    try:
+        yield
+    finally:
+        site.cycle_perf[name]=site.cycle_perf.get(name,0.)+time.perf_counter()-t0
+
+def perf_summary():
+    phases=", ".join(f'{name} {1000.*t:.0f} ms' for name,t in site.cycle_perf.items() if name != "total")
+    retval=f'cycle {1000.*site.cycle_perf.get("total",0.):.0f} ms ({phases})'
+    if site.room_perf:
+        slowest=max(site.room_perf,key=site.room_perf.get)
+        retval+=f', slowest room {slowest} {1000.*site.room_perf[slowest]:.1f} ms'
+    return retval
+
+def report_perf(start_date):
+    # Overrun check, icinga summary and ical_homematic_perf measurement for the sweep which just finished
+    threshold=site.global_config.get("cycle_overrun_threshold",cycle_time/2.)
+    if threshold and site.cycle_perf["total"] > threshold:
+        error_msg(f'Cycle overrun: {perf_summary()} exceeds {threshold} s.',1)
+    if site.log_level >= 1:
+        log(f'INFO: {perf_summary()}',1)
+    if influx:
+        fields={f'{name}_ms': 1000.*t for name,t in site.cycle_perf.items()}
+        fields["rooms"]=len(site.room_perf)
+        if site.room_perf:
+            fields["room_max_ms"]=1000.*max(site.room_perf.values())
+            fields["room_avg_ms"]=1000.*sum(site.room_perf.values())/len(site.room_perf)
+        fields["influx_queued"]=len(influx_queue)
+        fields["influx_spooled"]=influx_stats["spooled"]
+        if "last_write_s" in influx_stats:
+            fields["influx_last_write_ms"]=1000.*influx_stats["last_write_s"]
+        influx_write([{ "measurement": "ical_homematic_perf", "tags": {}, "time": start_date, "fields": fields }])
+
+async def control_room(room,state,decision,start_date):
+    t0=time.perf_counter()
+    if decision is not None:
+        apply_decision(room,state,decision,start_date)
+    site.room_perf[room]=site.room_perf.get(room,0.)+time.perf_counter()-t0
+    await reconcile_room(room)
+
+# Controller state checkpoint, so that a restart resumes without re-firing BEGIN/END and night mode edges
+
+def ledger_key_to_json(key):
+    return key if isinstance(key,str) else f'{key[0]}:{key[1]}'
+
+def ledger_key_from_json(key):
+    if key.startswith("switch:"):
+        return ("switch",key.removeprefix("switch:"))
+    return key
+
+def controller_state():
+    retval={"saved": time.time(), "rooms": {}, "desired": {}, "desired_times": {}, "issued": {}, "profiles": dict(site.profile_plans)}
+    for room in site.rooms:
+        retval["rooms"][room]={"in_event": site.rooms[room]["in_event"], "night_mode": site.rooms[room]["night_mode"],
+                               "boostLastSet": site.rooms[room]["boostLastSet"].timestamp(), "event_title": site.rooms[room].get("event_title")}
+    for room,pending in site.desired_state.items():
+        if pending:
+            retval["desired"][room]={ledger_key_to_json(key): value for key,value in pending.items()}
+            retval["desired_times"][room]={ledger_key_to_json(key): site.desired_times.get(room,{}).get(key) for key in pending}
+    for room,issued in site.issued_state.items():
+        if issued:
+            retval["issued"][room]={ledger_key_to_json(key): list(value) for key,value in issued.items()}
+    return retval
+
+async def save_controller_state():
+    # Written atomically, and only if something changed apart from the time stamp
+    state=controller_state()
+    compare=json.dumps({key: value for key,value in state.items() if key != "saved"},sort_keys=True)
+    if compare == site.last_saved_state:
+        return
+    try:
+        await asyncio.to_thread(write_file_atomic,site.state_filename,json.dumps(state).encode())
+        site.last_saved_state=compare
+    except Exception as e:
+        log(f'ERROR: Could not write controller state to {site.state_filename}: {e}')
+
+def night_hour(config,hour):
+    # Whether the local hour is in the night reduction period of a room
+    if config.night_start > config.night_end:
+        return hour >= config.night_start or hour < config.night_end
+    return hour >= config.night_start and hour < config.night_end
+
+def decision_window_start(room,now):
+    # Unix time of the last flank the control logic acts upon before now: an event start or end, or the begin
+    # or end of night mode
+    start=now-site.global_config.get("state_max_age",86400)
+    intervals=night_intervals(site.room_configs[room],start,now)
+    if "timeline" in site.rooms[room]:
+        intervals+=[(ev_start,ev_end) for ev_start,ev_end,title in site.rooms[room]["timeline"].between(start,now)]
+    return max([start]+[t for interval in intervals for t in interval if t <= now])
+
+def restore_controller_state():
+    # Restore the state of the last run, validated against the live HmIP state
+    try:
+        with open(site.state_filename) as f:
+            state=json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        log(f'ERROR: Could not read controller state from {site.state_filename}: {e}')
+        return
+    age=time.time()-state.get("saved",0)
+    if age > site.global_config.get("state_max_age",86400):
+        log(f'INFO: Controller state in {site.state_filename} is {age:.0f} s old, not restoring it.')
+        return
+    now=time.time()
+    saved_time=state.get("saved",0)
+    for room,saved in state.get("rooms",{}).items():
+        if not room in site.rooms:
+            continue
+        config=site.room_configs[room]
+        # The flags are derived from the timeline and the clock, the file only tells which flanks were acted upon
+        # before the restart; the first sweep then acts on those which passed while we were down.
+        if config.calendar_url is not None:
+            event=site.rooms[room]["timeline"].first_after(now) if "timeline" in site.rooms[room] else None
+            if event is not None and event[0] < now:
+                # An event is running: its BEGIN was handled if we were in an event which had started when saved
+                site.rooms[room]["in_event"]=bool(saved["in_event"]) and event[0] <= saved_time
+            else:
+                # No event is running (or the calendar could not be read): a handled BEGIN still needs its END
+                site.rooms[room]["in_event"]=bool(saved["in_event"])
+            if site.rooms[room]["in_event"] and saved.get("event_title") is not None:
+                site.rooms[room]["event_title"]=saved["event_title"]
+        if config.night_start is not None and config.heating_switches is None:
+            site.rooms[room]["night_mode"]=night_hour(config,datetime.datetime.fromtimestamp(saved_time).hour)
+        site.rooms[room]["boostLastSet"]=datetime.datetime.fromtimestamp(saved["boostLastSet"],datetime.timezone.utc)
+    dropped=0
+    for room,pending in state.get("desired",{}).items():
+        if not room in site.rooms:
+            continue
+        window_start=decision_window_start(room,now)
+        times=state.get("desired_times",{}).get(room,{})
+        for key,value in pending.items():
+            # Set before the last event or night mode flank: the decisions of the current window replace it
+            if times.get(key) is None or times[key] < window_start:
+                dropped+=1
+                continue
+            desire(room,ledger_key_from_json(key),value)
+            site.desired_times[room][ledger_key_from_json(key)]=times[key]
+    if dropped:
+        if site.log_level >= 1:
+            log(f'INFO: Dropped {dropped} pending commands from before the current decision window.',1)
+    for room,issued in state.get("issued",{}).items():
+        if not room in site.rooms:
+            continue
+        for key,value in issued.items():
+            key=ledger_key_from_json(key)
+            found,observed=observed_state(room,key)
+            # Only keep commands which the live state confirms; anything else was changed since or never arrived
+            if found and state_matches(observed,value[0]):
+                site.issued_state.setdefault(room,{})[key]=tuple(value)
+    # Heating profiles which were uploaded before are not uploaded again unless their plan changes
+    for room,digest in state.get("profiles",{}).items():
+        if room in site.rooms:
+            site.profile_plans[room]=digest
+    log(f'INFO: Restored controller state of {len(state.get("rooms",{}))} rooms from {site.state_filename} ({age:.0f} s old).')
+
+def next_local_hour(now_local,hour):
+    # Unix time of the next time the local clock reaches hour:00. Like night_intervals(), a fractional hour is rounded
+    # up to the whole hour at which the control logic acts on it; 24 is the next midnight.
+    t=now_local.replace(hour=int(math.ceil(hour))%24,minute=0,second=0,microsecond=0)
+    if t <= now_local:
+        t+=datetime.timedelta(days=1)
+    return t.timestamp()
+
+def schedule_room(room,state,start_ts,start_date_local):
+    # Compute the next time something can change for this room: event edges, the ramp crossing the current
+    # temperature, the end of a boost and the night_start/night_end edges.
+    deadlines=[]
+    config=site.room_configs[room]
+    if "timeline" in site.rooms[room]:
+        timeline=site.rooms[room]["timeline"]
+        heatevents=timeline.between(start_ts,start_ts+lookahead*3600.)
+        for ev_start,ev_end,title in heatevents:
+            deadlines.append(ev_start)
+            deadlines.append(ev_end)
+            if isinstance(state.get("actualTemperature"),numbers.Number):
+                ramp=room_ramp(room,state["actualTemperature"],config.high)
+                if ramp > 0:
+                    deadlines.append(ev_start - (config.high-state["actualTemperature"])*3600./ramp)
+        # The next event entering the lookahead window
+        i=bisect.bisect_right(timeline.starts,start_ts+lookahead*3600.)
+        if i < len(timeline.starts):
+            deadlines.append(timeline.starts[i]-lookahead*3600.)
+    if config.boost_threshold is not None and isinstance(state.get("boostDuration"),numbers.Number):
+        deadlines.append(site.rooms[room]["boostLastSet"].timestamp()+state["boostDuration"]*60.)
+    if config.night_start is not None:
+        deadlines.append(next_local_hour(start_date_local,config.night_start))
+        deadlines.append(next_local_hour(start_date_local,config.night_end))
+    deadlines=[d for d in deadlines if d > start_ts]
+    if deadlines:
+        deadline=min(deadlines)
+        site.room_next_deadline[room]=deadline
+        heapq.heappush(site.room_deadlines,(deadline,room))
+    else:
+        site.room_next_deadline.pop(room,None)
+
+def wake_room(room):
+    # Called from the websocket event handler: re-evaluate this room as soon as possible
+    if room in site.rooms:
+        site.dirty_rooms.add(room)
+        event_loop.call_soon_threadsafe(site.room_wakeup.set)
+
+async def evaluate_due_rooms():
+    # Re-evaluate the rooms whose deadline has passed or which were flagged by an event
+    now=time.time()
+    due=set(site.dirty_rooms)
+    site.dirty_rooms.clear()
+    while site.room_deadlines and site.room_deadlines[0][0] <= now:
+        deadline,room=heapq.heappop(site.room_deadlines)
+        # Skip stale entries which have been superseded by a later schedule_room
+        if site.room_next_deadline.get(room) == deadline:
+            due.add(room)
+    if not due:
+        return
+    start_date = datetime.datetime.now(datetime.timezone.utc)
+    start_date_local = datetime.datetime.now()
+    states=dict()
+    for room in due:
+        if site.log_level >= 1:
+            log(f'DEBUG {room}: Re-evaluating before the next periodic cycle.',1)
+        states[room]=get_room_data(room)
+    decisions=evaluate_rooms(due,states,start_date,start_date_local)
+    await asyncio.gather(*(control_room(room,states[room],decisions.get(room),start_date) for room in due))
+    for room in due:
+        schedule_room(room,states[room],start_date.timestamp(),start_date_local)
+
+# Schedule preview: the planned set point timeline of rooms over a window, computed from the expanded calendar
+# timelines and the room config only, without HmIP calls. Served on /schedule and printed by "ical_homematic.py schedule".
+def night_intervals(config,start,end):
+    # The night reduction periods of a room overlapping [start,end), in unix time. The control logic checks whole hours.
+    if config.night_start is None or config.heating_switches is not None:
+        return []
+    night_start=math.ceil(config.night_start)
+    night_end=math.ceil(config.night_end)
+    if night_start == night_end:
+        return []
+    retval=[]
+    day=datetime.datetime.fromtimestamp(start).date()-datetime.timedelta(days=1)
+    while datetime.datetime.combine(day,datetime.time()).timestamp() < end:
+        midnight=datetime.datetime.combine(day,datetime.time())
+        retval.append(((midnight+datetime.timedelta(hours=night_start)).timestamp(),
+                       (midnight+datetime.timedelta(days=1 if night_start > night_end else 0,hours=night_end)).timestamp()))
+        day+=datetime.timedelta(days=1)
+    return retval
+
+def schedule_leads(room,config):
+    # Ramp lead times from the base and from the night temperature, as the room would be before an event
+    leads=dict()
+    if config.heating_switches is None:
+        for before in (config.low,config.lown):
+            ramp=room_ramp(room,before,config.high)
+            leads[before]=min((config.high-before)*3600./ramp,lookahead*3600.) if ramp > 0 and config.high > before else 0.
+    return leads
+
+def event_lead(config,leads,nights,night_starts,ev_start):
+    if not leads:
+        return 0.
+    i=bisect.bisect_right(night_starts,ev_start)-1
+    return leads[config.lown if i >= 0 and ev_start < nights[i][1] else config.low]
+
+def compute_room_plan(config,timeline,leads,start,end):
+    # Set point segments covering [start,end): segment k runs from times[k] to times[k+1] (whole seconds). Later
+    # pieces (night < ramp < event) take precedence, like in the control logic, and earlier events over later ones.
+    nights=night_intervals(config,start,end+lookahead*3600.)
+    night_starts=[night_start for night_start,night_end in nights]
+    pieces=[(night_start,night_end,1,config.lown,"night") for night_start,night_end in nights]
+    for ev_start,ev_end,title in timeline.between(start,end+lookahead*3600.):
+        lead=event_lead(config,leads,nights,night_starts,ev_start)
+        if lead:
+            pieces.append((ev_start-lead,ev_start,2,config.high,f'ramp for {title}'))
+        pieces.append((ev_start,ev_end,3,config.high,title))
+    points=sorted(set([start,end]+[t for piece in pieces for t in piece[:2] if start < t < end]))
+    best=[(0,config.low,"base")]*(len(points)-1)
+    for piece_start,piece_end,priority,value,reason in pieces:
+        for k in range(bisect.bisect_left(points,max(piece_start,start)),bisect.bisect_left(points,min(piece_end,end))):
+            if priority > best[k][0]:
+                best[k]=(priority,value,reason)
+    times=[]
+    setpoints=[]
+    reasons=[]
+    for k,(priority,value,reason) in enumerate(best):
+        if not setpoints or setpoints[-1] != value or reasons[-1] != reason:
+            times.append(int(points[k]))
+            setpoints.append(value)
+            reasons.append(reason)
+    times.append(int(end))
+    return {"start": start, "end": end, "times": times, "setpoints": setpoints, "reasons": reasons, "nights": nights, "night_starts": night_starts}
+
+def room_schedule(room,start,end):
+    # The planned set points of a room over [start,end) as times, setpoints and reasons (see compute_room_plan()),
+    # and the next heat-up
+    config=site.room_configs[room]
+    if config.heating_profile is not None:
+        kind="profile"
+    elif config.heating_switches is not None:
+        kind="switches"
+    else:
+        kind="thermostats"
+    retval={"kind": kind}
+    if config.heating_switches is not None:
+        retval["switches"]=list(config.heating_switches)
+    timeline=site.rooms[room].get("timeline")
+    if timeline is None:
+        retval["note"]="No calendar configured." if config.calendar_url is None else "Calendar not loaded yet."
+        return retval
+    expanded_until=calendars.get(config.calendar_url,{}).get("expanded_until")
+    retval["complete_until"]=expanded_until.timestamp() if expanded_until is not None else None
+    leads=schedule_leads(room,config)
+    plan=site.schedule_cache.get(room)
+    if (plan is None or plan["timeline"] is not timeline or plan["version"] != timeline.version or plan["config"] is not config
+        or plan["leads"] != leads or start < plan["start"] or end > plan["end"]):
+        # Cover yesterday to eight days ahead (or the expanded horizon), so that the usual queries, up to a week from
+        # now, are slices of one plan
+        midnight=datetime.datetime.combine(datetime.date.today(),datetime.time()).timestamp()
+        plan=compute_room_plan(config,timeline,leads,min(start,midnight-86400.),max(end,time.time()+8*86400.,retval["complete_until"] or 0.))
+        plan.update(timeline=timeline,version=timeline.version,config=config,leads=leads)
+        site.schedule_cache[room]=plan
+    times=plan["times"]
+    lo=bisect.bisect_right(times,start)-1
+    hi=min(max(bisect.bisect_left(times,end),lo+1),len(times)-1)
+    retval["times"]=[int(start)]+times[lo+1:hi]+[int(end)]
+    retval["setpoints"]=plan["setpoints"][lo:hi]
+    retval["reasons"]=plan["reasons"][lo:hi]
+    retval["next_heat"]=None
+    heatevent=timeline.first_after(start)
+    if heatevent is not None:
+        ev_start,ev_end,title=heatevent
+        lead=event_lead(config,leads,plan["nights"],plan["night_starts"],ev_start)
+        retval["next_heat"]={"from": ev_start-lead, "event_start": ev_start, "event_end": ev_end, "title": title}
+    return retval
+
+def parse_time(value):
+    # Unix time or ISO 8601 (local time unless it has an offset)
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+def status_schedule(query):
+    # /schedule?room=<room>&room=...&start=<time>&hours=<hours> (or end=<time>); all rooms and the next 7 days by default
+    start=parse_time(query["start"][0]) if "start" in query else time.time()
+    end=parse_time(query["end"][0]) if "end" in query else start+float(query.get("hours",["168"])[0])*3600.
+    retval={"start": start, "end": end, "rooms": {}}
+    for room in query.get("room",list(site.rooms)):
+        if room in site.rooms:
+            retval["rooms"][room]=room_schedule(room,start,end)
+        else:
+            retval["rooms"][room]={"error": "Unknown room."}
+    return "application/json",json.dumps(retval).encode()
+
+# Local status endpoint (Unix socket and/or localhost TCP), served from the event loop. Monitoring asks it
+# instead of polling the status file: /health for check_ical_homematic.py, /rooms, and /metrics for Prometheus.
+
+def status_health(query):
+    now=time.time()
+    retval={"status": 3, "messages": ["No cycle completed yet."], "perf": "", "last_cycle": None, "age": None, "uptime": now-site.start_time}
+    if site.last_status is not None:
+        retval.update(status=site.last_status["status"],messages=site.last_status["messages"],perf=site.last_status["perf"],
+                      last_cycle=site.last_status["time"],age=now-site.last_status["time"])
+    return "application/json",json.dumps(retval).encode()
+
+def status_rooms(query):
+    state=controller_state()
+    retval=dict()
+    for room in site.rooms:
+        retval[room]=dict(state["rooms"][room])
+        retval[room]["desired"]=state["desired"].get(room,{})
+        retval[room]["issued"]=state["issued"].get(room,{})
+        retval[room]["observed"]=site.last_room_states.get(room,{})
+        retval[room]["next_evaluation"]=site.room_next_deadline.get(room)
+        retval[room]["ramp_model"]=site.ramp_models.get(room)
+    return "application/json",json.dumps(retval,default=str).encode()
+
+def metric_labels(labels):
+    if not labels:
+        return ""
+    return "{"+",".join(f'{key}="{str(value).replace(chr(92),chr(92)*2).replace(chr(34),chr(92)+chr(34)).replace(chr(10),chr(92)+"n")}"' for key,value in labels.items())+"}"
+
+def status_metrics(query):
+    # Prometheus text exposition format
+    lines=[]
+    def metric(name,kind,helptext,samples):
+        lines.append(f'# HELP {name} {helptext}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels,value in samples:
+            if isinstance(value,numbers.Number):
+                lines.append(f'{name}{metric_labels(labels)} {float(value)}')
+    now=time.time()
+    metric("ical_homematic_uptime_seconds","gauge","Seconds since start",[({},now-site.start_time)])
+    if site.last_status is not None:
+        metric("ical_homematic_status","gauge","Icinga status of the last cycle (0 OK, 1 WARNING, 2 CRITICAL)",[({},site.last_status["status"])])
+        metric("ical_homematic_last_cycle_timestamp_seconds","gauge","Unix time at which the last cycle completed",[({},site.last_status["time"])])
+    metric("ical_homematic_cycle_seconds","gauge","Duration of the phases of the last cycle",[({"phase": name},t) for name,t in site.cycle_perf.items()])
+    metric("ical_homematic_slowest_cycle_seconds","gauge","Duration of the slowest profiled cycle",[({},site.slowest_cycle)])
+    metric("ical_homematic_log_dropped_total","counter","Log messages dropped because the log queue was full",[({},log_stats["dropped"])])
+    metric("ical_homematic_errors_total","counter","Error messages by icinga status",[({"status": status},count) for status,count in site.error_counts.items()])
+    metric("ical_homematic_api_calls_total","counter","HmIP cloud calls including retries",[({"call": call},count) for call,count in site.api_calls.items()])
+    metric("ical_homematic_calendar_age_seconds","gauge","Seconds since the calendar was last checked",
+           [({"calendar": hashlib.sha256(url.encode()).hexdigest()[:12]},now-entry["cal_last_update"].timestamp()) for url,entry in calendars.items() if "cal_last_update" in entry])
+    metric("ical_homematic_influx_queue_depth","gauge","InfluxDB points waiting for the writer",[({},len(influx_queue))])
+    metric("ical_homematic_influx_points_total","counter","InfluxDB points by outcome",[({"result": key},influx_stats[key]) for key in ("queued","written","dropped") if key in influx_stats])
+    metric("ical_homematic_influx_spooled_points","gauge","InfluxDB points in the spool file",[({},influx_stats.get("spooled",0))])
+    room_samples=[]
+    for room,state in site.last_room_states.items():
+        for field in ("actualTemperature","setPointTemperature"):
+            room_samples.append(({"room": room, "kind": field.removesuffix("Temperature")},state.get(field)))
+    metric("ical_homematic_room_temperature_celsius","gauge","Room temperatures of the last cycle",room_samples)
+    metric("ical_homematic_energy_reading","gauge","Last emitted energy counter readings",[({"name": counter, "counter": counter_type},reading["value"]) for (counter,counter_type),reading in site.energy_readings.items()])
+    metric("ical_homematic_energy_rate","gauge","Consumption rate per hour since the reading before (m³/h, kW)",[({"name": counter, "counter": counter_type},reading["rate"]) for (counter,counter_type),reading in site.energy_readings.items()])
+    return "text/plain; version=0.0.4",("\n".join(lines)+"\n").encode()
+
+status_routes={"/health": status_health, "/rooms": status_rooms, "/metrics": status_metrics, "/schedule": status_schedule}
+
+async def handle_status_request(reader,writer):
+    try:
+        request=await asyncio.wait_for(reader.readline(),5.)
+        while True:
+            line=await asyncio.wait_for(reader.readline(),5.)
+            if line in (b"\r\n",b"\n",b""):
+                break
+        parts=request.decode("latin-1").split()
+        url=urllib.parse.urlsplit(parts[1] if len(parts) >= 2 else "/")
+        route=status_routes.get(url.path)
+        if len(parts) < 2 or parts[0] != "GET":
+            status,content_type,body="405 Method Not Allowed","text/plain",b"Only GET is supported.\n"
+        elif route is None:
+            status,content_type,body="404 Not Found","text/plain",("Known paths: "+" ".join(status_routes)+"\n").encode()
         else:
-            room["calendar"] = tmpcal
-            room["cal_last_update"] = datetime.datetime.now()
-
-async def main_loop():
-    # Main loop
-    global home
-    global rooms
-    global global_config
+            try:
+                status="200 OK"
+                content_type,body=route(urllib.parse.parse_qs(url.query))
+            except Exception as e:
+                log(f'ERROR: Status request {url.path} failed: {e}')
+                status,content_type,body="500 Internal Server Error","text/plain",f'{e}\n'.encode()
+        writer.write(f'HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode()+body)
+        await writer.drain()
+    except (asyncio.TimeoutError,ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_status_server():
+    socket_name=site.global_config.get("status_socket","ical_homematic.sock")
+    if socket_name:
+        socket_name=os.path.join(site.directory,socket_name)
+        try:
+            if os.path.exists(socket_name):
+                os.remove(socket_name)
+            site.status_servers.append(await asyncio.start_unix_server(handle_status_request,path=socket_name))
+            if site.log_level >= 1:
+                log(f'INFO: Status endpoint listening on {socket_name}.',1)
+        except OSError as e:
+            log(f'ERROR: Could not listen on {socket_name}: {e}')
+    port=site.global_config.get("status_port",0)
+    if port:
+        host=site.global_config.get("status_host","127.0.0.1")
+        try:
+            site.status_servers.append(await asyncio.start_server(handle_status_request,host=host,port=port))
+            if site.log_level >= 1:
+                log(f'INFO: Status endpoint listening on {host}:{port}.',1)
+        except OSError as e:
+            log(f'ERROR: Could not listen on {host}:{port}: {e}')
+
+async def sweep():
+    # Periodic full pass over all rooms: calendars, energy counters, influx and control logic
     global influx
-    home.onEvent += handle_events
-    await home.enable_events()
+    site.cycle_perf.clear()
+    site.room_perf.clear()
+    t0=time.perf_counter()
 
-    icinga_status=0
-    while True:
+    # Check if any of the calendars need to be refreshed
+    with perf_phase("calendar_refresh"):
+        await refresh_calendars()
+    with perf_phase("recurrence_expansion"):
+        await update_timelines()
+    with perf_phase("heating_profiles"):
+        await update_heating_profiles(datetime.datetime.now())
 
-        start_error_log()
+    # UTC for interaction with online calendar
+    start_date = datetime.datetime.now(datetime.timezone.utc)
+    start_ts = start_date.timestamp()
 
-        # Check if the global calendar needs to be refreshed
-        if "url" in global_config:
-            lu=global_config.get("cal_last_update",datetime.datetime(1970,1,1))
-            now=datetime.datetime.now()
-            if (now-lu).total_seconds() > 300.:
-                log(f'ICAL global: Refreshing ical.')
-                refresh_calendar(global_config,"global calendar")
-
-        # Check if any of the calendars need to be refreshed
-        for room in rooms:
-            if "url" in rooms[room]:
-                lu=rooms[room].get("cal_last_update",datetime.datetime(1970,1,1))
-                now=datetime.datetime.now()
-                if (now-lu).total_seconds() > 300.:
-                    log(f'ICAL {room}: Refreshing ical.')
-                    refresh_calendar(rooms[room],room)
-
-        # UTC for interaction with online calendar
-        start_date = datetime.datetime.now(datetime.timezone.utc)
-    
-        # Local time for lowering of base temperature over night
-        start_date_local = datetime.datetime.now()
-
-        energy_counters = get_energy_counters()
-
-        if influx and energy_counters:
-            series=[]
-            for counter in energy_counters:
-                for counter_type in energy_counters[counter]:
-                    if counter_type == "gas":
-                        series.append({
-                                        "measurement": "energy",
-                                        "tags":        { "type": "gas", "name": counter },
-                                        "time":        start_date,
-                                        "fields":      { "gas": energy_counters[counter][counter_type] }
-                                      })
-                    elif counter_type.startswith("elec"):
-                        series.append({
-                                        "measurement": "energy",
-                                        "tags":        { "type": "electrical", "name": counter, "number": counter_type.removeprefix("elec") },
-                                        "time":        start_date,
-                                        "fields":      { "electricity": energy_counters[counter][counter_type] }
-                                      })
-            if series:
-                try:
-                    influx.write_points(series)
-                except:
-                    log("Writing energy counters to influxdb failed.")
-                    error_msg("Writing energy counters to influxdb failed.",1)
+    # Local time for lowering of base temperature over night
+    start_date_local = datetime.datetime.now()
 
-        for room in rooms:
+    with perf_phase("energy_counters"):
+        series=energy_series(get_energy_counters(),start_date)
+        if influx and series:
+            influx_write(series)
+
+    with perf_phase("room_state"):
+        states=dict()
+        for room in site.rooms:
             # Get present state of this room
             state=get_room_data(room)
-
+            states[room]=state
             if influx:
                 series=[]
                 fields={}
@@ -306,7 +2563,7 @@ async def main_loop():
                 if fields:
                     series.append({
                                 "measurement": "homematic_rooms",
-                                "tags":        { "room": rooms[room]["influx_name"], "subroom": rooms[room]["subroom"] },
+                                "tags":        { "room": site.room_configs[room].influx_name, "subroom": site.room_configs[room].subroom },
                                 "fields":     fields,
                                 "time":        start_date
                                 })
@@ -315,277 +2572,611 @@ async def main_loop():
                     if isinstance(state["thermostats"][thermostat],numbers.Number): 
                         series.append({
                                     "measurement": "homematic_rooms",
-                                    "tags":        { "room": rooms[room]["influx_name"], "subroom": rooms[room]["subroom"], "thermostat": thermostat },
+                                    "tags":        { "room": site.room_configs[room].influx_name, "subroom": site.room_configs[room].subroom, "thermostat": thermostat },
                                     "fields":      { "vp": state["thermostats"][thermostat] },
                                     "time":        start_date
                                     })
                 if series:
-                    try:
-                        influx.write_points(series)
-                    except Exception as e:
-                        log(f'Write to influxdb failed for room {room} with subroom {rooms[room]["subroom"]} on measurement {rooms[room]["influx_name"]}.')
-                        log(f'Message was {e}.')
-                        log(f'Data was {series}.')
-                        error_msg("Write to influxdb failed.",1)
-
-            # Stop processing this room in case we only follow it for logging purposes
-            if not "thermostats" in state:
-                log(f'DEBUG {room}: No thermostats available for this room, continuing with next room after logging.',1)
-                continue
+                    influx_write(series)
 
-            if "url" in rooms[room] and "calendar" in rooms[room]:
-                calendar_source=rooms[room]["calendar"]
-            elif "ical_resource" in rooms[room] and "url" in global_config and "calendar" in global_config:
-                calendar_source=global_config["calendar"]
-            else:
-                log(f'DEBUG {room}: No calendar available for this room, continuing with next room.',1)
-                continue
+    with perf_phase("ramp_models"):
+        await update_ramp_models(states,start_ts)
 
-            try:
-                events = recurring_ical_events.of(calendar_source, skip_bad_series=True).between(start_date, datetime.timedelta(hours=lookahead))
-            except:
-                log(f'Unable to get events within next {lookahead} hours for room {room}.')
-                error_msg(f'Unable to get events within next {lookahead} hours for room {room}.',1)
-                events=list()
-
-            heatevents=list()
-            if events:
-                for event in events:
-                    myevent=False
-                    if isinstance(event["DTSTART"].dt,datetime.datetime):
-                        if "summary_keyword" in rooms[room]:
-                            if rooms[room]["summary_keyword"] in str(event["SUMMARY"]):
-                                myevent=event
-                        if "ical_resource" in rooms[room] and "RESOURCES" in event:
-                            resources=event["RESOURCES"].split(',')
-                            resources=[element.strip() for element in resources]
-                            log(f'DEBUG {room}: Event {event["SUMMARY"]} has resources {event["RESOURCES"]}')
-                            if rooms[room]["ical_resource"] in resources:
-                                if not ( rooms[room]["veto_resource"] != "" and rooms[room]["veto_resource"] in resources ):
-                                    myevent=event
-                                else:
-                                    log(f'DEBUG {room}: Event {event["SUMMARY"]} (from {event["DTSTART"].dt} to {event["DTEND"].dt}) skipped because of veto resource',1)
-                        if myevent:
-                            heatevents.append(myevent)
-                            log(f'DEBUG {room}: Event {myevent["SUMMARY"]} (from {myevent["DTSTART"].dt} to {myevent["DTEND"].dt}) ahead!',1)
-                heatevents=sorted(heatevents, key=lambda argevent: argevent["DTSTART"].dt)
- 
-            should_be_in_event=False
-            should_be_ramping=False
-
-            if heatevents:
-                # Time to event
-                timetohot=(heatevents[0]["DTSTART"].dt - start_date).total_seconds()
-                rooms[room]["event_title"] = str(heatevents[0]["SUMMARY"])
-                if timetohot < 0: 
-                    # We are already in the event
-                    should_be_in_event = True
-                    if len(heatevents) >= 2:
-                        # We are in the event and the next event is already in sight
-                        should_be_ramping = True
-                        timetohot=(heatevents[1]["DTSTART"].dt - start_date).total_seconds()
-                    else:
-                        # We are in the event and no other event is in sight within the next 'lookahead' hours
-                        should_be_ramping = False
-                else:
-                    # We are not in the event yet
-                    should_be_in_event = False
-                    should_be_ramping = True
-            else:
-                should_be_in_event = False
-                should_be_ramping = False
-
-            # Flank detection for should_be_in_event
-            if should_be_in_event and not rooms[room]["in_event"]:
-                log(f'BEGIN {room}: {rooms[room]["event_title"]}')
-                if isinstance(state["setPointTemperature"],numbers.Number):
-                    if state["setPointTemperature"] + 0.1 < rooms[room]["high"]:
-                        log(f'ACTION {room}: Setting temperature to {rooms[room]["high"]}°C (Reason: {rooms[room]["event_title"]}).')
-                        if await set_room_temperature(room,rooms[room]["high"]):
-                            rooms[room]["in_event"] = True
-                    else:
-                        log(f'ACTION {room}: No need to set temperature to {rooms[room]["high"]}°C; it is already at {state["setPointTemperature"]}°C (Reason: {rooms[room]["event_title"]}).')
-                        rooms[room]["in_event"] = True
-                    if "heating_switches" in rooms[room]:
-                        for switch in rooms[room]["heating_switches"]:
-                            log(f'ACTION {room}: Setting switch {switch} to on. (Reason: {rooms[room]["event_title"]})')
-                            if await set_room_switch(room,switch,True):
-                                rooms[room]["in_event"] = True
-                else:
-                    log(f'WARNING {room}: setPointTemperature is not numeric!')
-            if not should_be_in_event and rooms[room]["in_event"]:
-                log(f'END {room}: {rooms[room]["event_title"]}')
-                log(f'ACTION {room}: Setting temperature to {rooms[room]["low"]}°C. (Reason: {rooms[room]["event_title"]})')
-                if await set_room_temperature(room,rooms[room]["low"]):
-                    rooms[room]["in_event"] = False
-                if "heating_switches" in rooms[room]:
-                    for switch in rooms[room]["heating_switches"]:
-                        log(f'ACTION {room}: Setting switch {switch} to off. (Reason: {rooms[room]["event_title"]})')
-                        if await set_room_switch(room,switch,False):
-                            rooms[room]["in_event"] = False
-
-            # We assume that if heating_switches are not set for this room, boost mode does not make any sense, and neither the pre-heating mode or the overnight reduction
-            if "heating_switches" in rooms[room]:
-                log(f'DEBUG {room}: This room has heating switches configured. No need to do any ramping, boosting or over-night reduction. Continuing with next room.',1)
-                continue
+    # Evaluate all rooms concurrently, so that their HmIP calls are dispatched in parallel
+    with perf_phase("control"):
+        await asyncio.gather(*(set_room_control_mode(room) for room in site.rooms))
+        decisions=evaluate_rooms(list(site.rooms),states,start_date,start_date_local)
+        await asyncio.gather(*(control_room(room,states[room],decisions.get(room),start_date) for room in site.rooms))
+    site.last_room_states=states
+    for room in site.rooms:
+        schedule_room(room,states[room],start_ts,start_date_local)
+    site.cycle_perf["total"]=time.perf_counter()-t0
+    report_perf(start_date)
 
-            # In case we are in the ramp-up for the next event, set the set value to "high" when the ramp goes through the current temperature
-            if should_be_ramping:
-                if isinstance(state["actualTemperature"],numbers.Number):
-                    if state["actualTemperature"] < rooms[room]["high"] - timetohot * rooms[room]["ramp"]/3600. and state["setPointTemperature"] < rooms[room]["high"]: 
-                        log(f'ACTION {room}: Setting temperature to {rooms[room]["high"]}°C at {timetohot} seconds from next event (Reason: {rooms[room]["event_title"]}).')
-                        await set_room_temperature(room,rooms[room]["high"])
-
-            # Do we need to boost?
-            if "boost_threshold" in rooms[room]:
-                if isinstance(state["actualTemperature"],numbers.Number):
-                    if state["setPointTemperature"] - state["actualTemperature"] > rooms[room]["boost_threshold"]:
-                        if (start_date - rooms[room]["boostLastSet"]).total_seconds() > state["boostDuration"]*60.0:
-                            log(f'ACTION {room}: Setting {state["boostDuration"]} minutes boost mode because set point {state["setPointTemperature"]}°C is more than {threshold}K above the room temperature {state["actualTemperature"]}°C.')
-                            await set_room_boost(room, True)
-                            rooms[room]["boostLastSet"]=start_date
-
-            # Reduction of base temperature over night
-            if "night_start" in rooms[room] and "night_end" in rooms[room]:
-                log(f'DEBUG {room}: night time reduction configured.',1)
-                # Are we in the configured night time period?
-                if rooms[room]["night_start"] > rooms[room]["night_end"]:
-                    log(f'DEBUG {room}: night time reduction period includes midnight.',1)
-                    # The period with reduced temperature includes midnight. This will be the more common case.
-                    if start_date_local.hour >= rooms[room]["night_start"] or start_date_local.hour < rooms[room]["night_end"]:
-                        should_be_in_night_mode = True
-                        log(f'DEBUG {room}: should be in night mode.',1)
-                    else:
-                        should_be_in_night_mode = False
-                        log(f'DEBUG {room}: should not be in night mode.',1)
-                else:
-                    log(f'DEBUG {room}: night time reduction period does not include midnight.',1)
-                    # This is the other case...
-                    if start_date_local.hour >= rooms[room]["night_start"] and start_date_local.hour < rooms[room]["night_end"]:
-                        should_be_in_night_mode = True
-                        log(f'DEBUG {room}: should be in night mode.',1)
-                    else:
-                        should_be_in_night_mode = False
-                        log(f'DEBUG {room}: should not be in night mode.',1)
-                # Flank detection for night mode
-                log(f'DEBUG {room}: night_mode: {rooms[room]["night_mode"]}',1)
-                if should_be_in_night_mode and not rooms[room]["night_mode"]:
-                    rooms[room]["night_mode"] = True
-                    log(f'DEBUG {room} in_event: {rooms[room]["in_event"]} should_be_ramping: {should_be_ramping}',1)
-                    if not (rooms[room]["in_event"] or should_be_ramping):
-                        log(f'ACTION {room}: Setting to reduced base temperature of {rooms[room]["lown"]}°C over night.')
-                        if await set_room_temperature(room,rooms[room]["lown"]):
-                            log(f'ACTION {room}: Entering night mode.')
-                elif rooms[room]["night_mode"] and not should_be_in_night_mode:
-                    rooms[room]["night_mode"] = False
-                    log(f'DEBUG {room} setPointTemperature: {state["setPointTemperature"]}',1)
-                    if state["setPointTemperature"] < rooms[room]["low"]:
-                        log(f'ACTION {room}: Setting to base temperature of {rooms[room]["low"]}°C.')
-                        if await set_room_temperature(room,rooms[room]["low"]):
-                            log(f'ACTION {room}: Leaving night mode.')
+    if influx:
+        if site.log_level >= 1:
+            log(f'INFO: influxdb points queued: {influx_stats["queued"]}, written: {influx_stats["written"]}, spooled: {influx_stats["spooled"]}, dropped: {influx_stats["dropped"]}.',1)
+        influx_flush.set()
+    return start_date
+
+async def profiled_sweep():
+    # Run a sweep under cProfile and keep the profile of the slowest sweep so far
+    profile=cProfile.Profile()
+    profile.enable()
+    try:
+        start_date=await sweep()
+    finally:
+        profile.disable()
+    if site.cycle_perf.get("total",0.) > site.slowest_cycle:
+        site.slowest_cycle=site.cycle_perf["total"]
+        profile.dump_stats(os.path.join(site.directory,"ical_homematic_slowest.prof"))
+        log(f'INFO: New slowest cycle ({1000.*site.slowest_cycle:.0f} ms), profile written to {os.path.join(site.directory,"ical_homematic_slowest.prof")}.')
+    return start_date
+
+async def main_loop(cycles=None):
+    # Main loop. cycles limits the number of periodic sweeps (used by the benchmark), None runs forever.
+    global influx
+    global http_semaphore
+    global event_loop
+    global influx_flush
+    # Limits the number of calendar downloads running in parallel
+    if http_semaphore is None:
+        http_semaphore = asyncio.Semaphore(main_site.global_config.get("http_max_connections",8))
+    event_loop = asyncio.get_running_loop()
+    site.room_wakeup = asyncio.Event()
+    site.events_pending = asyncio.Event()
+    # Concurrency and rate limits for calls to the HmIP cloud
+    site.hmip_semaphore = asyncio.Semaphore(site.global_config.get("hmip_max_concurrency",4))
+    site.hmip_bucket = TokenBucket(site.global_config.get("hmip_rate",2.),site.global_config.get("hmip_burst",10))
+    # A site run by the supervisor uses its influxdb writer
+    if site.name is None:
+        influx_flush = asyncio.Event()
+        if influx:
+            site.background_tasks.append(asyncio.create_task(influx_writer()))
+    site.background_tasks.append(asyncio.create_task(event_processor()))
+    site.home.onEvent += functools.partial(handle_events,contextvars.copy_context())
+    await site.home.enable_events()
+
+    # The periodic sweep over all rooms is a safety net; in between, rooms are woken up at their deadlines or by events
+    next_sweep=0.
+    sweeps=0
+    while True:
+        if time.time() >= next_sweep:
+            notify("WATCHDOG=1")
+            start_error_log()
+            reload_config()
+            site.room_deadlines.clear()
+            site.dirty_rooms.clear()
+            if site.global_config.get("profile_cycles",False):
+                start_date=await profiled_sweep()
             else:
-                log(f'DEBUG {room}: night time reduction NOT configured.',1)
+                start_date=await sweep()
+            stop_error_log()
+            await save_controller_state()
+            next_sweep=start_date.timestamp()+cycle_time
+            sweeps+=1
+            if cycles is not None and sweeps >= cycles:
+                return
+        else:
+            await evaluate_due_rooms()
+            await save_controller_state()
 
-        stop_error_log()
+        wakeup=next_sweep
+        if site.room_deadlines:
+            wakeup=min(wakeup,site.room_deadlines[0][0])
+        to_wait=max(wakeup-time.time(),0.)
+        log(f'INFO: sleeping for {to_wait} s.',1 if wakeup < next_sweep else 0)
+        site.room_wakeup.clear()
+        if site.dirty_rooms:
+            continue
+        try:
+            await asyncio.wait_for(site.room_wakeup.wait(),to_wait)
+        except asyncio.TimeoutError:
+            pass
 
-        to_wait = cycle_time - (datetime.datetime.now(datetime.timezone.utc) - start_date).total_seconds()
-        if to_wait < 0:
-            to_wait = 0.
-        log(f'INFO: sleeping for {to_wait} s.')
-        await asyncio.sleep(to_wait)
+class RoomConfig:
+    # Settings of one room, compiled once from its config section and the [global] defaults
+    __slots__ = ("section", "url", "calendar_url", "ical_resource", "summary_keyword", "veto_resource", "high", "low", "lown", "ramp",
+                 "boost_threshold", "night_start", "night_end", "heating_switches", "heating_profile", "learn_ramp", "influx_name", "subroom")
 
+    def __init__(self,room,section_name=None,section=None,defaults=None):
+        section=section or {}
+        defaults=defaults or {}
+        def setting(key,default=None):
+            return section[key] if key in section else defaults.get(key,default)
+        self.section=section_name
+        self.url=section.get("url")
+        self.ical_resource=section.get("ical_resource")
+        # The calendar this room follows: its own, or the global one for rooms selected by resource
+        if self.url is not None:
+            self.calendar_url=self.url
+        elif self.ical_resource is not None:
+            self.calendar_url=defaults.get("url")
+        else:
+            self.calendar_url=None
+        self.summary_keyword=setting("summary_keyword")
+        self.veto_resource=setting("veto_resource","")
+        self.high=float(setting("high"))
+        self.low=float(setting("low"))
+        self.lown=float(setting("lown"))
+        self.ramp=float(setting("ramp"))
+        self.boost_threshold=float(section["boost_threshold"]) if "boost_threshold" in section else None
+        if setting("night_start") is not None and setting("night_end") is not None:
+            self.night_start=setting("night_start")
+            self.night_end=setting("night_end")
+        else:
+            self.night_start=None
+            self.night_end=None
+        self.heating_switches=tuple(section["heating_switches"]) if "heating_switches" in section else None
+        self.heating_profile=setting("heating_profile") if self.calendar_url is not None else None
+        self.learn_ramp=bool(setting("learn_ramp",True))
+        if "room_prefix" in section:
+            self.influx_name=section_name
+            self.subroom=room.removeprefix(section["room_prefix"]).strip()
+        else:
+            self.influx_name=room
+            self.subroom=""
 
-if __name__ == "__main__":
+    def settings(self):
+        return tuple(getattr(self,name) for name in self.__slots__)
 
-    # This is where we put the error messages for icinga
-    error_msg_filename="ical_homematic.msg"
+    def __eq__(self,other):
+        return isinstance(other,RoomConfig) and self.settings() == other.settings()
 
-    # Our config file
-    config_files= [ "ical_homematic.ini" ]
+def room_section(room,inisections,prefixes,order):
+    # The section configuring this room: a section named like the room or one whose room_prefix matches.
+    # If several match, the last one in the config file wins.
+    candidates=[prefixes[room[:i]] for i in range(len(room)+1) if room[:i] in prefixes]
+    if room in inisections and not "room_prefix" in inisections[room]:
+        candidates.append(room)
+    if not candidates:
+        return None
+    return max(candidates,key=order.get)
 
-    # One cycle lasts 60 seconds
-    cycle_time = 60.
+def compile_room_configs(inisections,defaults):
+    order={section_name: i for i,section_name in enumerate(inisections)}
+    prefixes=dict()
+    for section_name in inisections:
+        if "room_prefix" in inisections[section_name]:
+            prefixes[inisections[section_name]["room_prefix"]]=section_name
+    configs=dict()
+    for room in site.rooms:
+        section_name=room_section(room,inisections,prefixes,order)
+        configs[room]=RoomConfig(room,section_name,inisections.get(section_name),defaults)
+    return configs
 
-    # This is how far we look into the future in hours
-    lookahead=4
+def apply_config(inisections):
+    # Compile the config of all rooms and apply it where it changed. Returns the new and the changed rooms;
+    # the runtime state of changed rooms (in_event, night_mode, boostLastSet) is kept.
+    configs=compile_room_configs(inisections,site.global_config)
+    new_rooms=[room for room in site.rooms if not room in site.room_configs]
+    changed_rooms=[room for room in site.rooms if room in site.room_configs and site.room_configs[room] != configs[room]]
+    for room in new_rooms:
+        site.room_configs[room]=configs[room]
+        site.rooms[room]["in_event"] =  False
+        site.rooms[room]["boostLastSet"] = datetime.datetime(1970,1,1,tzinfo=datetime.timezone.utc)
+        site.rooms[room]["night_mode"] = False
+    for room in changed_rooms:
+        site.room_configs[room]=configs[room]
+        # Picked up again by update_timelines() if the room still follows a calendar
+        site.rooms[room].pop("timeline",None)
+    return new_rooms,changed_rooms
 
-    # Read our own config file
+def read_config(config_files):
+    # Parse the config files into sections of JSON values. Raises ValueError on a JSON error.
     iniparser = configparser.RawConfigParser()
     iniparser.optionxform=str
-    rooms = dict()
-
-    inisections={}
-    inisections["global"]=dict()
-    inisections["global"]["high"]=21.0
-    inisections["global"]["low"]=18.0
-    inisections["global"]["lown"]=16.0
-    inisections["global"]["ramp"]=1.0
-    inisections["global"]["veto_resource"]=""
+    sections={}
+    sections["global"]=dict()
+    sections["global"]["high"]=21.0
+    sections["global"]["low"]=18.0
+    sections["global"]["lown"]=16.0
+    sections["global"]["ramp"]=1.0
+    sections["global"]["veto_resource"]=""
     for config_file in config_files:
         try:
             iniparser.read(config_file)
         except:
             continue
-        for section_name in iniparser.sections():
-            if not section_name in inisections:
-                inisections[section_name]=dict()
-            for key in iniparser[section_name]:
-                try:
-                    inisections[section_name][key] = json.loads(iniparser[section_name][key])
-                except Exception as e:
-                    log(e)
-                    log(f'JSON parse error in section {section_name}, key {key}. Bye.')
-                    sys.exit(1)
-
-    global_config=inisections.pop("global")
-    log_level=global_config.get("log_level",0)
-
-    config = homematicip.find_and_load_config_file()
-    if config == None:
-        log("Cannot find config.ini!")
-        sys.exit(1)
+    for section_name in iniparser.sections():
+        if not section_name in sections:
+            sections[section_name]=dict()
+        for key in iniparser[section_name]:
+            try:
+                sections[section_name][key] = json.loads(iniparser[section_name][key])
+            except Exception as e:
+                raise ValueError(f'JSON parse error in section {section_name}, key {key}: {e}')
+    return sections
+
+# Settings which are only used at startup
+restart_settings=[ "log_rotate", "log_max_bytes", "log_backup_count", "log_format", "cache_dir", "influxhost", "influxport", "influxdb",
+                   "status_socket", "status_port", "status_host", "http_max_connections", "hmip_max_concurrency", "hmip_rate",
+                   "hmip_burst", "calendar_workers", "sites", "site_processes" ]
+
+def get_config_mtimes(config_files=None):
+    return {config_file: os.path.getmtime(config_file) for config_file in (config_files or site.config_files) if os.path.exists(config_file)}
 
-    home = homematicip.async_home.AsyncHome()
-    asyncio.run(home.init_async(config.access_point,config.auth_token))
-    asyncio.run(home.get_current_state_async())
+def reload_config():
+    # Re-read the config files if they changed, and rebuild only the rooms whose effective settings changed
+    if site.config_mtimes is None:
+        return
+    mtimes=get_config_mtimes()
+    if mtimes == site.config_mtimes:
+        return
+    site.config_mtimes=mtimes
+    old_global_config=site.global_config
+    try:
+        sections=read_config(site.config_files)
+        site.global_config=sections.pop("global")
+        new_rooms,changed_rooms=apply_config(sections)
+    except Exception as e:
+        site.global_config=old_global_config
+        log(f'ERROR: Could not reload {", ".join(site.config_files)}, keeping the previous config: {e}')
+        error_msg(f'Config reload failed: {e}',1)
+        return
+    site.inisections=sections
+    site.log_level=site.global_config.get("log_level",0)
+    for key in restart_settings:
+        if site.global_config.get(key) != old_global_config.get(key):
+            log(f'INFO: {key} changed, this takes effect after a restart.')
+    for room in changed_rooms:
+        log(f'INFO {room}: Settings changed.')
+        wake_room(room)
+    log(f'INFO: Reloaded {", ".join(site.config_files)}, {len(changed_rooms)} rooms changed.')
 
+def discover_rooms():
     # Make sure we have all the rooms that have thermostats or thermometers, even those that are not in our config!
     get_rooms()
+    build_hmip_index()
+    new_rooms,changed_rooms=apply_config(site.inisections)
+    if new_rooms:
+        if site.log_level >= 1:
+            log(f'INFO: Configured {len(new_rooms)} rooms.',1)
 
-    # Apply config to rooms
-    for section_name in inisections:
-        if "room_prefix" in inisections[section_name]:
-            for room in rooms:
-                if room.startswith(inisections[section_name]["room_prefix"]):
-                    rooms[room]=inisections[section_name].copy()
-                    rooms[room]["influx_name"]=section_name
-                    rooms[room]["subroom"]=room.removeprefix(inisections[section_name]["room_prefix"])
-                    rooms[room]["subroom"]=rooms[room]["subroom"].strip()
-        else:
-            if section_name in rooms:
-                rooms[section_name]=inisections[section_name]
-
-    # Initialize some status variables and pick up globals
-    for room in rooms:
-        rooms[room]["in_event"] =  False
-        rooms[room]["boostLastSet"] = datetime.datetime(1970,1,1,tzinfo=datetime.timezone.utc)
-        rooms[room]["night_mode"] = False
-        if not "influx_name" in rooms[room]:
-            rooms[room]["influx_name"]=room
-        if not "subroom" in rooms[room]:
-            rooms[room]["subroom"]=""
-        for key in [ "high", "low", "lown", "ramp", "night_start", "night_end", "summary_keyword", "veto_resource" ]:
-            if not key in rooms[room] and key in global_config:
-                rooms[room][key]=global_config[key]
+def load_home_snapshot():
+    try:
+        with open(site.home_snapshot_filename) as f:
+            json_state=json.load(f)
+        site.home.update_home(json_state)
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        log(f'ERROR: Could not load HmIP snapshot {site.home_snapshot_filename}: {e}')
+        return False
+    if site.log_level >= 1:
+        log(f'INFO: Loaded HmIP snapshot from {site.home_snapshot_filename}.',1)
+    return True
+
+async def load_live_state():
+    # Download the current state from the HmIP cloud and keep a copy for the next start
+    await site.home.init_async(site.config.access_point,site.config.auth_token)
+    json_state=await site.home.download_configuration_async()
+    # The objects created from the snapshot were bound to the connection of the home before init_async() and would
+    # keep it when updated in place, so they are replaced by new ones; discover_rooms() then indexes those.
+    site.home.update_home(json_state,clear_config=True)
+    try:
+        os.makedirs(cache_dir,exist_ok=True)
+        await asyncio.to_thread(write_file_atomic,site.home_snapshot_filename,json.dumps(json_state).encode())
+    except Exception as e:
+        log(f'ERROR: Could not write HmIP snapshot {site.home_snapshot_filename}: {e}')
+
+async def main():
+    # Startup: rooms are discovered from the cached snapshot right away, so that systemd gets READY within a
+    # second, while the live state and the calendars load in the background.
+    global http_semaphore
+    site.home = homematicip.async_home.AsyncHome()
+    if http_semaphore is None:
+        http_semaphore = asyncio.Semaphore(main_site.global_config.get("http_max_connections",8))
+    await start_status_server()
+    if load_home_snapshot():
+        discover_rooms()
+        notify("READY=1")
+        calendars_task=asyncio.create_task(refresh_calendars())
+    else:
+        calendars_task=None
+    await load_live_state()
+    discover_rooms()
+    notify("READY=1")
+    if calendars_task:
+        await calendars_task
+    else:
+        await refresh_calendars()
+    # Validated against the live state and the timelines of the rooms, so only after both are there
+    await update_timelines()
+    restore_controller_state()
+    restore_ramp_models()
+    await main_loop()
+
+async def shutdown():
+    # Stop the background tasks, the websocket and the status endpoint, e.g. before a failed site is restarted
+    for task in site.background_tasks:
+        task.cancel()
+    site.background_tasks.clear()
+    for server in site.status_servers:
+        server.close()
+    site.status_servers.clear()
+    if site.home is not None:
+        try:
+            result=hmip_method(site.home,"disable_events")()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            log(f'ERROR: Could not close the HmIP websocket: {e}')
+
+# Multi-site supervisor: with sites set in [global], one daemon runs several installations, each with its own access
+# point, config file and working directory, in one event loop (or spread over site_processes worker processes).
+# Every site runs main() in its own task with its own Site in current_site. The calendar cache and workers, the
+# influxdb writer and the log writer are those of the supervisor.
+site_tasks=dict()
+
+async def run_site(name,directory):
+    # Run one site until it fails. Returns the error.
+    current_site.set(Site(name,directory))
+    try:
+        site.load_config()
+        log(f'INFO: Starting site {name} in {directory}.')
+        await main()
+    except Exception as e:
+        return e
+    finally:
+        await shutdown()
+
+async def supervise(sites):
+    # Run the sites in this event loop. A site which fails is restarted from scratch after one cycle.
+    global event_loop
+    global http_semaphore
+    global influx_flush
+    event_loop=asyncio.get_running_loop()
+    http_semaphore=asyncio.Semaphore(main_site.global_config.get("http_max_connections",8))
+    influx_flush=asyncio.Event()
+    if influx:
+        main_site.background_tasks.append(asyncio.create_task(influx_writer()))
+    await start_status_server()
+    notify("READY=1")
+    while True:
+        notify("WATCHDOG=1")
+        start_error_log()
+        for name,directory in sites.items():
+            task=site_tasks.get(name)
+            if task is not None and task.done():
+                e=task.result() if not task.cancelled() else "cancelled"
+                log(f'ERROR: Site {name} failed: {e}. Restarting it.')
+                error_msg(f'Site {name} failed: {e}',2)
+                task=None
+            if task is None:
+                site_tasks[name]=asyncio.create_task(run_site(name,directory))
+        stop_error_log()
+        await asyncio.sleep(cycle_time)
+
+class InfluxForwarder:
+    # Stands in for the InfluxDB client in a site worker process: batches are written by the parent process
+
+    def __init__(self,points_queue):
+        self.points_queue=points_queue
+
+    def write_points(self,points):
+        self.points_queue.put(points)
+
+def receive_influx_points(points_queue):
+    # Thread in the parent process handing the batches of the site worker processes to the influxdb writer
+    while True:
+        points=points_queue.get()
+        event_loop.call_soon_threadsafe(forward_influx_points,points)
+
+def forward_influx_points(points):
+    influx_write(points)
+    influx_flush.set()
+
+def run_site_worker(number,sites,settings,worker_log_queue,points_queue):
+    # Entry point of a site worker process. Log records and influxdb points go to the parent process.
+    global log_queue
+    global log_writer
+    global influx_spool_filename
+    global cycle_time
+    global lookahead
+    global cache_dir
+    global influx
+    main_site.global_config=settings["global_config"]
+    log_queue=worker_log_queue
+    # Written by the LogWriter of the parent process
+    log_writer=False
+    main_site.log_level=main_site.global_config.get("log_level",0)
+    main_site.error_msg_filename=f'ical_homematic_worker{number}.msg'
+    influx_spool_filename=f'influx_spool_worker{number}.jsonl'
+    cycle_time=settings["cycle_time"]
+    lookahead=settings["lookahead"]
+    cache_dir=settings["cache_dir"]
+    influx=InfluxForwarder(points_queue) if points_queue is not None else None
+    asyncio.run(supervise(sites))
+
+def stop_site_workers(workers):
+    for worker in workers:
+        if worker is not None and worker.is_alive():
+            worker.terminate()
+            worker.join(5.)
+
+async def supervise_processes(sites,processes):
+    # Spread the sites over worker processes, restarting any which dies after one cycle. This process writes the
+    # log and influxdb for all of them and serves its own status endpoint.
+    global event_loop
+    global influx_flush
+    context=multiprocessing.get_context("spawn")
+    groups=[dict() for i in range(min(processes,len(sites)))]
+    for i,name in enumerate(sites):
+        groups[i%len(groups)][name]=sites[name]
+    # The worker processes share the calendar workers
+    worker_config=dict(main_site.global_config,status_socket="",status_port=0)
+    workers=main_site.global_config.get("calendar_workers",os.cpu_count() or 1)
+    if workers > 0:
+        worker_config["calendar_workers"]=max(1,workers//len(groups))
+    settings={"global_config": worker_config, "cycle_time": cycle_time, "lookahead": lookahead, "cache_dir": cache_dir}
+    event_loop=asyncio.get_running_loop()
+    influx_flush=asyncio.Event()
+    points_queue=None
+    if influx:
+        points_queue=context.Queue()
+        threading.Thread(target=receive_influx_points,args=(points_queue,),name="InfluxReceiver",daemon=True).start()
+        main_site.background_tasks.append(asyncio.create_task(influx_writer()))
+    await start_status_server()
+    processes=[None]*len(groups)
+    atexit.register(stop_site_workers,processes)
+    notify("READY=1")
+    while True:
+        notify("WATCHDOG=1")
+        start_error_log()
+        for i,group in enumerate(groups):
+            if processes[i] is not None and not processes[i].is_alive():
+                log(f'ERROR: Worker process {i} ({", ".join(group)}) exited with code {processes[i].exitcode}. Restarting it.')
+                error_msg(f'Worker process for {", ".join(group)} exited with code {processes[i].exitcode}',2)
+                processes[i]=None
+            if processes[i] is None:
+                processes[i]=context.Process(target=run_site_worker,name=f'ical_homematic worker {i}',args=(i,group,settings,log_queue,points_queue))
+                processes[i].start()
+                log(f'INFO: Started worker process {i} (pid {processes[i].pid}) for {", ".join(group)}.')
+        stop_error_log()
+        await asyncio.sleep(cycle_time)
+
+def query_status(path,socket_name=None,host="127.0.0.1",port=0,timeout=10.):
+    # One request to the status endpoint of the running daemon, over its Unix socket or else TCP
+    if socket_name:
+        s=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        s.connect(socket_name)
+    else:
+        s=socket.create_connection((host,port),timeout)
+    with s:
+        s.sendall(f'GET {path} HTTP/1.0\r\nHost: localhost\r\n\r\n'.encode())
+        response=b''
+        while True:
+            data=s.recv(65536)
+            if not data:
+                break
+            response+=data
+    head,_,body=response.partition(b'\r\n\r\n')
+    if head.split(b' ')[1:2] != [b'200']:
+        raise http.client.HTTPException(head.split(b'\r\n')[0].decode()+": "+body.decode(errors="replace").strip())
+    return json.loads(body)
+
+def schedule_command(argv):
+    # ical_homematic.py schedule: print the planned set points as served by the running daemon
+    parser=argparse.ArgumentParser(prog="ical_homematic.py schedule",description="Planned set points of the rooms, from the calendars and room settings of the running service.")
+    parser.add_argument("rooms",nargs="*",help="rooms to show (default: all)")
+    parser.add_argument("--start",help="start of the window, ISO 8601 or unix time (default: now)")
+    parser.add_argument("--hours",type=float,default=168.,help="length of the window in hours (default: 168)")
+    parser.add_argument("--config",default=site.config_files[0],help="config file of the service (default: %(default)s)")
+    parser.add_argument("--site",help="site of a multi-site service")
+    parser.add_argument("--json",action="store_true",help="print the JSON answer of the service")
+    args=parser.parse_args(argv)
+    directory=os.path.dirname(args.config)
+    try:
+        settings=read_config([args.config])["global"]
+        if args.site is not None:
+            if not args.site in settings.get("sites",{}):
+                print(f'Unknown site {args.site}.')
+                return 1
+            directory=settings["sites"][args.site]
+            settings=read_config([os.path.join(directory,"ical_homematic.ini")])["global"]
+    except ValueError as e:
+        print(e)
+        return 1
+    socket_name=settings.get("status_socket","ical_homematic.sock")
+    query=[("room",room) for room in args.rooms]+[("hours",args.hours)]
+    if args.start is not None:
+        query.append(("start",args.start))
+    try:
+        schedule=query_status("/schedule?"+urllib.parse.urlencode(query),os.path.join(directory,socket_name) if socket_name else None,
+                              settings.get("status_host","127.0.0.1"),settings.get("status_port",0))
+    except Exception as e:
+        print(f'Could not query the status endpoint of the service: {e}')
+        return 1
+    if args.json:
+        print(json.dumps(schedule,indent=1))
+        return 0
+    for room,plan in schedule["rooms"].items():
+        if "error" in plan:
+            print(f'{room}: {plan["error"]}')
+            continue
+        print(f'{room} ({plan["kind"]}{": "+", ".join(plan["switches"])+" on during events" if "switches" in plan else ""})')
+        if "note" in plan:
+            print(f'  {plan["note"]}')
+            continue
+        if plan["complete_until"] is not None and plan["complete_until"] < schedule["end"]:
+            print(f'  Events are only known until {logtime(plan["complete_until"])} (timeline_horizon).')
+        next_heat=plan["next_heat"]
+        if next_heat is not None:
+            print(f'  Next heat-up from {logtime(next_heat["from"])} for {next_heat["title"]} ({logtime(next_heat["event_start"])} to {logtime(next_heat["event_end"])}).')
+        for k,(value,reason) in enumerate(zip(plan["setpoints"],plan["reasons"])):
+            print(f'  {logtime(plan["times"][k])} - {logtime(plan["times"][k+1])}  {value:4.1f}°C  {reason}')
+    return 0
+
+if __name__ == "__main__":
+
+    # Command line client of the running service
+    if sys.argv[1:2] == [ "schedule" ]:
+        sys.exit(schedule_command(sys.argv[2:]))
+
+    # This is where we put the error messages for icinga
+    site.error_msg_filename="ical_homematic.msg"
+
+    # One cycle lasts 60 seconds
+    cycle_time = 60.
+
+    # This is how far we look into the future in hours
+    lookahead=4
+
+    # Read our own config file; it is re-read whenever it changes
+    site.rooms = dict()
+    site.config_mtimes=get_config_mtimes()
+    try:
+        site.inisections=read_config(site.config_files)
+    except ValueError as e:
+        log(e)
+        log('Bye.')
+        sys.exit(1)
+
+    site.global_config=site.inisections.pop("global")
+    site.log_level=site.global_config.get("log_level",0)
+
+    # Sites run by this process as a supervisor, optionally in worker processes
+    sites=site.global_config.get("sites")
+    site_processes=site.global_config.get("site_processes",0)
+    if sites and site_processes > 0:
+        # The LogWriter of this process also writes the records of the worker processes
+        log_queue=multiprocessing.get_context("spawn").Queue(maxsize=log_queue_max)
+    start_logging(rotate_when=site.global_config.get("log_rotate","size"),
+                  max_bytes=site.global_config.get("log_max_bytes",10*1024*1024),
+                  backup_count=site.global_config.get("log_backup_count",5),
+                  json_lines=site.global_config.get("log_format","text")=="json")
+    atexit.register(stop_logging)
+
+    # Downloaded calendars are kept here across restarts
+    cache_dir=site.global_config.get("cache_dir",os.path.join(os.path.expanduser("~"),"cache"))
+
+    # Snapshot of the last downloaded HmIP state, for room discovery before the cloud has answered
+    site.home_snapshot_filename=os.path.join(cache_dir,"home_snapshot.json")
 
     # influxdb for logging
-    if "influxhost" in global_config:
+    if "influxhost" in site.global_config:
         try:
-            influx=InfluxDBClient(global_config["influxhost"],global_config["influxport"],database=global_config["influxdb"])
+            from influxdb import InfluxDBClient
+            influx=InfluxDBClient(site.global_config["influxhost"],site.global_config["influxport"],database=site.global_config["influxdb"])
         except:
-            log(f'Could not setup InfluxDB client. Bye.')
+            log('Could not setup InfluxDB client. Bye.')
             sys.exit(1)
     else:
         influx=None
-    asyncio.run(main_loop())
 
+    if sites:
+        # Each site has its own config files; rooms configured here are not used
+        log(f'INFO: Supervising {len(sites)} sites: {", ".join(sites)}.')
+        if site_processes > 0:
+            asyncio.run(supervise_processes(sites,site_processes))
+        else:
+            asyncio.run(supervise(sites))
+    else:
+        site.config = homematicip.find_and_load_config_file()
+        if site.config == None:
+            log("Cannot find config.ini!")
+            sys.exit(1)
+
+        asyncio.run(main())
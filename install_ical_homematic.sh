@@ -38,7 +38,7 @@ else
 fi
 
 echo "Installation erforderlicher python Pakete mit pip in ${venv}."
-"${venv}/bin/pip" install homematicip influxdb systemd-python icalendar recurring_ical_events
+"${venv}/bin/pip" install homematicip influxdb systemd-python icalendar recurring_ical_events numpy
 
 if [ -d "${localdir}" ] ; then
   echo "Verzeichnis ${localdir} für Logs und Statusdateien sowie als Homeverzeichnis für ${localuser} existiert bereits."
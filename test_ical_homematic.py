@@ -0,0 +1,436 @@
+#!/usr/local/share/mypy/bin/python3
+# Copyright (C) 2024 Christian Ospelkaus
+# This file is part of ical_homematic <https://github.com/cospelka/ical_homematic>.
+#
+# ical_homematic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ical_homematic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ical_homematic.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of ical_homematic which need neither an access point nor a network. Run with
+#
+#   python -m unittest test_ical_homematic.py
+
+import os
+import sys
+import json
+import math
+import time
+import types
+import datetime
+import tempfile
+import unittest
+import icalendar
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+import ical_homematic
+
+class CalendarScanTest(unittest.TestCase):
+    # The streaming scan and the expansion of its records must give the same occurrences as a full parse
+
+    def ingest_and_compare(self,ics,start,end):
+        with tempfile.NamedTemporaryFile("w",suffix=".ics",delete=False) as f:
+            f.write(ics)
+        try:
+            expected=ical_homematic.expand_calendar(icalendar.Calendar.from_ical(ics),start,end)
+            fingerprints,records,occurrences,changed,removed=ical_homematic.ingest_calendar(f.name,start,end,None)
+        finally:
+            os.remove(f.name)
+        self.assertEqual(occurrences,expected)
+        return occurrences
+
+    def test_x_wr_timezone_across_dst(self):
+        # Google-style feed: a UTC series in a calendar with X-WR-TIMEZONE stays at 09:00 local time across the
+        # end of daylight saving time on 2026-10-25, i.e. moves from 07:00Z to 08:00Z
+        ics="\r\n".join(["BEGIN:VCALENDAR","VERSION:2.0","PRODID:-//Google Inc//Google Calendar 70.9054//EN",
+                         "X-WR-CALNAME:Rooms","X-WR-TIMEZONE:Europe/Berlin",
+                         "BEGIN:VTODO","UID:todo","SUMMARY:Not a calendar property","END:VTODO",
+                         "BEGIN:VEVENT","UID:daily","DTSTART:20261020T070000Z","DTEND:20261020T080000Z",
+                         "RRULE:FREQ=DAILY;COUNT=14","SUMMARY:Lecture (HEIZ)","END:VEVENT",
+                         "END:VCALENDAR",""])
+        start=datetime.datetime(2026,10,21,tzinfo=datetime.timezone.utc)
+        end=datetime.datetime(2026,10,30,tzinfo=datetime.timezone.utc)
+        occurrences=self.ingest_and_compare(ics,start,end)
+        hours=[datetime.datetime.fromtimestamp(o[0],datetime.timezone.utc).hour for o in occurrences["daily"]]
+        self.assertEqual(hours,[7]*4+[8]*5)
+
+    def test_vtimezone_across_dst(self):
+        ics="\r\n".join(["BEGIN:VCALENDAR","VERSION:2.0","PRODID:-//test//EN",
+                         "BEGIN:VTIMEZONE","TZID:Europe/Berlin",
+                         "BEGIN:DAYLIGHT","TZOFFSETFROM:+0100","TZOFFSETTO:+0200","TZNAME:CEST","DTSTART:19700329T020000",
+                         "RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU","END:DAYLIGHT",
+                         "BEGIN:STANDARD","TZOFFSETFROM:+0200","TZOFFSETTO:+0100","TZNAME:CET","DTSTART:19701025T030000",
+                         "RRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU","END:STANDARD","END:VTIMEZONE",
+                         "BEGIN:VEVENT","UID:weekly","DTSTART;TZID=Europe/Berlin:20261001T180000",
+                         "DTEND;TZID=Europe/Berlin:20261001T200000","RRULE:FREQ=WEEKLY","EXDATE;TZID=Europe/Berlin:20261022T180000",
+                         "SUMMARY:Choir","RESOURCES:Hall","END:VEVENT",
+                         "BEGIN:VEVENT","UID:weekly","RECURRENCE-ID;TZID=Europe/Berlin:20261015T180000",
+                         "DTSTART;TZID=Europe/Berlin:20261015T190000","DTEND;TZID=Europe/Berlin:20261015T210000",
+                         "SUMMARY:Choir (moved)","RESOURCES:Hall","END:VEVENT",
+                         "END:VCALENDAR",""])
+        start=datetime.datetime(2026,10,10,tzinfo=datetime.timezone.utc)
+        end=datetime.datetime(2026,11,10,tzinfo=datetime.timezone.utc)
+        occurrences=self.ingest_and_compare(ics,start,end)
+        self.assertEqual(len(occurrences["weekly"]),3)
+
+    def test_rejects_non_calendar(self):
+        # An error or captive portal page served with status 200, or a truncated download, must not replace the cached
+        # calendar: ingest_calendar raises and refresh_calendar keeps the previous one
+        start=datetime.datetime(2026,10,10,tzinfo=datetime.timezone.utc)
+        end=datetime.datetime(2026,11,10,tzinfo=datetime.timezone.utc)
+        bodies=["<html><head><title>503 Service Unavailable</title></head><body>Service unavailable</body></html>\n",
+                "",
+                "\r\n".join(["BEGIN:VCALENDAR","VERSION:2.0","BEGIN:VEVENT","UID:cut","DTSTART:20261020T070000Z",""])]
+        for body in bodies:
+            with tempfile.NamedTemporaryFile("w",suffix=".ics",delete=False) as f:
+                f.write(body)
+            try:
+                with self.assertRaises(ValueError):
+                    ical_homematic.ingest_calendar(f.name,start,end,None)
+            finally:
+                os.remove(f.name)
+
+class RestoreControllerStateTest(unittest.TestCase):
+    # The event flag of a restored room follows the timeline: the first sweep after a restart acts on the BEGIN and
+    # END flanks which passed while the service was down, and pending commands from before them are dropped
+
+    def setUp(self):
+        # A fresh site, as the supervisor would run it from this directory
+        self.directory=tempfile.TemporaryDirectory()
+        self.token=ical_homematic.current_site.set(ical_homematic.Site("test",self.directory.name))
+        ical_homematic.site.room_configs={"Hall": types.SimpleNamespace(calendar_url="https://example.org/hall.ics",night_start=None,
+                                                                        night_end=None,heating_switches=None)}
+        self.now=time.time()
+
+    def tearDown(self):
+        ical_homematic.current_site.reset(self.token)
+        self.directory.cleanup()
+
+    def restore(self,events,saved_ago,in_event,desired_ago):
+        for ledger in (ical_homematic.site.desired_state,ical_homematic.site.desired_times,ical_homematic.site.issued_state):
+            ledger.clear()
+        ical_homematic.site.rooms={"Hall": {"in_event": False, "night_mode": False, "timeline": ical_homematic.Timeline(events),
+                                            "boostLastSet": datetime.datetime.now(datetime.timezone.utc)}}
+        saved=self.now-saved_ago
+        with open(ical_homematic.site.state_filename,"w") as f:
+            json.dump({"saved": saved, "rooms": {"Hall": {"in_event": in_event, "night_mode": False, "boostLastSet": 0., "event_title": "Concert"}},
+                       "desired": {"Hall": {"setpoint": 21.0}}, "desired_times": {"Hall": {"setpoint": self.now-desired_ago}}}, f)
+        ical_homematic.restore_controller_state()
+        return ical_homematic.site.rooms["Hall"]["in_event"],ical_homematic.site.desired_state.get("Hall",{})
+
+    def test_running_event(self):
+        # BEGIN handled before the restart: nothing to do again, the pending set point of this event is kept
+        in_event,desired=self.restore([(self.now-3600.,self.now+3600.,"Concert")],600.,True,900.)
+        self.assertTrue(in_event)
+        self.assertEqual(desired,{"setpoint": 21.0})
+        # Saved before this event began (the previous one was still running): its BEGIN is still due
+        in_event,desired=self.restore([(self.now-3*3600.,self.now-2*3600.,"Rehearsal"),(self.now-3600.,self.now+3600.,"Concert")],
+                                      3*3600.-600.,True,3*3600.-900.)
+        self.assertFalse(in_event)
+        self.assertEqual(desired,{})
+
+    def test_finished_event(self):
+        # The event ended while we were down: its END is still due, and the set point desired during it is dropped
+        in_event,desired=self.restore([(self.now-3*3600.,self.now-3600.,"Concert")],2*3600.,True,2*3600.+60.)
+        self.assertTrue(in_event)
+        self.assertEqual(desired,{})
+        state={"setpoint": [21.],"actual": [21.],"boost_duration": [float("nan")],"boost_last_set": [0.],"in_event": [in_event],
+               "night_mode": [False],"first_start": [float("nan")],"second_start": [float("nan")]}
+        params={"high": [21.],"low": [18.],"lown": [16.],"ramp": [1.],"boost_threshold": [float("nan")],"night_start": [float("nan")],
+                "night_end": [float("nan")],"switches": [False],"profile": [False]}
+        import numpy
+        decision=ical_homematic.control_kernel({key: numpy.array(value) for key,value in params.items()},
+                                               {key: numpy.array(value) for key,value in state.items()},self.now,12)
+        self.assertTrue(decision["end"][0])
+        self.assertEqual(decision["setpoint"][0],18.)
+
+class NightScheduleTest(unittest.TestCase):
+    # night_start and night_end come from the config file as int or float; the scheduler wakes a room at the whole
+    # hour at which night_intervals() and the control logic switch
+
+    def test_next_local_hour(self):
+        now=datetime.datetime(2026,10,17,12,30)
+        for hour,expected in ((22,datetime.datetime(2026,10,17,22)),(22.0,datetime.datetime(2026,10,17,22)),
+                              (6.5,datetime.datetime(2026,10,18,7)),(12,datetime.datetime(2026,10,18,12)),
+                              (23.5,datetime.datetime(2026,10,18,0))):
+            self.assertEqual(ical_homematic.next_local_hour(now,hour),expected.timestamp())
+
+    def test_matches_night_intervals(self):
+        config=types.SimpleNamespace(night_start=21.5,night_end=6.0,heating_switches=None)
+        now=datetime.datetime(2026,10,17,12,30)
+        intervals=ical_homematic.night_intervals(config,now.timestamp(),now.timestamp()+2*86400.)
+        self.assertIn(ical_homematic.next_local_hour(now,config.night_start),[start for start,end in intervals])
+        self.assertIn(ical_homematic.next_local_hour(now,config.night_end),[end for start,end in intervals])
+
+class ControlKernelTest(unittest.TestCase):
+    # The batched control kernel against the decisions of the scalar control logic it replaced: every flank sets
+    # its target in the order in which the scalar code issued the calls, so the last one wins
+
+    now=1800000000.
+
+    def kernel(self,hour=12,**room):
+        # One room: a thermostat room at 19°C, set to 18°C, high/low/lown 21/18/16, 1 K/h, nothing else configured
+        import numpy
+        params=dict(high=21.,low=18.,lown=16.,ramp=1.,boost_threshold=math.nan,night_start=math.nan,night_end=math.nan,switches=False,profile=False)
+        state=dict(setpoint=18.,actual=19.,boost_duration=15.,boost_last_set=0.,in_event=False,night_mode=False,
+                   first_start=math.nan,second_start=math.nan)
+        for key,value in room.items():
+            (params if key in params else state)[key]=value
+        decision=ical_homematic.control_kernel({key: numpy.array([value]) for key,value in params.items()},
+                                               {key: numpy.array([value]) for key,value in state.items()},self.now,hour)
+        return {key: value[0].item() for key,value in decision.items()}
+
+    def assertTarget(self,decision,target):
+        if target is None:
+            self.assertTrue(math.isnan(decision["setpoint"]),decision)
+        else:
+            self.assertEqual(decision["setpoint"],target,decision)
+
+    def test_begin(self):
+        decision=self.kernel(first_start=self.now-60.)
+        self.assertTrue(decision["begin_set_high"])
+        self.assertTrue(decision["in_event"])
+        self.assertTarget(decision,21.)
+
+    def test_begin_already_high(self):
+        # Nothing to set, but the room is in the event from now on
+        decision=self.kernel(setpoint=21.,first_start=self.now-60.)
+        self.assertTrue(decision["begin"])
+        self.assertFalse(decision["begin_set_high"])
+        self.assertTrue(decision["in_event"])
+        self.assertTarget(decision,None)
+        # Within 0.1 K of high counts as set
+        self.assertFalse(self.kernel(setpoint=20.95,first_start=self.now-60.)["begin_set_high"])
+
+    def test_end(self):
+        decision=self.kernel(setpoint=21.,in_event=True)
+        self.assertTrue(decision["end"])
+        self.assertFalse(decision["in_event"])
+        self.assertTarget(decision,18.)
+
+    def test_end_then_night_on(self):
+        # The event ends at the start of the night: END sets low, then the night flank sets lown
+        decision=self.kernel(hour=22,setpoint=21.,in_event=True,night_start=22.,night_end=6.)
+        self.assertTrue(decision["end"])
+        self.assertTrue(decision["night_set_lown"])
+        self.assertTrue(decision["night_mode"])
+        self.assertTarget(decision,16.)
+        # With the next event in sight the night flank leaves the set point alone, and the ramp wins over END
+        decision=self.kernel(hour=22,setpoint=20.,actual=17.,in_event=True,night_start=22.,night_end=6.,first_start=self.now+1800.)
+        self.assertTrue(decision["end"])
+        self.assertTrue(decision["night_on"])
+        self.assertFalse(decision["night_set_lown"])
+        self.assertTrue(decision["ramp_high"])
+        self.assertTarget(decision,21.)
+
+    def test_night_off(self):
+        decision=self.kernel(hour=6,setpoint=16.,night_mode=True,night_start=22.,night_end=6.)
+        self.assertTrue(decision["night_off"])
+        self.assertFalse(decision["night_mode"])
+        self.assertTarget(decision,18.)
+        # Not within the night when it does not wrap around midnight either
+        decision=self.kernel(hour=12,night_mode=True,night_start=1.,night_end=5.)
+        self.assertTrue(decision["night_off"])
+        self.assertTarget(decision,None)
+
+    def test_ramp_before_event(self):
+        # 19°C and 1 K/h: 21°C is reached in time for an event in 2 h, not for one in 30 minutes
+        self.assertTarget(self.kernel(first_start=self.now+2*3600.),None)
+        decision=self.kernel(first_start=self.now+1800.)
+        self.assertEqual(decision["timetohot"],1800.)
+        self.assertTrue(decision["ramp_high"])
+        self.assertTarget(decision,21.)
+
+    def test_ramp_in_event_towards_next(self):
+        # In an event (set point lowered by hand), the ramp only looks at the next event once it is in sight
+        decision=self.kernel(in_event=True,first_start=self.now-600.)
+        self.assertFalse(decision["ramp_high"])
+        self.assertTarget(decision,None)
+        decision=self.kernel(in_event=True,first_start=self.now-600.,second_start=self.now+1800.)
+        self.assertFalse(decision["end"])
+        self.assertEqual(decision["timetohot"],1800.)
+        self.assertTrue(decision["ramp_high"])
+        self.assertTarget(decision,21.)
+        # Night starting during the event: no reduction while in the event
+        decision=self.kernel(hour=22,in_event=True,setpoint=21.,first_start=self.now-600.,night_start=22.,night_end=6.)
+        self.assertTrue(decision["night_on"])
+        self.assertFalse(decision["night_set_lown"])
+        self.assertTarget(decision,None)
+
+    def test_boost(self):
+        self.assertTrue(self.kernel(setpoint=21.,actual=18.,boost_threshold=2.)["boost"])
+        self.assertFalse(self.kernel(setpoint=21.,actual=18.,boost_threshold=3.)["boost"])
+        # The last boost (15 minutes) is still running
+        self.assertFalse(self.kernel(setpoint=21.,actual=18.,boost_threshold=2.,boost_last_set=self.now-600.)["boost"])
+
+    def test_switch_rooms(self):
+        # Rooms with heating switches follow BEGIN and END only: no ramp, boost or night reduction
+        room=dict(switches=True,actual=15.,boost_threshold=1.,night_start=22.,night_end=6.)
+        decision=self.kernel(hour=23,first_start=self.now+1800.,**room)
+        for flank in ("ramp_high","boost","night_on","night_set_lown","night_mode"):
+            self.assertFalse(decision[flank],flank)
+        self.assertTarget(decision,None)
+        self.assertFalse(self.kernel(hour=12,night_mode=True,**room)["night_off"])
+        self.assertTarget(self.kernel(hour=23,first_start=self.now-60.,**room),21.)
+        self.assertTarget(self.kernel(hour=23,setpoint=21.,in_event=True,**room),18.)
+
+    def test_profile_rooms(self):
+        # Flanks are tracked, but the heating profile sets the temperatures
+        decision=self.kernel(first_start=self.now-60.,profile=True)
+        self.assertTrue(decision["in_event"])
+        self.assertTarget(decision,None)
+
+    def test_nan_inputs(self):
+        # Unknown values never act
+        decision=self.kernel(setpoint=math.nan,first_start=self.now-60.)
+        self.assertTrue(decision["begin_without_setpoint"])
+        self.assertFalse(decision["in_event"])
+        self.assertTarget(decision,None)
+        self.assertTarget(self.kernel(actual=math.nan,first_start=self.now+1800.),None)
+        self.assertFalse(self.kernel(setpoint=21.,actual=math.nan,boost_threshold=1.)["boost"])
+        self.assertFalse(self.kernel(setpoint=21.,actual=18.,boost_threshold=1.,boost_duration=math.nan)["boost"])
+        self.assertFalse(self.kernel(hour=23,night_start=22.,night_end=math.nan)["night_on"])
+        self.assertTarget(self.kernel(hour=6,setpoint=math.nan,night_mode=True,night_start=22.,night_end=6.),None)
+
+    def test_batch(self):
+        # Rooms evaluated together get the same decisions as one by one
+        import numpy
+        rooms=[dict(first_start=self.now-60.),dict(setpoint=21.,in_event=True,night_start=22.,night_end=6.),
+               dict(switches=True,actual=15.,first_start=self.now+1800.),dict(setpoint=math.nan,first_start=self.now-60.)]
+        single=[self.kernel(hour=22,**room) for room in rooms]
+        params=dict(high=21.,low=18.,lown=16.,ramp=1.,boost_threshold=math.nan,night_start=math.nan,night_end=math.nan,switches=False,profile=False)
+        state=dict(setpoint=18.,actual=19.,boost_duration=15.,boost_last_set=0.,in_event=False,night_mode=False,
+                   first_start=math.nan,second_start=math.nan)
+        batch=ical_homematic.control_kernel({key: numpy.array([room.get(key,value) for room in rooms]) for key,value in params.items()},
+                                            {key: numpy.array([room.get(key,value) for room in rooms]) for key,value in state.items()},self.now,22)
+        for i,decision in enumerate(single):
+            for key,value in decision.items():
+                if isinstance(value,float) and math.isnan(value):
+                    self.assertTrue(math.isnan(batch[key][i]),(i,key))
+                else:
+                    self.assertEqual(batch[key][i],value,(i,key))
+
+class InfluxSpoolTest(unittest.TestCase):
+    # Batches which could not be written to influxdb are appended to the spool file and read back oldest first,
+    # across restarts, from the read offset stored next to it
+
+    def setUp(self):
+        self.directory=tempfile.TemporaryDirectory()
+        self.saved=(ical_homematic.influx_spool_filename,dict(ical_homematic.influx_stats),ical_homematic.main_site.global_config)
+        ical_homematic.influx_spool_filename=os.path.join(self.directory.name,"influx_spool.jsonl")
+        ical_homematic.main_site.global_config={"influx_spool_compact": 2}
+        ical_homematic.scan_influx_spool()
+
+    def tearDown(self):
+        ical_homematic.influx_spool_filename,stats,ical_homematic.main_site.global_config=self.saved
+        ical_homematic.influx_stats.update(stats)
+        ical_homematic.influx_spool_batches.clear()
+        self.directory.cleanup()
+
+    def batch(self,i,points=2):
+        return [{"measurement": "temperature", "tags": {"room": f'Room {i}'}, "fields": {"value": float(j)}} for j in range(points)]
+
+    def spooled(self):
+        return [json.loads(line) for line in open(ical_homematic.influx_spool_filename,"rb")]
+
+    def test_append_and_peek(self):
+        for i in range(3):
+            ical_homematic.spool_influx_points(self.batch(i))
+        self.assertEqual(ical_homematic.influx_stats["spooled"],6)
+        self.assertEqual(self.spooled(),[self.batch(i) for i in range(3)])
+        # A batch stays in the spool until it is done
+        self.assertEqual(ical_homematic.peek_influx_spool(),self.batch(0))
+        self.assertEqual(ical_homematic.peek_influx_spool(),self.batch(0))
+        ical_homematic.done_influx_spool_batch()
+        self.assertEqual(ical_homematic.peek_influx_spool(),self.batch(1))
+        self.assertEqual(ical_homematic.influx_stats["spooled"],4)
+
+    def test_restart_from_offset(self):
+        for i in range(3):
+            ical_homematic.spool_influx_points(self.batch(i))
+        ical_homematic.done_influx_spool_batch()
+        # Written batches stay in the file; the restarted writer continues after them
+        self.assertEqual(len(self.spooled()),3)
+        ical_homematic.scan_influx_spool()
+        self.assertEqual(len(ical_homematic.influx_spool_batches),2)
+        self.assertEqual(ical_homematic.influx_stats["spooled"],4)
+        self.assertEqual(ical_homematic.peek_influx_spool(),self.batch(1))
+
+    def test_partial_line(self):
+        # A write interrupted by a crash leaves a line without newline, which is cut off
+        for i in range(2):
+            ical_homematic.spool_influx_points(self.batch(i))
+        size=os.path.getsize(ical_homematic.influx_spool_filename)
+        with open(ical_homematic.influx_spool_filename,"ab") as f:
+            f.write(json.dumps(self.batch(2)).encode()[:20])
+        ical_homematic.scan_influx_spool()
+        self.assertEqual(os.path.getsize(ical_homematic.influx_spool_filename),size)
+        self.assertEqual(len(ical_homematic.influx_spool_batches),2)
+        ical_homematic.spool_influx_points(self.batch(3))
+        self.assertEqual(self.spooled(),[self.batch(0),self.batch(1),self.batch(3)])
+        for i in (0,1,3):
+            self.assertEqual(ical_homematic.peek_influx_spool(),self.batch(i))
+            ical_homematic.done_influx_spool_batch()
+        self.assertIsNone(ical_homematic.peek_influx_spool())
+
+    def test_skip_unreadable(self):
+        with open(ical_homematic.influx_spool_filename,"wb") as f:
+            f.write((json.dumps(self.batch(0))+"\n{not json\n"+json.dumps(self.batch(1))+"\n").encode())
+        ical_homematic.scan_influx_spool()
+        self.assertEqual(len(ical_homematic.influx_spool_batches),2)
+        self.assertEqual(ical_homematic.peek_influx_spool(),self.batch(0))
+        ical_homematic.done_influx_spool_batch()
+        self.assertEqual(ical_homematic.peek_influx_spool(),self.batch(1))
+        # A batch damaged after it was indexed is dropped when it is read
+        ical_homematic.spool_influx_points(self.batch(2))
+        ical_homematic.spool_influx_points(self.batch(3))
+        offset,length,points=ical_homematic.influx_spool_batches[1]
+        with open(ical_homematic.influx_spool_filename,"rb+") as f:
+            f.seek(offset)
+            f.write(b"#")
+        ical_homematic.done_influx_spool_batch()
+        dropped=ical_homematic.influx_stats["dropped"]
+        self.assertEqual(ical_homematic.peek_influx_spool(),self.batch(3))
+        self.assertEqual(ical_homematic.influx_stats["dropped"],dropped+2)
+
+    def test_limit(self):
+        ical_homematic.main_site.global_config["influx_spool_max"]=5
+        dropped=ical_homematic.influx_stats["dropped"]
+        for i in range(3):
+            ical_homematic.spool_influx_points(self.batch(i))
+        self.assertEqual(ical_homematic.influx_stats["spooled"],4)
+        self.assertEqual(ical_homematic.influx_stats["dropped"],dropped+2)
+        self.assertEqual(ical_homematic.peek_influx_spool(),self.batch(1))
+
+    def test_compact(self):
+        for i in range(4):
+            ical_homematic.spool_influx_points(self.batch(i))
+        size=os.path.getsize(ical_homematic.influx_spool_filename)
+        ical_homematic.done_influx_spool_batch()
+        self.assertEqual(os.path.getsize(ical_homematic.influx_spool_filename),size)
+        # Two batches (influx_spool_compact) skipped, and they are half of the file: only the rest is kept
+        ical_homematic.done_influx_spool_batch()
+        self.assertEqual(self.spooled(),[self.batch(2),self.batch(3)])
+        self.assertEqual(ical_homematic.influx_spool_batches[0][0],0)
+        self.assertEqual(ical_homematic.peek_influx_spool(),self.batch(2))
+        ical_homematic.scan_influx_spool()
+        self.assertEqual(ical_homematic.peek_influx_spool(),self.batch(2))
+        # The spool and its offset are removed once everything is written
+        for i in range(2):
+            ical_homematic.done_influx_spool_batch()
+        self.assertFalse(os.path.exists(ical_homematic.influx_spool_filename))
+        self.assertFalse(os.path.exists(ical_homematic.influx_spool_offset_filename()))
+        ical_homematic.spool_influx_points(self.batch(4))
+        self.assertEqual(ical_homematic.influx_spool_batches[0][0],0)
+        self.assertEqual(ical_homematic.peek_influx_spool(),self.batch(4))
+
+if __name__ == "__main__":
+    unittest.main()